@@ -0,0 +1,139 @@
+# CLI: Parses many snapshot files in parallel, and runs exports on each of them
+# Usage: python -m darter [options] <snapshot file>...
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+
+# name: (extension of output file, mode, whether native references are needed)
+EXPORTS = {
+    'summary': ('.summary.json', 'w', False),
+    'strings': ('.strings.jsonl', 'w', False),
+    'metadata': ('.meta.r2', 'w', True),
+    'sqlite': ('.sqlite', None, False),
+}
+
+def load_snapshot(fname, options):
+    ''' Parses an ELF (AppAOT) or AppJIT snapshot file, depending on its magic '''
+    from .file import parse_elf_snapshot, parse_appjit_snapshot
+    with open(fname, 'rb') as f:
+        is_elf = f.read(4) == b'\x7fELF'
+    parse = parse_elf_snapshot if is_elf else parse_appjit_snapshot
+    image = fname + '.image' if options['image'] else None
+    return parse(fname, image=image, print_level=options['print_level'], strict=options['strict'], stats=options['stats'])
+
+def run_export(s, name, path):
+    from . import export
+    _, mode, _ = EXPORTS[name]
+    if mode is None:
+        return export.export_sqlite(s, path)
+    with open(path, mode, encoding='utf-8') as f:
+        getattr(export, { 'metadata': 'export_r2_metadata' }.get(name, 'export_' + name))(s, f)
+
+def process_file(task):
+    ''' Worker: parses a snapshot file and runs the exports on it, returns a result dictionary '''
+    fname, outputs, options = task
+    result = { 'file': fname, 'ok': False, 'times': {}, 'outputs': {} }
+    times, log = result['times'], io.StringIO()
+    start = time.time()
+    try:
+        with redirect_stdout(sys.stdout if options['verbose'] else log):
+            t = time.time()
+            s = load_snapshot(fname, options)
+            times['parse'] = time.time() - t
+            if s.stats is not None: result['stats'] = s.stats.to_dict()
+            if any(EXPORTS[name][2] for name in outputs):
+                from .asm.base import populate_native_references
+                t = time.time()
+                populate_native_references(s, cache=options['nrefs_cache'])
+                times['analyze'] = time.time() - t
+            for name, path in outputs.items():
+                t = time.time()
+                run_export(s, name, path)
+                times[name] = time.time() - t
+                result['outputs'][name] = path
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = traceback.format_exception_only(type(e), e)[-1].strip()
+        result['traceback'] = traceback.format_exc()
+        result['log'] = log.getvalue()[-2000:]
+    times['total'] = time.time() - start
+    return result
+
+def init_worker(max_memory):
+    if max_memory:
+        import resource
+        limit = max_memory << 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def output_paths(files, exports, outdir):
+    ''' Returns the outputs of each file: next to the file, or in `outdir` (named after the
+        path of the file relative to the common directory of all of them) '''
+    if outdir is None:
+        return [ { name: f + EXPORTS[name][0] for name in exports } for f in files ]
+    dirs = [ os.path.dirname(os.path.abspath(f)) for f in files ]
+    root = os.path.commonpath(dirs) if dirs else ''
+    names = [ os.path.relpath(os.path.abspath(f), root).replace(os.sep, '_') for f in files ]
+    return [ { name: os.path.join(outdir, n + EXPORTS[name][0]) for name in exports } for n in names ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m darter',
+        description='Parses Dart snapshot files (ELF AppAOT, or AppJIT) in parallel, and exports data from them.')
+    parser.add_argument('files', nargs='+', metavar='FILE', help='snapshot files to parse')
+    parser.add_argument('-e', '--export', action='append', choices=list(EXPORTS),
+        help='export to run on each file (can be given multiple times, default: summary)')
+    parser.add_argument('-o', '--output-dir', help='directory for the outputs (default: next to each file)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--max-memory', type=int, metavar='MB', help='limit the address space of each worker, in MiB')
+    parser.add_argument('--image', action='store_true', help='load / save parsed images (FILE.image) to speed up subsequent runs')
+    parser.add_argument('--nrefs-cache', metavar='FILE', help='cache of native reference analysis results, shared between files and runs')
+    parser.add_argument('--stats', action='store_true', help='collect parse statistics (per phase and cluster) into the report')
+    parser.add_argument('--no-strict', dest='strict', action='store_false', help='treat inconsistencies as warnings')
+    parser.add_argument('--print-level', type=int, default=1, help='parser message level (see Snapshot)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show parser output (otherwise, only kept for failures)')
+    parser.add_argument('--report', help='write a JSON report of all results to this file')
+    args = parser.parse_args(argv)
+
+    exports = list(dict.fromkeys(args.export or ['summary']))
+    if args.output_dir: os.makedirs(args.output_dir, exist_ok=True)
+    options = { 'print_level': args.print_level, 'strict': args.strict, 'verbose': args.verbose, 'image': args.image,
+        'nrefs_cache': args.nrefs_cache, 'stats': args.stats }
+    tasks = [ (f, outputs, options) for f, outputs in zip(args.files, output_paths(args.files, exports, args.output_dir)) ]
+
+    # Process files, one per worker process (so memory is released after each one)
+    results, start = [], time.time()
+    with Pool(max(1, min(args.jobs, len(tasks))), init_worker, (args.max_memory,), maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(process_file, tasks):
+            results.append(result)
+            times = ', '.join('{} {:.2f}s'.format(k, v) for k, v in result['times'].items() if k != 'total')
+            status = 'OK' if result['ok'] else 'FAILED: ' + result['error']
+            print('[{}/{}] {} ({:.2f}s{}) {}'.format(len(results), len(tasks), result['file'], result['times']['total'],
+                ': ' + times if times else '', status), flush=True)
+    elapsed = time.time() - start
+
+    # Summary
+    failed = [ r for r in results if not r['ok'] ]
+    print('\n{} files processed in {:.2f}s ({} jobs): {} OK, {} failed'.format(
+        len(results), elapsed, args.jobs, len(results) - len(failed), len(failed)))
+    phases = {}
+    for r in results:
+        if not r['ok']: continue
+        for k, v in r['times'].items(): phases.setdefault(k, []).append(v)
+    for k, v in phases.items():
+        print('  {:10} total {:8.2f}s   mean {:7.2f}s   max {:7.2f}s'.format(k, sum(v), sum(v) / len(v), max(v)))
+    if failed:
+        print('Failures:')
+        for r in failed: print('  {}: {}'.format(r['file'], r['error']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({ 'elapsed': elapsed, 'jobs': args.jobs, 'results': sorted(results, key=lambda r: r['file']) }, f, indent=2)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
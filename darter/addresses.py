@@ -0,0 +1,102 @@
+# ADDRESSES: Maps addresses back to the objects located at them
+
+from array import array
+from bisect import bisect
+from operator import itemgetter
+
+from .read import has_numpy
+if has_numpy: import numpy as np
+
+
+class AddressMap:
+    '''
+    Sorted index of non-overlapping address intervals, each one associated to an
+    object and a kind:
+
+     - 'instructions': instructions of a Code object (stubs included)
+     - 'header': header of the instructions of a Code object
+     - 'rodata': an object in rodata (string, PcDescriptors, CodeSourceMap, StackMap),
+       up to the start of the next one
+
+    The intervals are in `starts`, `ends` (exclusive), `objects` and `kinds`. The
+    starts and ends are NumPy arrays if available. `entry_points` holds the sorted
+    addresses of the entry points of Code objects.
+    '''
+
+    def __init__(self, intervals, entry_points=()):
+        intervals = sorted(intervals, key=itemgetter(0))
+        starts = [ start for start, _, _, _ in intervals ]
+        # clip intervals to the start of the next one, so that they never overlap
+        ends = [ min(end, next_start) for (_, end, _, _), next_start in zip(intervals, starts[1:] + [float('inf')]) ]
+        self.objects = [ obj for _, _, obj, _ in intervals ]
+        self.kinds = [ kind for _, _, _, kind in intervals ]
+        make_array = (lambda x: np.array(x, np.int64)) if has_numpy else (lambda x: array('q', x))
+        self.starts, self.ends = make_array(starts), make_array(ends)
+        self.entry_points = make_array(sorted(entry_points))
+
+    def __len__(self):
+        return len(self.objects)
+
+    def lookup(self, addr):
+        ''' Returns (object, offset, kind) for the interval an address falls into, or None '''
+        i, offset = self.lookup_index(addr)
+        if i >= 0: return self.objects[i], offset, self.kinds[i]
+
+    def lookup_index(self, addr):
+        ''' Returns (index, offset) of the interval an address falls into, or (-1, 0) '''
+        i = (int(np.searchsorted(self.starts, addr, 'right')) if has_numpy else bisect(self.starts, addr)) - 1
+        if i >= 0 and addr < self.ends[i]:
+            return i, addr - int(self.starts[i])
+        return -1, 0
+
+    def lookup_many(self, addresses):
+        '''
+        Looks up many addresses at once. Returns (indexes, offsets): the index of the
+        interval each address falls into (-1 if none) and the offset into it. With NumPy,
+        these are arrays and the lookup is vectorized; otherwise they're lists.
+        '''
+        if not has_numpy:
+            result = [ self.lookup_index(addr) for addr in addresses ]
+            return [ i for i, _ in result ], [ offset for _, offset in result ]
+        addresses = np.asarray(addresses, np.int64)
+        indexes = np.searchsorted(self.starts, addresses, 'right') - 1
+        found = (indexes >= 0) & (addresses < self.ends[np.maximum(indexes, 0)])
+        indexes[~found] = -1
+        offsets = np.where(found, addresses - self.starts[indexes], 0)
+        return indexes, offsets
+
+    def resolve_many(self, addresses):
+        ''' Like lookup_many, but returns a list of (object, offset, kind) or None '''
+        indexes, offsets = self.lookup_many(addresses)
+        if has_numpy: indexes, offsets = indexes.tolist(), offsets.tolist()
+        objects, kinds = self.objects, self.kinds
+        return [ (objects[i], offset, kinds[i]) if i >= 0 else None for i, offset in zip(indexes, offsets) ]
+
+    def is_entry_point_many(self, addresses):
+        ''' Returns whether each address is the entry point of a Code object '''
+        if not has_numpy:
+            entry_points = set(self.entry_points)
+            return [ addr in entry_points for addr in addresses ]
+        return np.isin(np.asarray(addresses, np.int64), self.entry_points)
+
+
+def build_address_map(s):
+    ''' Builds the AddressMap of a parsed snapshot (including the objects of its base) '''
+    intervals = []
+    header_size = 32 if s.is_64 else 16
+    for code in s.getrefs('Code'):
+        instr = code.x['instructions']
+        if not instr or 'data_addr' not in instr: continue
+        start = instr['data_addr']
+        intervals.append((start - header_size, start, code, 'header'))
+        intervals.append((start, start + len(instr['data']), code, 'instructions'))
+
+    for snapshot in ([s.base] if isinstance(getattr(s.base, 'rodata_objects', None), list) else []) + [s]:
+        rodata = getattr(snapshot, 'rodata', None)
+        if rodata is None or not snapshot.rodata_objects: continue
+        objects = sorted(snapshot.rodata_objects, key=itemgetter(0))
+        end = snapshot.rodata_offset + len(rodata.buf)
+        for (start, obj), (next_start, _) in zip(objects, objects[1:] + [(end, None)]):
+            intervals.append((start, next_start, obj, 'rodata'))
+
+    return AddressMap(intervals, s.entry_points.keys())
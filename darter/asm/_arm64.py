@@ -43,7 +43,9 @@ def match_loadobj(ops, i):
         offset = 0
         if match('movk', r'(\w+), #(\w+), lsl #16', lambda: m[0] == src, -1):
             offset = int(m[1], 0) << 16
-        if not match('movz', r'(\w+), #(\w+)', lambda: m[0] == src, -1): return
+        # (newer Capstone versions print movz, and orr with xzr, as mov)
+        if not (match('movz', r'(\w+), #(\w+)', lambda: m[0] == src, -1) or
+                match('mov', r'(\w+), #(\w+)', lambda: m[0] == src, -1)): return
         offset |= int(m[1], 0)
         return orig_i, offset, target
 
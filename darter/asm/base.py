@@ -1,12 +1,25 @@
 # ASM/BASE: Common API to disassemble compiled instructions and analyze them
 
 import time
+import heapq
+import multiprocessing
+from array import array
 
 from ..constants import kEntryType
-from . import _arm, _arm64, _ia32, _x64
+from ..core import VMObject
+from ..read import has_numpy
+if has_numpy: import numpy as np
 
+# Capstone is needed for disassembling, but not for the `vector` analysis engine
+has_capstone = False
+try:
+    from . import _arm, _arm64, _ia32, _x64
+    has_capstone = True
+except ImportError:
+    pass
 
-ARCH_MODULES = _arm, _arm64, _ia32, _x64
+
+ARCH_MODULES = (_arm, _arm64, _ia32, _x64) if has_capstone else ()
 
 def _find_arch_module(snapshot):
     '''
@@ -14,6 +27,8 @@ def _find_arch_module(snapshot):
     according to the architecture and other settings of a given snapshot.
     Raises if the architecture / settings are not supported.
     '''
+    if not has_capstone:
+        raise Exception('Capstone is not available')
     arch = snapshot.arch.split('-')[0]
     for m in ARCH_MODULES:
         if m.supports(snapshot, arch): return m
@@ -32,7 +47,7 @@ def disasm_code(md, code, lite=False, detail=False):
     It is preferable to use this function when possible (i.e. for thumb mode).
     '''
     instr = code.x['instructions']
-    data, addr = instr['data'], instr['data_addr']
+    data, addr = bytes(instr['data']), instr['data_addr'] # data may be a memoryview
     md.detail = detail
     ops = list((md.disasm_lite if lite else md.disasm)(data, addr))
     get_end = lambda x: (x[0]+x[1] if lite else x.address+x.size)
@@ -40,7 +55,84 @@ def disasm_code(md, code, lite=False, detail=False):
         raise Exception('Not all instructions were disassembled')
     return ops        
 
-def analyze_native_references(snapshot):
+def analyze_code(arch, md, code):
+    ''' Disassembles a Code object and returns the native references found in it
+        (see analyze_native_references) '''
+    ops = disasm_code(md, code, lite=True)
+    nrefs = []
+    i = 0
+    while i < len(ops):
+        res = arch.match_nref(ops, i)
+        if res:
+            ii, *nref = res
+            nrefs.append((ops[i][0], *nref))
+            assert ii > i
+            i = ii
+        else:
+            i += 1
+    return nrefs
+
+# PC-relative instructions of each arch, as (mask, value, bits that aren't the immediate)
+PC_RELATIVE = {
+    'arm64': [
+        (0x7C000000, 0x14000000, 0xFC000000), # b, bl
+        (0xFF000010, 0x54000000, 0xFF00001F), # b.cond
+        (0x7E000000, 0x34000000, 0xFF00001F), # cbz, cbnz
+        (0x7E000000, 0x36000000, 0xFFF8001F), # tbz, tbnz
+        (0x3B000000, 0x18000000, 0xFF00001F), # ldr (literal)
+        (0x1F000000, 0x10000000, 0x9F00001F), # adr, adrp
+    ],
+    'arm': [
+        (0x0E000000, 0x0A000000, 0xFF000000), # b, bl, blx
+        (0x0FFF0000, 0x028F0000, 0xFFFFF000), # adr (add <rd>, pc, #imm)
+        (0x0FFF0000, 0x024F0000, 0xFFFFF000), # adr (sub <rd>, pc, #imm)
+        (0x0E1F0000, 0x041F0000, 0xFFFFF000), # ldr, ldrb (literal)
+    ],
+}
+
+def mask_pc_relative(arch, data):
+    '''
+    Returns the instructions in `data` (as bytes) with the immediates of PC-relative
+    instructions (branches, calls, adr...) zeroed, so that the code compares equal
+    wherever it and its targets are placed. Returns None if `arch` isn't supported.
+    '''
+    patterns = PC_RELATIVE.get(arch.split('-')[0])
+    if patterns is None: return
+    data = data[:len(data) & ~3]
+    if has_numpy:
+        words = np.frombuffer(data, '<u4')
+        kept = np.full(len(words), 0xFFFFFFFF, np.uint32)
+        for mask, value, bits in patterns:
+            kept[(words & mask) == value] = bits
+        return (words & kept).astype('<u4').tobytes()
+    words = array('I', bytes(data))
+    for n, w in enumerate(words):
+        for mask, value, bits in patterns:
+            if w & mask == value:
+                words[n] = w & bits
+                break
+    return words.tobytes()
+
+def make_shards(sizes, count):
+    '''
+    Splits items (given their sizes) into at most `count` shards of similar total size,
+    assigning the biggest items first to the smallest shard. Returns lists of indexes.
+    '''
+    shards = [ (0, n, []) for n in range(min(count, len(sizes))) ]
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        total, n, items = heapq.heappop(shards)
+        items.append(i)
+        heapq.heappush(shards, (total + sizes[i], n, items))
+    return [ items for _, _, items in sorted(shards, key=lambda s: s[1]) if items ]
+
+# (arch module, engine, Code objects) being analyzed, inherited by forked workers
+_shard_state = None
+
+def _analyze_shard(indexes):
+    arch, md, codes = _shard_state
+    return [ (i, analyze_code(arch, md, codes[i])) for i in indexes ]
+
+def analyze_native_references(snapshot, jobs=None, engine=None, codes=None, cache=None):
     '''
     Analyzes all Code objects of a snapshot that have native instructions:
     the instructions are disassembled and searched for references to VM
@@ -57,33 +149,122 @@ def analyze_native_references(snapshot):
        into register named `reg` (special value `call` means that next
        entry was also loaded and called).
     - "call", address: function call to `address`
+
+    If `jobs` is greater than 1, Code objects are split into shards of similar
+    instruction size, which are analyzed by that many (forked) worker processes.
+    The result is the same, in the same order.
+
+    `engine` selects how the instructions are analyzed: 'capstone' disassembles
+    them, while 'vector' matches the instruction words directly for the whole
+    blob at once, using NumPy (see the `vector` module; much faster, and `jobs`
+    is ignored). The default is 'capstone' if available, 'vector' otherwise.
+
+    `codes` restricts the analysis to a list of Code objects. If `cache` is given
+    (a NativeRefCache, or the path to one), results of previously analyzed
+    instructions are reused from it, and new ones are stored (see `cache` module).
     '''
+    global _shard_state
+    if codes is None:
+        codes = [ code for code in snapshot.getrefs('Code') if 'instructions' in code.x ]
+    if cache is not None:
+        from .cache import NativeRefCache
+        analyze = lambda codes: analyze_native_references(snapshot, jobs, engine, codes)
+        if isinstance(cache, NativeRefCache): return cache.analyze(snapshot, codes, analyze)
+        with NativeRefCache(cache) as cache: return cache.analyze(snapshot, codes, analyze)
+    if engine is None:
+        engine = 'capstone' if has_capstone else 'vector'
+    if engine == 'vector':
+        from . import vector
+        return vector.analyze_native_references(snapshot, codes)
+    if engine != 'capstone':
+        raise ValueError('Invalid engine: {}'.format(repr(engine)))
     arch = _find_arch_module(snapshot)
     if not hasattr(arch, 'match_nref'):
         raise Exception('Native reference analysis is not yet implemented for this architecture')
     md = arch.make_engine(snapshot)
-    result = {}
-    for code in snapshot.getrefs('Code'):
-        if 'instructions' not in code.x: continue
-        ops = disasm_code(md, code, lite=True)
-        result[code] = nrefs = []
-        i = 0
-        while i < len(ops):
-            res = arch.match_nref(ops, i)
-            if res:
-                ii, *nref = res
-                nrefs.append((ops[i][0], *nref))
-                assert ii > i
-                i = ii
-            else:
-                i += 1
-    return result
+    if not (jobs and jobs > 1 and len(codes) > 1 and 'fork' in multiprocessing.get_all_start_methods()):
+        return { code: analyze_code(arch, md, code) for code in codes }
+
+    shards = make_shards([ len(code.x['instructions']['data']) for code in codes ], jobs * 4)
+    results = [None] * len(codes)
+    _shard_state = (arch, md, codes)
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for shard in pool.imap_unordered(_analyze_shard, shards):
+                for i, nrefs in shard: results[i] = nrefs
+    finally:
+        _shard_state = None
+    return dict(zip(codes, results))
+
+def code_class(code):
+    ''' Class a Code object belongs to (through its owner function), or None '''
+    owner = code.x['owner']
+    if owner.is_cid('Function'): owner = owner.x['owner']
+    if owner.is_cid('PatchClass'): owner = owner.x['patched_class']
+    return owner if owner.is_cid('Class') else None
+
+def scope_codes(snapshot, scope=None):
+    '''
+    Returns the Code objects with native instructions inside `scope`, which can be:
+    None (every Code object), a Library, Class or Function object, a list of Code
+    objects, or a function that is called with each Code object and returns True
+    if it should be included.
+    '''
+    if scope is None or callable(scope):
+        codes = [ code for code in snapshot.getrefs('Code') if 'instructions' in code.x ]
+        return codes if scope is None else [ code for code in codes if scope(code) ]
+    if isinstance(scope, VMObject):
+        if scope.is_cid('Function'):
+            test = lambda code: code.x['owner'] is scope
+        elif scope.is_cid('Class'):
+            test = lambda code: code_class(code) is scope
+        elif scope.is_cid('Library'):
+            test = lambda code: (lambda cls: cls is not None and cls.x['library'] is scope)(code_class(code))
+        else:
+            raise ValueError('Invalid scope: {}'.format(scope))
+        return scope_codes(snapshot, test)
+    return [ code for code in scope if 'instructions' in code.x ]
+
+def pool_indexes(snapshot, targets):
+    ''' Indexes of the global object pool entries holding any of `targets` (a set), found
+        through their back-references (or by scanning the pool, if they aren't tracked) '''
+    pool = snapshot.root.x['global_object_pool']
+    if snapshot.backrefs:
+        return { src[2] for obj in targets for src in obj.src if src[0] is pool and src[1] == 'entries' }
+    return { n for n, e in enumerate(pool.x['entries']) if e.get('raw_obj') in targets }
 
-def populate_native_references(snapshot):
+def target_codes(snapshot, targets, jobs=None, engine=None, cache=None, scope=None):
     '''
-    High-level method that uses analyze_native_references, then associates
-    the results to objects, and saves the results into the snapshot data,
-    storing back-references on the pointed objects too:
+    Returns the Code objects (inside `scope`, see scope_codes) whose instructions
+    reference any of `targets` (an object, or a list of them): that load them from
+    the global object pool, or call them (for Code objects, and Function objects
+    through their Code).
+
+    The pool entries holding the targets are looked up first; then the Code objects
+    that weren't analyzed yet are (see analyze_native_references, with the given `jobs`,
+    `engine` and `cache`), and only the results of those referencing the targets are
+    kept, like populate_native_references does. Passing a `cache` makes successive
+    queries cheap.
+    '''
+    targets = { targets } if isinstance(targets, VMObject) else set(targets)
+    targets |= { code for code in map(snapshot.get_code, [ t for t in targets if t.is_cid('Function') ]) if code is not None }
+    indexes = pool_indexes(snapshot, targets)
+    def calls_target(address):
+        match = snapshot.search_address(address)
+        return match is not None and match[0] in targets
+
+    codes = scope_codes(snapshot, scope)
+    results = analyze_native_references(snapshot, jobs, engine, [ code for code in codes if 'nrefs' not in code.x ], cache)
+    merge_native_references(snapshot, { code: nrefs for code, nrefs in results.items() if any(
+        (kind == 'load' and x in indexes) or (kind == 'call' and calls_target(x)) for _, kind, x, *_ in nrefs) })
+    return [ code for code in codes if any(target in targets for target, *_ in code.x.get('nrefs', ())) ]
+
+def populate_native_references(snapshot, jobs=None, engine=None, cache=None, scope=None, targets=None):
+    '''
+    High-level method that uses analyze_native_references (with the given `jobs`,
+    `engine` and `cache`), then associates the results to objects, and saves the
+    results into the snapshot data, storing back-references on the pointed
+    objects too:
 
      1. Each analyzed Code object gets an `nrefs` entry on its data
         dictionary, which is a list of `(target, address, <fields>)` items,
@@ -91,8 +272,9 @@ def populate_native_references(snapshot):
 
      2. This also creates back-references on the pointed objects; every
         snapshot object (the object itself, not the data dictionary)
-        will have an `nsrc` field containing a list of `(code, address, <fields>)`
-        items, where `code` is the Code object the native reference was found at.
+        has an `nsrc` property containing a list of `(code, address, <fields>)`
+        items, where `code` is the Code object the native reference was found at
+        (empty if there are none).
         
     `address` is the address of the instruction(s) which referenced the object,
     and the rest of the fields depend on the kind of native reference:
@@ -101,17 +283,30 @@ def populate_native_references(snapshot):
        named `reg` (special value `call` means that next entry was also loaded and
        called).
      - `"call", offset`: function call to the object, at offset `offset`.
+
+    Code objects that already have `nrefs` aren't analyzed again. If `scope` is given
+    (see scope_codes), only the Code objects inside it are analyzed. If `targets` is
+    given, only the results of the Code objects that reference these objects are kept
+    (see target_codes). Either way, `nsrc` contains the references from the code
+    analyzed so far, and successive calls merge their results. Also, the `nrefs`
+    property of a Code object analyzes it on first access.
     '''
     print('Starting analysis...')
     start = time.time()
-    results = analyze_native_references(snapshot)
+    if targets is not None:
+        target_codes(snapshot, targets, jobs, engine, cache, scope)
+        print('Done in {:.2f}s'.format(time.time() - start))
+        return
+    codes = [ code for code in scope_codes(snapshot, scope) if 'nrefs' not in code.x ]
+    results = analyze_native_references(snapshot, jobs, engine, codes, cache)
     print('Done in {:.2f}s, processing results'.format(time.time() - start))
+    merge_native_references(snapshot, results)
 
-    entries = snapshot.refs['root'].x['global_object_pool'].x['entries']
-    # initialize nsrc to an empty list on every object
-    for i in range(1, snapshot.refs['next']):
-        snapshot.refs[i].nsrc = []
-
+def merge_native_references(snapshot, results):
+    ''' Associates analyze_native_references results to objects, and adds them to
+        the `nrefs` of the Code objects and the `nsrc` of their targets '''
+    entries = snapshot.root.x['global_object_pool'].x['entries']
+    snapshot.nrefs_populated = True
     for code, nrefs in results.items():
         out_nrefs = code.x['nrefs'] = []
         for address, kind, x, *rest in nrefs:
@@ -134,4 +329,7 @@ def populate_native_references(snapshot):
             else:
                 continue
             out_nrefs.append(( target, address, kind, *rest ))
-            target.nsrc.append(( code, address, kind, *rest ))
+            try:
+                target._nsrc.append(( code, address, kind, *rest ))
+            except AttributeError:
+                target._nsrc = [( code, address, kind, *rest )]
@@ -0,0 +1,144 @@
+# ASM/CACHE: Persistent cache of native reference analysis results, shared between snapshots
+
+import json
+import time
+import sqlite3
+import hashlib
+from struct import unpack_from
+
+from .base import mask_pc_relative
+
+CACHE_VERSION = 2 # increase when the results of the analysis (or the hashes) change
+
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS entries (arch TEXT, hash BLOB, nrefs TEXT, size INTEGER, used REAL, PRIMARY KEY (arch, hash)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+'''
+
+def instructions_hash(arch, data):
+    ''' Hash of instructions, with the immediates of PC-relative instructions masked
+        (see mask_pc_relative) for the archs that support it '''
+    masked = mask_pc_relative(arch, data)
+    return hashlib.sha256(data if masked is None else masked).digest()
+
+def call_target(arch, data, offset, address, mask):
+    ''' Target of the `bl` instruction at `offset` into `data`, which is at `address` '''
+    w = unpack_from('<L', data, offset)[0]
+    if arch.split('-')[0] == 'arm64':
+        imm, bits = w & 0x3ffffff, 26
+    else:
+        imm, bits, address = w & 0xffffff, 24, address + 8
+    imm -= (imm >> (bits - 1)) << bits
+    return (address + 4 * imm) & mask
+
+def make_relative(nrefs, start):
+    ''' Makes the addresses of analysis results relative to `start`, and drops the
+        call targets (they're computed again from the instructions, see make_absolute) '''
+    return [ (address - start, kind, None if kind == 'call' else x, *rest)
+        for address, kind, x, *rest in nrefs ]
+
+def make_absolute(nrefs, arch, instr, mask):
+    ''' Inverse of make_relative, for the Code object with instructions `instr` '''
+    start, data = instr['data_addr'], instr['data']
+    return [ (start + address, kind, call_target(arch, data, address, start + address, mask) if kind == 'call' else x,
+        *rest) for address, kind, x, *rest in nrefs ]
+
+class NativeRefCache:
+    '''
+    On-disk cache (an SQLite database at `path`) of analyze_native_references results,
+    keyed by architecture and the hash of the instructions of each Code object, so that
+    code shared between snapshots (successive builds of an app, the framework...) is
+    only analyzed once. The immediates of PC-relative instructions are masked for the
+    hash, since they change whenever the code or its callees move; so call targets
+    aren't stored, but decoded again from the instructions, and the other addresses
+    are stored relative to the code.
+
+    When the stored results exceed `max_size` bytes, the least recently used ones are
+    evicted. New results are committed every `chunk_size` analyzed objects, so an
+    interrupted analysis resumes from where it was left.
+    '''
+
+    def __init__(self, path, max_size=512 << 20, chunk_size=2000):
+        self.path, self.max_size, self.chunk_size = path, max_size, chunk_size
+        self.hits = self.misses = 0
+        self.con = sqlite3.connect(path, timeout=60)
+        self.con.executescript(CACHE_SCHEMA)
+        version = self.con.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or version[0] != CACHE_VERSION:
+            with self.con:
+                self.con.execute('DELETE FROM entries')
+                self.con.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (CACHE_VERSION,))
+        with self.con:
+            self.evict()
+
+    def close(self):
+        self.con.close()
+    __enter__ = lambda self: self
+    __exit__ = lambda self, *args: self.close()
+
+    def get(self, arch, hashes):
+        ''' Returns a dictionary with the stored (relative) results of the given hashes,
+            and marks them as used '''
+        result, now = {}, time.time()
+        for n in range(0, len(hashes), 500):
+            batch = hashes[n:n + 500]
+            rows = self.con.execute('SELECT hash, nrefs FROM entries WHERE arch = ? AND hash IN ({})'.format(
+                ', '.join('?' * len(batch))), (arch, *batch))
+            for h, nrefs in rows:
+                result[h] = [ tuple(x) for x in json.loads(nrefs) ]
+        with self.con:
+            self.con.executemany('UPDATE entries SET used = ? WHERE arch = ? AND hash = ?', [ (now, arch, h) for h in result ])
+        return result
+
+    def put(self, arch, items):
+        ''' Stores (hash, relative results) items, evicting old entries if needed '''
+        now, rows = time.time(), []
+        for h, nrefs in items:
+            value = json.dumps(nrefs, separators=(',', ':'))
+            rows.append((arch, h, value, len(h) + len(value), now))
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            self.evict()
+
+    def size(self):
+        return self.con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        ''' Removes the least recently used entries until the size is within `max_size` '''
+        total = self.size()
+        if total <= self.max_size: return
+        victims = []
+        for arch, h, size in self.con.execute('SELECT arch, hash, size FROM entries ORDER BY used'):
+            if total <= self.max_size: break
+            victims.append((arch, h))
+            total -= size
+        self.con.executemany('DELETE FROM entries WHERE arch = ? AND hash = ?', victims)
+
+    def analyze(self, snapshot, codes, analyze):
+        '''
+        Returns the analyze_native_references results for a list of Code objects. The
+        ones that aren't in the cache are passed to `analyze` (in chunks), which should
+        return their results, and these are stored.
+        '''
+        arch, mask = snapshot.arch, (1 << (64 if snapshot.is_64 else 32)) - 1
+        instrs = [ code.x['instructions'] for code in codes ]
+        hashes = [ instructions_hash(arch, instr['data']) for instr in instrs ]
+        cached = self.get(arch, list(set(hashes)))
+        missing, seen = [], set(cached) # (analyze each distinct instructions once)
+        for n, h in enumerate(hashes):
+            if h not in seen:
+                seen.add(h)
+                missing.append(n)
+        self.hits += len(codes) - len(missing)
+        self.misses += len(missing)
+
+        for n in range(0, len(missing), self.chunk_size):
+            chunk = [ codes[i] for i in missing[n:n + self.chunk_size] ]
+            results = analyze(chunk)
+            items = []
+            for i in missing[n:n + self.chunk_size]:
+                cached[hashes[i]] = make_relative(results[codes[i]], instrs[i]['data_addr'])
+                items.append((hashes[i], cached[hashes[i]]))
+            self.put(arch, items)
+        return { code: make_absolute(cached[h], arch, instr, mask) for code, instr, h in zip(codes, instrs, hashes) }
@@ -0,0 +1,263 @@
+# ASM/VECTOR: Capstone-free analysis of native references for ARM and ARM64.
+# Instead of disassembling each Code object, the instructions blob is viewed as an
+# array of words, and the patterns matched by `_arm` / `_arm64` are looked for in
+# their bitfields, for all the code at once.
+
+import numpy as np
+
+INT64_LIMIT = 1 << 63
+
+
+# COMMON #
+
+def shift(seg, pos, k):
+    ''' Returns pos + k (clamped), and whether it's inside the same Code object as pos '''
+    q = np.clip(pos + k, 0, len(seg) - 1)
+    return q, (pos + k == q) & (seg[q] == seg[pos])
+
+def follow_adds(seg, is_add, rd, rn, add_value, pos, src):
+    '''
+    Follows chains of `add <rd>, <src>, #imm` instructions starting at `pos`: returns
+    the position after them, the register holding the result, the accumulated offset,
+    and whether the position is still inside the Code object.
+    '''
+    cur, src = pos, np.full(len(pos), src, rd.dtype)
+    offset = np.zeros(len(pos), np.int64)
+    ok = np.ones(len(pos), bool)
+    active = is_add[cur] & (rn[cur] == src)
+    while active.any():
+        offset += np.where(active, add_value[cur], 0)
+        src = np.where(active, rd[cur], src)
+        nxt, inside = shift(seg, cur, 1)
+        ok &= ~active | inside
+        cur = np.where(active, nxt, cur)
+        active &= inside & is_add[cur] & (rn[cur] == src)
+    return cur, src, offset, ok
+
+def sign_extend(x, bits):
+    x = x.astype(np.int64)
+    return (x ^ (1 << (bits - 1))) - (1 << (bits - 1))
+
+
+# ARM64 #
+
+# ldr <reg>, [<xn|sp>{, #imm}] (unsigned offset): (opcode, log2 of the scale, register prefix)
+ARM64_LDR = [ (0xF9400000, 3, 'x'), (0xB9400000, 2, 'w'), (0x3D400000, 0, 'b'),
+    (0x7D400000, 1, 'h'), (0xBD400000, 2, 's'), (0xFD400000, 3, 'd'), (0x3DC00000, 4, 'q') ]
+ARM64_LDR_NAMES = [ [ p + str(n) for n in range(31) ] + [ p + 'zr' if p in 'xw' else p + '31' ] for _, _, p in ARM64_LDR ]
+ARM64_BLR_X30 = 0xD63F03C0
+
+def make_bitmask_table():
+    ''' Values of the (N, immr, imms) logical immediates of 64-bit instructions, and validity '''
+    values, valid = np.zeros(1 << 13, np.uint64), np.zeros(1 << 13, bool)
+    for enc in range(1 << 13):
+        n, immr, imms = enc >> 12, (enc >> 6) & 63, enc & 63
+        length = ((n << 6) | (~imms & 63)).bit_length() - 1
+        if length < 1: continue
+        levels = (1 << length) - 1
+        if imms & levels == levels: continue
+        esize, s, r = 1 << length, imms & levels, immr & levels
+        elem = (1 << (s + 1)) - 1
+        elem = ((elem >> r) | (elem << (esize - r))) & ((1 << esize) - 1)
+        values[enc] = sum(elem << i for i in range(0, 64, esize))
+        valid[enc] = True
+    return values, valid
+
+ARM64_BITMASKS = None
+
+def arm64_mov_immediates(w):
+    '''
+    Values of `mov <xd>, #imm` instructions (MOVZ, and ORR with XZR) that have a
+    positive immediate, and whether each word is one. (ORR writing to register 31
+    is `mov sp, #imm`, so it's excluded.)
+    '''
+    global ARM64_BITMASKS
+    if ARM64_BITMASKS is None: ARM64_BITMASKS = make_bitmask_table()
+    hw, imm16 = (w >> 21) & 3, ((w >> 5) & 0xffff).astype(np.uint64)
+    movz = ((w & 0xFF800000) == 0xD2800000) & ((imm16 != 0) | (hw == 0))
+    value = np.where(movz, imm16 << (hw.astype(np.uint64) << np.uint64(4)), np.uint64(0))
+    masks, valid = ARM64_BITMASKS
+    enc = (w >> 10) & 0x1fff
+    orr = ((w & 0xFF8003E0) == 0xB20003E0) & valid[enc] & ((w & 31) != 31)
+    value = np.where(orr, masks[enc], value)
+    is_mov = (movz | orr) & (value < np.uint64(INT64_LIMIT))
+    return is_mov, value.astype(np.int64)
+
+def match_arm64(w, seg, base):
+    rd, rn, rm = w & 31, (w >> 5) & 31, (w >> 16) & 31
+    imm12 = (w >> 10) & 0xfff
+    sh = (w >> 22) & 1
+    address = base + 4 * np.arange(len(w), dtype=np.int64)
+
+    # add <xd|sp>, <xn|sp>, #imm{, lsl #12} (it's printed as mov if imm is 0 and sp is involved)
+    is_add = ((w & 0xFF800000) == 0x91000000) & ~((sh == 0) & (imm12 == 0) & ((rd == 31) | (rn == 31)))
+    add_value = imm12.astype(np.int64) << (12 * sh).astype(np.int64)
+    ldr_kind = np.full(len(w), -1, np.int8)
+    for k, (opcode, _, _) in enumerate(ARM64_LDR):
+        ldr_kind[(w & 0xFFC00000) == opcode] = k
+    ldr_value = imm12.astype(np.int64) << np.array([ s for _, s, _ in ARM64_LDR ] + [0])[ldr_kind]
+    # ldp x5, x30, [<xn|sp>{, #imm}] (signed offset, positive)
+    is_ldp = (w & 0xFFE07C1F) == (0xA9400000 | (30 << 10) | 5)
+    ldp_value = ((w >> 15) & 0x7f).astype(np.int64) << 3
+    is_ldr = ldr_kind >= 0
+    starts, ends, offsets, regs = [], [], [], []
+
+    # Loads through x27, with immediate offsets: add* + (ldr | ldp + blr x30)
+    pos = np.flatnonzero((rn == 27) & (is_add | is_ldr | is_ldp) & (seg >= 0))
+    cur, src, offset, ok = follow_adds(seg, is_add, rd, rn, add_value, pos, 27)
+    ok &= rn[cur] == src
+    hit = ok & is_ldr[cur]
+    starts.append(pos[hit]); ends.append(cur[hit] + 1); offsets.append(offset[hit] + ldr_value[cur[hit]])
+    regs += [ ARM64_LDR_NAMES[k][r] for k, r in zip(ldr_kind[cur[hit]].tolist(), rd[cur[hit]].tolist()) ]
+    nxt, inside = shift(seg, cur, 1)
+    hit = ok & is_ldp[cur] & inside & (w[nxt] == ARM64_BLR_X30)
+    starts.append(pos[hit]); ends.append(cur[hit] + 2); offsets.append(offset[hit] + ldp_value[cur[hit]])
+    regs += [ 'call' ] * int(hit.sum())
+
+    # Loads through x27 with a register offset: mov (+ movk) + add <xd>, x27, <xd> + ldr <reg>, [<xd>]
+    pos = np.flatnonzero(((w & 0xFFE0FC00) == 0x8B000000) & (rn == 27) & (rd == rm) & (seg >= 0))
+    src = rd[pos] # (register 31 is xzr here, but sp in the ldr)
+    nxt, ok = shift(seg, pos, 1)
+    ok &= is_ldr[nxt] & (imm12[nxt] == 0) & (rn[nxt] == src) & (src != 31)
+    prev, inside = shift(seg, pos, -1)
+    ok &= inside
+    is_mov, mov_value = arm64_mov_immediates(w)
+    movk = ok & ((w[prev] & 0xFFE00000) == 0xF2A00000) & (rd[prev] == src)
+    high = np.where(movk, ((w[prev] >> 5) & 0xffff).astype(np.int64) << 16, 0)
+    prev2, inside = shift(seg, pos, -2)
+    prev, ok = np.where(movk, prev2, prev), ok & (~movk | inside)
+    hit = ok & is_mov[prev] & (rd[prev] == src)
+    starts.append(pos[hit]); ends.append(pos[hit] + 2); offsets.append(high[hit] | mov_value[prev[hit]])
+    regs += [ ARM64_LDR_NAMES[k][r] for k, r in zip(ldr_kind[nxt[hit]].tolist(), rd[nxt[hit]].tolist()) ]
+
+    # Calls: bl #imm
+    pos = np.flatnonzero(((w & 0xFC000000) == 0x94000000) & (seg >= 0))
+    calls = address[pos] + 4 * sign_extend(w[pos] & 0x3ffffff, 26)
+    return starts, ends, offsets, regs, pos, calls
+
+def arm64_pool_index(offset):
+    div, mod = divmod(offset, 8)
+    assert mod == 0
+    return div - 2
+
+
+# ARM #
+
+ARM_REGS = [ 'r{}'.format(n) for n in range(9) ] + [ 'sb', 'sl', 'fp', 'ip', 'sp', 'lr', 'pc' ]
+
+def make_modified_immediate_table():
+    '''
+    Values of the 12-bit modified immediates, and whether each encoding is the canonical
+    one for its value (otherwise, the disassembler prints it as `#bits, #rot`).
+    '''
+    rotr = lambda x, n: ((x >> n) | (x << (32 - n))) & 0xffffffff if n else x
+    ctz = lambda x: (x & -x).bit_length() - 1
+    def encode(value): # same as LLVM's ARM_AM::getSOImmVal
+        if value & ~255 == 0: return value
+        rot = ctz(value) & ~1
+        if rotr(value, rot) & ~255 and value & 63:
+            rot2 = ctz(value & ~63) & ~1
+            if rotr(value, rot2) & ~255 == 0: rot = rot2
+        rot = (32 - rot) & 31
+        if rotr(~255 & 0xffffffff, rot) & value: return -1
+        return rotr(value, (32 - rot) & 31) | ((rot >> 1) << 8)
+    values = [ rotr(enc & 255, (enc >> 8) * 2) for enc in range(1 << 12) ]
+    return np.array(values, np.int64), np.array([ encode(v) == enc for enc, v in enumerate(values) ])
+
+ARM_IMMEDIATES = None
+
+def match_arm(w, seg, base):
+    global ARM_IMMEDIATES
+    if ARM_IMMEDIATES is None: ARM_IMMEDIATES = make_modified_immediate_table()
+    rd, rn = (w >> 12) & 15, (w >> 16) & 15
+    address = base + 4 * np.arange(len(w), dtype=np.int64)
+
+    # add <rd>, <rn>, #imm
+    values, canonical = ARM_IMMEDIATES
+    is_add = ((w & 0xFFF00000) == 0xE2800000) & canonical[w & 0xfff]
+    add_value = values[w & 0xfff]
+    # ldr <rd>, [<rn>{, #imm}]
+    is_ldr = (w & 0xFFF00000) == 0xE5900000
+    ldr_value = (w & 0xfff).astype(np.int64)
+
+    # Loads through r5: add* + ldr
+    pos = np.flatnonzero((rn == 5) & (is_add | is_ldr) & (seg >= 0))
+    cur, src, offset, ok = follow_adds(seg, is_add, rd, rn, add_value, pos, 5)
+    hit = ok & is_ldr[cur] & (rn[cur] == src)
+    regs = [ ARM_REGS[r] for r in rd[cur[hit]].tolist() ]
+
+    # Calls: bl #imm
+    calls = np.flatnonzero(((w & 0xFF000000) == 0xEB000000) & (seg >= 0))
+    targets = address[calls] + 8 + 4 * sign_extend(w[calls] & 0xffffff, 24)
+    return [ pos[hit] ], [ cur[hit] + 1 ], [ offset[hit] + ldr_value[cur[hit]] ], regs, calls, targets
+
+def arm_pool_index(offset):
+    div, mod = divmod(offset + 1, 4)
+    assert mod == 0
+    return div - 2
+
+
+# ANALYSIS #
+
+# arch: (matcher, pool index of a load offset, mask of call addresses)
+MATCHERS = { 'arm': (match_arm, arm_pool_index, (1 << 32) - 1), 'arm64': (match_arm64, arm64_pool_index, (1 << 64) - 1) }
+
+supports = lambda snapshot: snapshot.arch.split('-')[0] in MATCHERS
+
+def analyze_native_references(snapshot, codes=None):
+    '''
+    Capstone-free version of `base.analyze_native_references`, with the same results.
+    Only ARM and ARM64 are supported. Unlike the Capstone version, words that aren't
+    valid instructions are simply skipped (instead of raising). `codes` restricts the
+    analysis to a list of Code objects.
+    '''
+    arch = snapshot.arch.split('-')[0]
+    if arch not in MATCHERS:
+        raise Exception('Native reference analysis is not yet implemented for this architecture')
+    match, pool_index, address_mask = MATCHERS[arch]
+    if codes is None:
+        codes = [ code for code in snapshot.getrefs('Code') if 'instructions' in code.x ]
+    result = { code: [] for code in codes }
+
+    # Code objects of the base (VM stubs...) are in the instructions blob of the base snapshot
+    blobs = {}
+    for code in codes:
+        s = snapshot.base if code.is_base() and snapshot.base is not None else snapshot
+        if s.instructions is not None: blobs.setdefault(s, []).append(code)
+    for s, blob_codes in blobs.items():
+        match_blob(match, pool_index, address_mask, s.instructions.buf, s.instructions_offset, blob_codes, result)
+    return result
+
+def match_blob(match, pool_index, address_mask, buf, base, codes, result):
+    ''' Matches the Code objects of an instructions blob (at address `base`), appends
+        their native references to their lists in `result` '''
+    # Index of the Code object each word belongs to (-1 if none)
+    w = np.frombuffer(buf, '<u4', len(buf) // 4)
+    seg = np.full(len(w), -1, np.int32)
+    for n, code in enumerate(codes):
+        instr = code.x['instructions']
+        start = (instr['data_addr'] - base) // 4
+        end = start + len(instr['data']) // 4
+        if not 0 <= start <= end <= len(w):
+            raise Exception('Instructions of {} are outside their blob'.format(code))
+        seg[start:end] = n
+
+    starts, ends, offsets, regs, calls, targets = match(w, seg, base)
+    # Merge loads and calls by position, then skip matches that overlap a previous
+    # one (like the sequential matcher does)
+    starts = np.concatenate(starts + [calls])
+    ends = np.concatenate(ends + [calls + 1])
+    values = np.concatenate(offsets + [targets]).tolist()
+    kinds = [ 'load' ] * len(regs) + [ 'call' ] * len(calls)
+    order = np.argsort(starts, kind='stable').tolist()
+    starts, ends, segs = starts.tolist(), ends.tolist(), seg[starts].tolist()
+    lists = [ result[code] for code in codes ]
+    end = -1
+    for i in order:
+        if starts[i] < end: continue
+        end = ends[i]
+        address = base + 4 * starts[i]
+        if kinds[i] == 'load':
+            lists[segs[i]].append((address, 'load', pool_index(values[i]), regs[i]))
+        else:
+            lists[segs[i]].append((address, 'call', values[i] & address_mask))
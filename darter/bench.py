@@ -0,0 +1,219 @@
+# BENCH: Offline benchmarks of parsing and analysis, with comparison against a baseline
+# Usage: python -m darter.bench [options]   (see --help)
+
+import gc
+import io
+import json
+import time
+import random
+import fnmatch
+import platform
+import tracemalloc
+
+from .read import Reader
+from .write import writeuint
+from .synth import generate, SIZES, VM_OFFSETS, ISOLATE_OFFSETS
+from .core import Snapshot
+
+
+# FIXTURES #
+
+def make_snapshot(blobs, **kwargs):
+    ''' Returns an unparsed isolate Snapshot for the blobs of a synthetic snapshot, with a
+        parsed base (bases can't be shared, since parsing poisons them) '''
+    base = Snapshot(data=blobs[0], instructions=blobs[1], vm=True, print_level=0,
+        data_offset=VM_OFFSETS[0], instructions_offset=VM_OFFSETS[1]).parse()
+    return Snapshot(data=blobs[2], instructions=blobs[3], base=base, print_level=0,
+        data_offset=ISOLATE_OFFSETS[0], instructions_offset=ISOLATE_OFFSETS[1], **kwargs)
+
+def file_snapshot(fname, **kwargs):
+    ''' Returns a function that parses a snapshot file (ELF AppAOT or AppJIT) '''
+    from .file import parse_elf_snapshot, parse_appjit_snapshot
+    with open(fname, 'rb') as f:
+        is_elf = f.read(4) == b'\x7fELF'
+    parse = parse_elf_snapshot if is_elf else parse_appjit_snapshot
+    return lambda: parse(fname, print_level=0, **kwargs)
+
+
+# MEASURING #
+
+def measure(fn, setup=None, repeat=3, memory=False):
+    '''
+    Runs `fn` (with the result of `setup()` as argument, if passed; setup isn't timed)
+    `repeat` times, returns a dictionary with the minimum and mean wall `time`. If
+    `memory` is True, it's run once more with tracemalloc to get `memory_peak`.
+    '''
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        times.append(time.perf_counter() - start)
+        del arg
+    result = { 'time': min(times), 'mean': sum(times) / len(times) }
+    if memory:
+        arg = setup() if setup else None
+        gc.collect()
+        tracemalloc.start()
+        fn(arg) if setup else fn()
+        result['memory_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+# BENCHMARKS #
+# Each one is a function (options) -> iterator of (name, kwargs for measure()), which
+# are measured as they're yielded
+
+def bench_read(options):
+    rng = random.Random(0)
+    f = io.BytesIO()
+    values = [ rng.getrandbits(rng.choice([6, 13, 20, 40])) for _ in range(options['read_count']) ]
+    for v in values: writeuint(f, v)
+    buf = f.getvalue()
+    def readuint():
+        r = Reader(buf)
+        for _ in range(len(values)): r.readuint()
+    yield 'read.readuint', { 'fn': readuint }
+    yield 'read.readuints', { 'fn': lambda: Reader(buf).readuints(len(values)) }
+
+    # readref / readrefs over the objects of a small snapshot
+    s = make_snapshot(generate(seed=0), backrefs=False).parse()
+    refs = [ rng.randrange(1, len(s.objects)) for _ in range(options['read_count']) ]
+    f = io.BytesIO()
+    for r in refs: writeuint(f, r)
+    buf, source = f.getvalue(), (s.root, 'bench')
+    def readref():
+        r = Reader(buf)
+        for _ in range(len(refs)): s.readref(r, source)
+    yield 'read.readref', { 'fn': readref }
+    yield 'read.readrefs', { 'fn': lambda: s.readrefs(Reader(buf), len(refs), source) }
+
+def bench_parse(options):
+    for size in options['sizes']:
+        blobs = options['fixtures'](size)
+        yield 'parse.' + size, { 'fn': lambda s: s.parse(), 'setup': lambda: make_snapshot(blobs) }
+        yield 'parse.{}.csr'.format(size), { 'fn': lambda s: s.parse(),
+            'setup': lambda: make_snapshot(blobs, backrefs='csr') }
+    for fname in options['files']:
+        yield 'parse.file.' + fname, { 'fn': file_snapshot(fname) }
+
+def bench_tables(options):
+    size = options['sizes'][-1]
+    # (re-linking adds back-references again, so they're disabled)
+    s = make_snapshot(options['fixtures'](size), backrefs=False).parse()
+    yield 'link_cids.' + size, { 'fn': s.link_cids }
+    yield 'build_tables.' + size, { 'fn': s.build_tables }
+
+    rng = random.Random(0)
+    start, end = s.code_addrs[0], s.code_addrs[-1] + len(s.code_objs[-1].x['instructions']['data'])
+    addresses = [ rng.randrange(start, end) for _ in range(options['lookup_count']) ]
+    yield 'search_address.' + size, { 'fn': lambda: [ s.search_address(a) for a in addresses ] }
+    address_map = s.address_map
+    yield 'address_map.lookup_many.' + size, { 'fn': lambda: address_map.lookup_many(addresses) }
+
+def bench_analysis(options):
+    from .asm.base import analyze_native_references, has_capstone
+    size = options['sizes'][-1]
+    engines = ([ 'capstone' ] if has_capstone else []) + [ 'vector' ]
+    for arch in [ 'arm', 'arm64' ]:
+        s = make_snapshot(options['fixtures'](size, arch)).parse()
+        if has_capstone:
+            # (regression check: both engines must agree, VM stubs included)
+            if analyze_native_references(s, engine='vector') != analyze_native_references(s, engine='capstone'):
+                raise Exception('Analysis engines disagree on {} {} snapshot'.format(size, arch))
+        for engine in engines:
+            yield 'analyze.{}.{}.{}'.format(arch, engine, size), \
+                { 'fn': lambda: analyze_native_references(s, engine=engine) }
+
+BENCHMARKS = { 'read': bench_read, 'parse': bench_parse, 'tables': bench_tables, 'analysis': bench_analysis }
+
+
+def run(groups=None, sizes=('small', 'medium'), files=(), repeat=3, memory=True, select=None, log=print):
+    '''
+    Runs the benchmarks of the given groups (default: all of BENCHMARKS) on synthetic
+    snapshots of the given sizes (see darter.synth.SIZES) and on snapshot `files`,
+    returns a dictionary with the results of each benchmark, by name. `select` is an
+    optional list of glob patterns that benchmark names must match.
+    '''
+    cache = {}
+    def fixtures(size, arch='arm64'):
+        if (size, arch) not in cache:
+            log('  (generating {} {} snapshot)'.format(size, arch))
+            cache[size, arch] = generate(arch=arch, **SIZES[size])
+        return cache[size, arch]
+    options = { 'sizes': list(sizes), 'files': list(files), 'fixtures': fixtures,
+        'read_count': 200000, 'lookup_count': 100000 }
+
+    results = {}
+    for group in groups or BENCHMARKS:
+        for name, kwargs in BENCHMARKS[group](options):
+            if select and not any(fnmatch.fnmatch(name, p) for p in select): continue
+            results[name] = measure(repeat=repeat, memory=memory, **kwargs)
+            log('{:45} {:9.4f}s'.format(name, results[name]['time']) + ('   peak {:8.1f} MiB'.format(
+                results[name]['memory_peak'] / 2**20) if 'memory_peak' in results[name] else ''))
+    return results
+
+MIN_CHANGE = { 'time': 0.002, 'memory_peak': 256 << 10 }
+
+def compare(results, baseline, threshold=0.2, memory_threshold=0.2, thresholds={}):
+    '''
+    Compares results against baseline results, returns a list of (name, metric, baseline,
+    current, ratio, regressed) for the benchmarks in both. A benchmark regresses when a
+    metric grows more than its threshold (i.e. 0.2 = 20%), and more than a small absolute
+    amount (MIN_CHANGE), so that noise in tiny benchmarks isn't reported. `thresholds`
+    overrides the threshold for benchmarks matching glob patterns.
+    '''
+    report = []
+    for name in sorted(set(results) & set(baseline)):
+        limit = next((v for p, v in thresholds.items() if fnmatch.fnmatch(name, p)), None)
+        for metric, default in [ ('time', threshold), ('memory_peak', memory_threshold) ]:
+            if metric not in results[name] or metric not in baseline[name]: continue
+            old, new = baseline[name][metric], results[name][metric]
+            ratio = new / old if old else float('inf') if new else 1.0
+            regressed = ratio > 1 + (default if limit is None else limit) and new - old > MIN_CHANGE[metric]
+            report.append((name, metric, old, new, ratio, regressed))
+    return report
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m darter.bench',
+        description='Benchmarks darter on synthetic snapshots (and optionally, snapshot files), fully offline.')
+    parser.add_argument('-g', '--group', action='append', choices=list(BENCHMARKS), help='benchmark group to run (default: all)')
+    parser.add_argument('-k', '--select', action='append', metavar='PATTERN', help='only run benchmarks matching this glob')
+    parser.add_argument('--size', action='append', choices=list(SIZES), help='synthetic snapshot sizes (default: small, medium)')
+    parser.add_argument('--file', action='append', default=[], help='also benchmark parsing of this snapshot file')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of each benchmark (the minimum time is kept)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="don't measure peak memory")
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2, help='allowed time increase (default: 0.2 = 20%%)')
+    parser.add_argument('--memory-threshold', type=float, default=0.2, help='allowed peak memory increase')
+    parser.add_argument('--threshold-for', action='append', default=[], metavar='PATTERN=VALUE',
+        help='threshold for the benchmarks matching a glob (can be given multiple times)')
+    args = parser.parse_args(argv)
+
+    results = run(args.group, args.size or ('small', 'medium'), args.file, args.repeat, args.memory, args.select)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'python': platform.python_version(), 'platform': platform.platform(),
+                'time': time.time(), 'results': results }, f, indent=2)
+    if not args.baseline: return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    thresholds = { p: float(v) for p, v in (x.rsplit('=', 1) for x in args.threshold_for) }
+    report = compare(results, baseline, args.threshold, args.memory_threshold, thresholds)
+    print('\nComparison against {}:'.format(args.baseline))
+    for name, metric, old, new, ratio, regressed in report:
+        print('  {:45} {:12} {:>12.4g} -> {:>12.4g}  {:+7.1%}{}'.format(name, metric, old, new, ratio - 1,
+            '  REGRESSION' if regressed else ''))
+    regressions = [ r for r in report if r[-1] ]
+    print('{} regressions'.format(len(regressions)))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
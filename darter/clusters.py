@@ -1,17 +1,70 @@
 # CLUSTERS: Stores the deserialization logic for every kind of cluster (used by CORE)
 
-from struct import unpack
 import re
+from sys import intern
+from functools import partial
 
-from .read import *
+from .read import Reader
 from .constants import *
 from .other import parse_code_source_map
 
+
+class LazyData(dict):
+    '''
+    Data dictionary of an object whose fields are parsed on first access.
+    `load` is called (once) to parse them, and must return a dictionary;
+    `fields` names the fields it will provide, so that membership tests
+    don't trigger the load. Operations that need the whole dictionary
+    (iteration, printing, comparison...) load it too.
+    '''
+    __slots__ = ('load', 'fields')
+
+    def __init__(self, load, fields, **x):
+        super().__init__(**x)
+        self.load = load
+        self.fields = fields
+    def materialize(self):
+        ''' Loads the deferred fields now (if not loaded yet), returns self '''
+        if self.load is not None:
+            load, self.load = self.load, None
+            for k, v in load().items(): self.setdefault(k, v)
+        return self
+    is_loaded = lambda self: self.load is None
+
+    def __missing__(self, key):
+        if self.load is None or key not in self.fields: raise KeyError(key)
+        return self.materialize()[key]
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (self.load is not None and key in self.fields)
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    def setdefault(self, key, default=None):
+        if key in self: return self[key]
+        return dict.setdefault(self, key, default)
+    def pop(self, key, *args):
+        if key in self: self[key]
+        return dict.pop(self, key, *args)
+
+    __iter__ = lambda self: dict.__iter__(self.materialize())
+    __len__ = lambda self: dict.__len__(self.materialize())
+    __repr__ = lambda self: dict.__repr__(self.materialize())
+    __eq__ = lambda self, other: dict.__eq__(self.materialize(), \
+        other.materialize() if isinstance(other, LazyData) else other)
+    __ne__ = lambda self, other: not self == other
+    __reduce__ = lambda self: (dict, (dict(self.items()),))
+    keys = lambda self: dict.keys(self.materialize())
+    values = lambda self: dict.values(self.materialize())
+    items = lambda self: dict.items(self.materialize())
+    copy = lambda self: dict(self.items())
+
 def make_cluster_handlers(s):
     # Unpack any properties from Snapshot here, to make the dependencies clear
 
     parse_rodata = s.parse_rodata
     parse_csm = s.parse_csm
+    lazy_rodata = s.parse_rodata == 'lazy'
+    parallel_rodata = s.parse_rodata is True and (s.rodata_jobs or 0) > 1
+    pending_rodata = s.pending_rodata
     rodata = s.rodata
     rodata_offset = s.rodata_offset
 
@@ -28,6 +81,7 @@ def make_cluster_handlers(s):
 
     allocref = s.allocref
     readref = s.readref
+    readrefs = s.readrefs
     storeref = s.storeref
 
     warning = s.warning
@@ -41,25 +95,36 @@ def make_cluster_handlers(s):
     
     class SimpleHandler(Handler):
         def alloc(self, f, cluster):
-            for _ in range(readuint(f)): allocref(cluster, {})
+            for _ in range(f.readuint()): allocref(cluster, {})
     
     class LengthHandler(Handler):
         def alloc(self, f, cluster):
-            for _ in range(readuint(f)): allocref(cluster, { 'length': readuint(f) })
+            for _ in range(f.readuint()): allocref(cluster, { 'length': f.readuint() })
     
     class RODataHandler(Handler):
         do_read_from = False
+        lazy_fields = None  # if set, objects are returned as LazyData providing these fields
         def alloc(self, f, cluster):
-            for _ in range(readuint(f)):
-                allocref(cluster, { 'offset': readuint(f), 'shared': True }) # FIXME implement
+            cluster['alloc_offset'] = f.tell() # (see Snapshot.rodata_objects)
+            for _ in range(f.readuint()):
+                allocref(cluster, { 'offset': f.readuint(), 'shared': True }) # FIXME implement
             running_offset = 0
-            for _ in range(readuint(f)):
-                running_offset += readuint(f) << kObjectAlignmentLog2
-                allocref(cluster, self.try_parse_object(running_offset))
+            placeholder = cluster.get('placeholder', False) # not decoded (see Snapshot.materialize)
+            for _ in range(f.readuint()):
+                running_offset += f.readuint() << kObjectAlignmentLog2
+                allocref(cluster, {} if placeholder else self.try_parse_object(running_offset))
         def try_parse_object(self, offset):
             if not parse_rodata: return { 'offset': rodata_offset + offset }
-            rodata.seek(offset)
-            return self.parse_object(rodata)
+            if parallel_rodata:
+                # decoded afterwards by worker processes (see Snapshot.decode_rodata)
+                x = {}
+                pending_rodata.append((type(self).__name__, offset, x))
+                return x
+            if self.lazy_fields:
+                return LazyData(partial(self.parse_object_at, offset), self.lazy_fields)
+            return self.parse_object_at(offset)
+        def parse_object_at(self, offset):
+            return self.parse_object(Reader(rodata.buf, offset))
         def fill(self, f, x, ref): pass
 
     # Handlers
@@ -81,30 +146,29 @@ def make_cluster_handlers(s):
             def __init__(self, cid):
                 m = re.fullmatch('(External)?TypedData(.+)Array', kClassId[cid])
                 self.external = bool(m.group(1))
-                element_size, parse_char = self.type_associations[m.group(2)]
-                elem = lambda f: unpack('<' + parse_char, f.read(element_size))[0]
-                self.parse_func = lambda f, count: [ elem(f) for _ in range(count) ]
+                _, parse_char = self.type_associations[m.group(2)]
+                self.parse_func = lambda f, count: list(f.unpack('<{}{}'.format(count, parse_char)))
                 # Optimization: if Uint8 array, we can just read bytes
                 if parse_char == 'B': self.parse_func = lambda f, count: f.read(count)
             def alloc(self, f, cluster):
                 return (SimpleHandler if self.external else LengthHandler).alloc(self, f, cluster)
             def fill(self, f, x, ref):
-                count = readuint(f)
+                count = f.readuint()
                 if self.external:
-                    while f.tell() % kDataSerializationAlignment != 0: f.read(1)
+                    f.seek(-f.tell() % kDataSerializationAlignment, 1)
                 else:
-                    x['canonical'] = read1(f)
+                    x['canonical'] = f.read1()
                 x['value'] = self.parse_func(f, count)
 
         class Class(Handler):
             def alloc(self, f, cluster):
-                for _ in range(readuint(f)):
-                    allocref(cluster, { 'cid': readcid(f), 'predefined': True })
-                for _ in range(readuint(f)):
+                for _ in range(f.readuint()):
+                    allocref(cluster, { 'cid': f.readcid(), 'predefined': True })
+                for _ in range(f.readuint()):
                     allocref(cluster, { 'predefined': False })
 
             def fill(self, f, x, ref):
-                cid = readcid(f)
+                cid = f.readcid()
                 if x['predefined'] and cid != x['cid']:
                     warning('Predefined class has different CID (alloc={}, fill={})'.format(x['cid'], cid))
                 if not x['predefined'] and cid < kNumPredefinedCids:
@@ -112,51 +176,51 @@ def make_cluster_handlers(s):
                 x['cid'] = cid
                 
                 if (not is_precompiled) and (kind != kkKind['kFullAOT']):
-                    x['binary_declaration'] = readuint(f, 32)
+                    x['binary_declaration'] = f.readuint(32)
                 
                 # these two should be discarded if (predefined and IsInternalVMdefinedClassId)
-                x['instance_size_in_words'] = readint(f, 32)
-                x['next_field_offset_in_words'] = readint(f, 32)
+                x['instance_size_in_words'] = f.readint(32)
+                x['next_field_offset_in_words'] = f.readint(32)
 
-                x['type_arguments_field_offset_in_words'] = readint(f, 32)
-                x['num_type_arguments'] = readint(f, 16)
-                x['num_native_fields'] = readuint(f, 16)
-                x['token_pos'] = readtokenposition(f)
-                x['end_token_pos'] = readtokenposition(f)
-                x['state_bits'] = readuint(f, 32)
+                x['type_arguments_field_offset_in_words'] = f.readint(32)
+                x['num_type_arguments'] = f.readint(16)
+                x['num_native_fields'] = f.readuint(16)
+                x['token_pos'] = f.readtokenposition()
+                x['end_token_pos'] = f.readtokenposition()
+                x['state_bits'] = f.readuint(32)
 
         class Instance(Handler):
             do_read_from = False
             def alloc(self, f, cluster):
-                count = readuint(f)
-                cluster['next_field_offset_in_words'] = readint(f, 32)
-                cluster['instance_size_in_words'] = readint(f, 32)
+                count = f.readuint()
+                cluster['next_field_offset_in_words'] = f.readint(32)
+                cluster['instance_size_in_words'] = f.readint(32)
                 for _ in range(count): allocref(cluster, {})
             def fill(self, f, x, ref):
-                x['canonical'] = read1(f)
+                x['canonical'] = f.read1()
                 count = ref.cluster['next_field_offset_in_words'] - raw_instance_size_in_words
-                x['fields'] = [ readref(f, (ref, 'fields', n)) for n in range(count) ]
+                x['fields'] = readrefs(f, count, (ref, 'fields'))
 
         class Type(Handler):
             def alloc(self, f, cluster):
-                canonical_items = readuint(f)
-                for i in range(canonical_items + readuint(f)):
+                canonical_items = f.readuint()
+                for i in range(canonical_items + f.readuint()):
                     allocref(cluster, { 'canonical': i < canonical_items })
             def fill(self, f, x, ref):
-                x['token_pos'] = readtokenposition(f)
-                x['type_state'] = readint(f, 8)
+                x['token_pos'] = f.readtokenposition()
+                x['type_state'] = f.readint(8)
 
         class Mint(Handler):
             do_read_from = False
             def alloc(self, f, cluster):
-                for _ in range(readuint(f)):
-                    allocref(cluster, { 'canonical': read1(f), 'value': readint(f, 64) })
+                for _ in range(f.readuint()):
+                    allocref(cluster, { 'canonical': f.read1(), 'value': f.readint(64) })
             def fill(self, f, x, ref): pass
 
         class PatchClass(SimpleHandler):
             def fill(self, f, x, ref):
                 if (not is_precompiled) and (kind != kkKind['kFullAOT']):
-                    x['library_kernel_offset'] = readint(f, 32)
+                    x['library_kernel_offset'] = f.readint(32)
 
         class Function(SimpleHandler):
             def fill(self, f, x, ref):
@@ -171,11 +235,11 @@ def make_cluster_handlers(s):
                     storeref(f, x, 'ic_data_array', ref)
                 
                 if (not is_precompiled) and (kind != kkKind['kFullAOT']):
-                    x['token_pos'] = readtokenposition(f)
-                    x['end_token_pos'] = readtokenposition(f)
-                    x['binary_declaration'] = readuint(f, 32)
-                x['packed_fields'] = readuint(f, 32)
-                x['kind_tag'] = readuint(f, 64) # FIXME it should be 32
+                    x['token_pos'] = f.readtokenposition()
+                    x['end_token_pos'] = f.readtokenposition()
+                    x['binary_declaration'] = f.readuint(32)
+                x['packed_fields'] = f.readuint(32)
+                x['kind_tag'] = f.readuint(64) # FIXME it should be 32
 
         class ClosureData(SimpleHandler):
             def fill(self, f, x, ref): pass
@@ -186,64 +250,64 @@ def make_cluster_handlers(s):
         class Field(SimpleHandler):
             def fill(self, f, x, ref):
                 if kind != kkKind['kFullAOT']:
-                    x['token_pos'] = readtokenposition(f)
-                    x['end_token_pos'] = readtokenposition(f)
-                    x['guarded_cid'] = readcid(f)
-                    x['is_nullable'] = readcid(f)
-                    x['static_type_exactness_state'] = readint(f,8)
+                    x['token_pos'] = f.readtokenposition()
+                    x['end_token_pos'] = f.readtokenposition()
+                    x['guarded_cid'] = f.readcid()
+                    x['is_nullable'] = f.readcid()
+                    x['static_type_exactness_state'] = f.readint(8)
                     if not is_precompiled:
-                        x['binary_declaration'] = readuint(f,32)
-                x['kind_bits'] = readuint(f,16)
+                        x['binary_declaration'] = f.readuint(32)
+                x['kind_bits'] = f.readuint(16)
 
         class Script(SimpleHandler):
             def fill(self, f, x, ref):
-                x['line_offset'] = readint(f,32)
-                x['col_offset'] = readint(f,32)
-                x['kind'] = readint(f,8)
-                x['kernel_script_index'] = readint(f,32)
+                x['line_offset'] = f.readint(32)
+                x['col_offset'] = f.readint(32)
+                x['kind'] = f.readint(8)
+                x['kernel_script_index'] = f.readint(32)
 
         class Library(SimpleHandler):
             def fill(self, f, x, ref):
-                x['index'] = readint(f,32)
-                x['num_imports'] = readuint(f,16)
-                x['load_state'] = readint(f,8)
-                x['is_dart_scheme'] = read1(f)
-                x['debuggable'] = read1(f)
+                x['index'] = f.readint(32)
+                x['num_imports'] = f.readuint(16)
+                x['load_state'] = f.readint(8)
+                x['is_dart_scheme'] = f.read1()
+                x['debuggable'] = f.read1()
                 if not is_precompiled:
-                    x['binary_declaration'] = readuint(f,32)
+                    x['binary_declaration'] = f.readuint(32)
 
         class Code(SimpleHandler):
             def fill(self, f, x, ref):
-                x['state_bits'] = readint(f, 32)
+                x['state_bits'] = f.readint(32)
 
         class ObjectPool(LengthHandler):
             do_read_from = False
             def fill(self, f, x, ref):
                 def read_entry(n):
-                    e = decode_object_entry_type_bits(readuint(f,8))
+                    e = decode_object_entry_type_bits(f.readuint(8))
                     if e['type'] in {kkEntryType['kNativeEntryData'], kkEntryType['kTaggedObject']}:
                         e['raw_obj'] = readref(f, (ref, 'entries', n, 'raw_obj'))
                     elif e['type'] in {kkEntryType['kImmediate']}:
-                        e['raw_value'] = readint(f)
+                        e['raw_value'] = f.readint()
                     elif e['type'] in {kkEntryType['kNativeFunction'], kkEntryType['kNativeFunctionWrapper']}:
                         pass
                     else:
                         warning('Unknown entry type {}...'.format(e['type']))
                     return e
-                x['entries'] = [read_entry(n) for n in range(readuint(f))]
+                x['entries'] = [read_entry(n) for n in range(f.readuint())]
 
         class ExceptionHandlers(LengthHandler):
             do_read_from = False
             def fill(self, f, x, ref):
-                count = readuint(f)
+                count = f.readuint()
                 storeref(f, x, 'handled_types_data', ref)
                 def read_info():
                     i = {}
-                    i['handler_pc_offset'] = readuint(f,32)
-                    i['outer_try_index'] = readint(f,16)
-                    i['needs_stacktrace'] = readint(f,8)
-                    i['has_catch_all'] = readint(f,8)
-                    i['is_generated'] = readint(f,8)
+                    i['handler_pc_offset'] = f.readuint(32)
+                    i['outer_try_index'] = f.readint(16)
+                    i['needs_stacktrace'] = f.readint(8)
+                    i['has_catch_all'] = f.readint(8)
+                    i['is_generated'] = f.readint(8)
                     return i
                 x['entries'] = [read_info() for _ in range(count)]
 
@@ -252,7 +316,7 @@ def make_cluster_handlers(s):
 
         class MegamorphicCache(SimpleHandler):
             def fill(self, f, x, ref):
-                x['filled_entry_count'] = readint(f, 32)
+                x['filled_entry_count'] = f.readint(32)
 
         class SubtypeTestCache(SimpleHandler):
             def fill(self, f, x, ref): pass
@@ -263,21 +327,21 @@ def make_cluster_handlers(s):
         class TypeArguments(LengthHandler):
             do_read_from = False
             def fill(self, f, x, ref):
-                count = readuint(f)
-                x['canonical'] = read1(f)
-                x['hash'] = readint(f, 32)
+                count = f.readuint()
+                x['canonical'] = f.read1()
+                x['hash'] = f.readint(32)
                 storeref(f, x, 'instantiations', ref)
-                x['types'] = [ readref(f, (ref, 'types', n)) for n in range(count) ]
+                x['types'] = readrefs(f, count, (ref, 'types'))
 
         class TypeRef(SimpleHandler):
             def fill(self, f, x, ref): pass
 
         class TypeParameter(SimpleHandler):
             def fill(self, f, x, ref):
-                x['parameterized_class_id'] = readint(f, 32)
-                x['token_pos'] = readtokenposition(f)
-                x['index'] = readint(f, 16)
-                x['flags'] = readuint(f, 8)
+                x['parameterized_class_id'] = f.readint(32)
+                x['token_pos'] = f.readtokenposition()
+                x['index'] = f.readint(16)
+                x['flags'] = f.readuint(8)
 
         class Closure(SimpleHandler):
             def fill(self, f, x, ref): pass
@@ -285,8 +349,8 @@ def make_cluster_handlers(s):
         class Double(SimpleHandler):
             do_read_from = False
             def fill(self, f, x, ref):
-                x['canonical'] = read1(f)
-                x['value'] = readdouble(f)
+                x['canonical'] = f.read1()
+                x['value'] = f.readdouble()
 
         class GrowableObjectArray(SimpleHandler):
             def fill(self, f, x, ref): pass
@@ -297,114 +361,122 @@ def make_cluster_handlers(s):
         class Array(LengthHandler):
             do_read_from = False
             def fill(self, f, x, ref):
-                count = readuint(f)
-                x['canonical'] = read1(f)
+                count = f.readuint()
+                x['canonical'] = f.read1()
                 storeref(f, x, 'type_arguments', ref)
-                x['value'] = [ readref(f, (ref, 'value', n)) for n in range(count) ]
+                x['value'] = readrefs(f, count, (ref, 'value'))
 
         class Namespace(SimpleHandler):
             def fill(self, f, x, ref): pass
 
         class KernelProgramInfo(SimpleHandler):
             def fill(self, f, x, ref):
-                x['kernel_binary_version'] = readuint(f, 32)
+                x['kernel_binary_version'] = f.readuint(32)
 
         class ContextScope(LengthHandler):
             do_read_from = False
             def fill(self, f, x, ref):
-                length = readuint(f)
-                x['implicit'] = read1(f)
+                length = f.readuint()
+                x['implicit'] = f.read1()
                 def read_variable_desc(src):
                     x = {}
-                    x['declaration_token_pos'] = readuint(f)
-                    x['token_pos'] = readuint(f)
+                    x['declaration_token_pos'] = f.readuint()
+                    x['token_pos'] = f.readuint()
                     storeref(f, x, 'name', src)
                     storeref(f, x, 'is_final', src)
                     storeref(f, x, 'is_const', src)
                     storeref(f, x, 'value_or_type', src)
-                    x['context_index'] = readuint(f)
-                    x['context_level'] = readuint(f)
+                    x['context_index'] = f.readuint()
+                    x['context_level'] = f.readuint()
                     return x
                 x['variables'] = [ read_variable_desc((ref, 'variables', i)) for i in range(length) ]
 
         class ICData(SimpleHandler):
             def fill(self, f, x, ref):
                 if not is_precompiled:
-                    x['deopt_id'] = readint(f, 32)
-                x['state_bits'] = readint(f, 32)
+                    x['deopt_id'] = f.readint(32)
+                x['state_bits'] = f.readint(32)
 
         class LibraryPrefix(SimpleHandler):
             def fill(self, f, x, ref):
-                x['num_imports'] = readuint(f, 16)
-                x['deferred_load'] = read1(f)
+                x['num_imports'] = f.readuint(16)
+                x['deferred_load'] = f.read1()
 
         class RegExp(SimpleHandler):
             def fill(self, f, x, ref):
-                x['num_one_byte_registers'] = readint(f, 32)
-                x['num_two_byte_registers'] = readint(f, 32)
-                x['type_flags'] = readint(f, 8)
+                x['num_one_byte_registers'] = f.readint(32)
+                x['num_two_byte_registers'] = f.readint(32)
+                x['type_flags'] = f.readint(8)
 
         class WeakProperty(SimpleHandler):
             def fill(self, f, x, ref): pass
         
+        # String values are decoded with a single codec call, and interned
+        # so that duplicated strings share the same Python object
         if includes_code:
+            # Strings are only decoded when first accessed
             class OneByteString(RODataHandler):
+                lazy_fields = ('tags', 'hash', 'value')
                 def parse_object(self, f):
                     if is_64:
-                        tags, hash_, length = unpack('<LLQ', f.read(16))
+                        tags, hash_, length = f.unpack('<LLQ')
                     else:
-                        tags, length, hash_ = unpack('<LLL', f.read(12))
-                    value = "".join(chr(x) for x in f.read(length//2))
+                        tags, length, hash_ = f.unpack('<LLL')
+                    value = intern(str(f.view(length//2), 'latin-1'))
                     return { 'tags': tags, 'hash': hash_, 'value': value }
             class TwoByteString(RODataHandler):
+                lazy_fields = ('tags', 'hash', 'value')
                 def parse_object(self, f):
                     if is_64:
-                        tags, hash_, length = unpack('<LLQ', f.read(16))
+                        tags, hash_, length = f.unpack('<LLQ')
                     else:
-                        tags, length, hash_ = unpack('<LLL', f.read(12))
-                    value = f.read(length).decode('utf-16-le')
+                        tags, length, hash_ = f.unpack('<LLL')
+                    value = intern(str(f.view(length), 'utf-16-le'))
                     return { 'tags': tags, 'hash': hash_, 'value': value }
         else:
             # FIXME: verify this works
             class OneByteString(LengthHandler):
                 do_read_from = False
                 def fill(self, f, x, ref):
-                    length = readuint(f)
-                    x['canonical'] = read1(f)
-                    x['hash'] = readuint(f, 32)
-                    x['value'] = "".join(chr(x) for x in f.read(length))
+                    length = f.readuint()
+                    x['canonical'] = f.read1()
+                    x['hash'] = f.readuint(32)
+                    x['value'] = intern(str(f.view(length), 'latin-1'))
             class TwoByteString(LengthHandler):
                 do_read_from = False
                 def fill(self, f, x, ref):
-                    length = readuint(f)
-                    x['canonical'] = read1(f)
-                    x['hash'] = readuint(f, 32)
-                    x['value'] = f.read(length * 2).decode('utf-16-le')
+                    length = f.readuint()
+                    x['canonical'] = f.read1()
+                    x['hash'] = f.readuint(32)
+                    x['value'] = intern(str(f.view(length * 2), 'utf-16-le'))
 
         class PcDescriptors(RODataHandler):
+            lazy_fields = ('tags', 'data') if lazy_rodata else None
             def parse_object(self, f):
                 if is_64:
-                    tags, _, length = unpack('<LLQ', f.read(16))
+                    tags, _, length = f.unpack('<LLQ')
                 else:
-                    tags, length = unpack('<LL', f.read(8))
+                    tags, length = f.unpack('<LL')
                 return { 'tags': tags, 'data': f.read(length) }
 
         class CodeSourceMap(RODataHandler):
+            lazy_fields = ('tags', 'ops' if parse_csm else 'data') if lazy_rodata else None
             def parse_object(self, f):
                 if is_64:
-                    tags, _, length = unpack('<LLQ', f.read(16))
+                    tags, _, length = f.unpack('<LLQ')
                 else:
-                    tags, length = unpack('<LL', f.read(8))
+                    tags, length = f.unpack('<LL')
                 data = f.read(length)
                 if not parse_csm:
                     return { 'tags': tags, 'data': data }
                 return { 'tags': tags, 'ops': parse_code_source_map(data) }
 
         class StackMap(RODataHandler):
+            lazy_fields = ('tags', 'pc_offset', 'bits', 'slow_path_bit_count') if lazy_rodata else None
             def parse_object(self, f):
-                tags = unpack('<L', f.read(4))[0]
+                tags = f.unpack('<L')[0]
                 if is_64: f.read(4)
-                pc_offset, length, slow_path_bit_count = unpack('<IHH', f.read(8))
+                pc_offset, length, slow_path_bit_count = f.unpack('<IHH')
                 bits = []
                 while length > 0:
                     c = f.read(1)[0]
@@ -1,16 +1,27 @@
 # CORE: Logic to fully parse an individual snapshot, given its two blobs
 
-from io import BytesIO
-from struct import unpack
 import re
+import multiprocessing
+from array import array
 from bisect import bisect
-
-from .read import *
+from collections import deque
+from collections.abc import Mapping
+from contextlib import nullcontext
+from itertools import repeat, chain
+from operator import itemgetter, attrgetter
+from struct import unpack_from
+from sys import intern
+from time import perf_counter
+
+from .read import Reader, has_numpy
 from .constants import *
 from .clusters import make_cluster_handlers
+from .stats import ParseStats
 from .data.type_data import make_type_data
 from .data.base_objects import init_base_objects
 
+if has_numpy: import numpy as np
+
 
 class ParseError(Exception):
     def __init__(self, data_offset, message):
@@ -33,6 +44,19 @@ format_cid = lambda cid: \
 
 unob_string = lambda str: str.x['unob'] if 'unob' in str.x else str.x['value']
 
+# Maximum number of Code objects whose instructions are decoded together, when streaming
+FILL_BATCH = 1024
+
+# Handlers of the snapshot being decoded by Snapshot.decode_rodata (inherited by its workers)
+_rodata_handlers = None
+
+def decode_rodata_chunk(tasks):
+    ''' Worker: decodes a list of (handler name, rodata offset) objects, returns their dictionaries '''
+    handlers = {}
+    for name in set(name for name, _ in tasks):
+        handlers[name] = getattr(_rodata_handlers, name)(None).parse_object_at
+    return [ handlers[name](offset) for name, offset in tasks ]
+
 # FIXME: throw parseerror if:
 # if instructions / rodata is needed and not present,
 # if Bytecode and KernelProgramInfo appear if precompiled
@@ -40,12 +64,43 @@ unob_string = lambda str: str.x['unob'] if 'unob' in str.x else str.x['value']
 # if read methods fail
 
 class VMObject:
+    __slots__ = ('ref', 'x', 'cluster', '_src', 's', '_nsrc')
     def __init__(self, s, ref, cluster, x):
         self.ref = ref
         self.x = x
         self.cluster = cluster
-        self.src = []
+        self._src = [] if s.backrefs is True else None
         self.s = s
+    def __getattr__(self, name):
+        # data of objects loaded from an image is decoded on first access
+        if name != 'x' or self.s.image is None: raise AttributeError(name)
+        x = self.x = self.s.image.load_record(self.ref)
+        return x
+    @property
+    def src(self):
+        ''' List of back-references to this object, as (object, field, ...) tuples.
+            If back-references are kept in an index, a new list is built on each access. '''
+        return self.s.get_backrefs(self) if self._src is None else self._src
+    @property
+    def nsrc(self):
+        ''' List of native back-references to this object, as (code, address, <fields>)
+            tuples (see populate_native_references); empty if none were found. '''
+        try:
+            return self._nsrc
+        except AttributeError:
+            return []
+    @nsrc.setter
+    def nsrc(self, value):
+        self._nsrc = value
+    @property
+    def nrefs(self):
+        ''' Native references of a Code object (see populate_native_references); if they
+            haven't been populated, this Code object is analyzed now. '''
+        if not self.is_cid('Code'): raise AttributeError('nrefs')
+        if 'nrefs' not in self.x:
+            from .asm.base import analyze_native_references, merge_native_references
+            merge_native_references(self.s, analyze_native_references(self.s, codes=[self]))
+        return self.x['nrefs']
     def is_base(self):
         return type(self.ref) is int and self.ref < self.s.num_base_objects+1
     def is_own(self):
@@ -58,6 +113,7 @@ class VMObject:
         type(self.cluster['cid']) is int and self.cluster['cid'] >= kNumPredefinedCids )
     is_baseobject = lambda self: self.cluster['cid'] == 'BaseObject'
     is_null = lambda self: self.ref == 1
+    is_placeholder = lambda self: self.cluster.get('placeholder', False)
     def values(self):
         if self.ref == 4:
             return []
@@ -77,9 +133,15 @@ class VMObject:
         content = format_cid(self.cluster['cid'])
         if self.is_instance():
             content = 'Instance'
-        if self.is_string():
+        if self.is_string() and 'value' in x: # (not in placeholders)
             content = repr(x['value'])
-        extra = self.get_extra_fields()
+        if self.is_placeholder():
+            return '<placeholder>{}->{}'.format(content, self.ref)
+        try:
+            extra = self.get_extra_fields()
+        except KeyError:
+            if self.s.materialize is None: raise
+            extra = '...' # some referenced object is a placeholder
         content += '' if extra is None else '({})'.format(extra)
         return '{base}{1}->{0}'.format(self.ref, content, base="<base>" if self.is_base() else "")
     def get_extra_fields(self):
@@ -158,6 +220,34 @@ class VMObject:
         return self.__str__()
 
 
+class RefTable(Mapping):
+    ''' Read-only mapping view over the refs of a snapshot, kept for compatibility:
+        `refs[n]` is the object with ref `n`, `refs['root']` is the root object and
+        `refs['next']` is the next ref to be assigned. Refs are actually stored in the
+        `objects` list of the snapshot, indexed by ref number (index 0 is unused). '''
+    __slots__ = ('s',)
+    def __init__(self, s):
+        self.s = s
+    def __getitem__(self, key):
+        objects = self.s.objects
+        if isinstance(key, int):
+            if 0 < key < len(objects): return objects[key]
+        elif key == 'next':
+            return len(objects)
+        elif key == 'root' and self.s.root is not None:
+            return self.s.root
+        raise KeyError(key)
+    def __contains__(self, key):
+        if isinstance(key, int): return 0 < key < len(self.s.objects)
+        return key == 'next' or (key == 'root' and self.s.root is not None)
+    def __iter__(self):
+        yield from range(1, len(self.s.objects))
+        yield 'next'
+        if self.s.root is not None: yield 'root'
+    def __len__(self):
+        return len(self.s.objects) + (self.s.root is not None)
+
+
 class Snapshot:
     """
     This is the core snapshot parser. It can only parse one snapshot,
@@ -168,19 +258,22 @@ class Snapshot:
     
     Typical usage is constructing an instance and then calling the `parse`
     method to perform the actual parsing. Most of the parsed information is
-    in `refs` and `clusters`.
+    in `objects` (indexed by ref number, also accessible through `refs`), `root`
+    and `clusters`.
     """
 
     def __init__(self, data, instructions=None, vm=False, base=None,
         data_offset=0, instructions_offset=0, print_level=3,
-        strict=True, parse_rodata=True, parse_csm=True, build_tables=True):
+        strict=True, parse_rodata=True, parse_csm=True, build_tables=True, backrefs=True,
+        rodata_jobs=None, materialize=None, stats=False):
         """ Initialize a parser.
         
         Main arguments
         --------------
 
-        data -- The data blob.
-        instructions -- The instructions blob (if present).
+        data -- The data blob. Any bytes-like object is accepted (bytes, mmap, memoryview...) and
+            it's never copied; rodata and instructions are parsed from views into it.
+        instructions -- The instructions blob (if present). Same as above.
         vm -- True if this is a VM snapshot; False if isolate snapshot (default).
         base -- Base snapshot, which should always be passed if vm=False. If not passed, the core base objects are used.
             IMPORTANT: The base will be poisoned, you should discard it after passing it here.
@@ -198,22 +291,44 @@ class Snapshot:
                 - instructions / active_instructions field of Code objects, if present
             
             To be empty except for an `offset` field pointing where they are located.
+            If set to 'lazy', CodeSourceMap, PcDescriptors and StackMap objects are parsed on
+            first access to their fields instead (like strings always are), so their full data is
+            available without paying for it at parse time.
         parse_csm -- Enables / disabling parsing code source maps using parse_code_source_map().
             If disabled, code source maps will contain a 'data' field with the encoded bytecode, instead of 'ops'.
             This option has no effect if parse_rodata is False.
+        rodata_jobs -- If set to a number greater than 1, memory structures (strings, PcDescriptors, CodeSourceMap,
+            StackMap) are collected while reading the allocation clusters, and decoded afterwards by this many
+            worker processes, which share the rodata with the parser (they're forked). Strings are then decoded
+            eagerly too. Only worth it for big snapshots; this option has no effect unless parse_rodata is True.
+        materialize -- If passed, only clusters in this set (given by handler or class name, e.g. 'OneByteString',
+            'Library', 'Function', 'Code', 'Instance') are fully parsed. The rest are only read far enough to
+            advance the stream: their objects stay as placeholders with (at most) their alloc data, no rodata is
+            decoded for them and no back-references are recorded from them. They can be parsed later with
+            fill_placeholders(). Tables built by build_tables() only cover materialized objects.
+            This option is ignored for VM snapshots, whose objects are shared with the isolate snapshot.
         build_tables -- Calls build_tables() at the end of the parsing, which populates some convenience data
             about the snapshot. Disable this if it fails for some reason.
+        backrefs -- How back-references (the `src` of each object) are tracked. If True (default), each object
+            keeps a list of them. If 'csr', they're recorded as edges into flat integer arrays while parsing,
+            which are turned into a compressed index afterwards; `src` is then built on access from it, and
+            is read-only. If False, back-references aren't tracked at all and `src` is always empty.
 
         Reporting parameters
         --------------------
 
+        stats -- If True, timing and size statistics are collected while parsing (per phase, and per cluster) into
+            `stats`, a ParseStats object that can be exported as JSON. If 'memory', peak memory of each phase is
+            measured too, using tracemalloc (which slows down the parse). If False (default), `stats` is None.
         data_offset -- When reporting an offset into the data blob, this value will be added to it.
         instructions_offset -- When reporting an offset into the instructions blob, this value will be added to it.
         print_level -- Maximum message level to print: -1 nothing, 0 error, 1 warning, 2 notice, 3 info (default), 4 debug
         """
-        self.data = BytesIO(data)
+        self.data = Reader(data)
         self.data_offset = data_offset
-        self.instructions = None if instructions is None else BytesIO(instructions)
+        self.instructions = None if instructions is None else Reader(instructions)
+        self.blobs = (self.data.buf, None if instructions is None else self.instructions.buf)
+        self.image = None
         self.instructions_offset = instructions_offset
         self.vm = vm
         self.base = base
@@ -223,42 +338,120 @@ class Snapshot:
         self.strict = strict
         self.parse_rodata = parse_rodata
         self.parse_csm = parse_csm
+        self.rodata_jobs = rodata_jobs
+        self.materialize = None if materialize is None or vm else tuple(sorted(set(materialize)))
         self.do_build_tables = build_tables
+        if backrefs not in {True, False, 'csr'}:
+            raise ValueError('Invalid backrefs mode: {}'.format(repr(backrefs)))
+        self.backrefs = backrefs
+        self.collect_stats = stats
+        self.stats = None
+
+        self.objects = [None]
+        self.root = None
+        self.refs = RefTable(self)
+        self.pending_instructions = []
+        self.pending_rodata = []
+        self._rodata_objects = None
+        self.nrefs_populated = False # whether native references were merged (see asm.base)
     
-    def parse(self):
-        ''' Parse the snapshot. '''
-        self.parse_header()
-        self.initialize_settings()
-        self.initialize_clusters()
-        self.initialize_references()
+    def parse(self, callback=None):
+        ''' Parse the snapshot. If passed, `callback(event, value)` is called for every
+            event of stream() as it's parsed. '''
+        for event, value in self.stream():
+            if callback is not None: callback(event, value)
+        return self
+
+    def stream(self, link=True, release=None):
+        '''
+        Parses the snapshot incrementally, as a generator of (event, value) pairs:
+
+         - ('cluster', cluster) after the alloc section of each cluster is read (its
+           objects are allocated in cluster['refs'] but still unfilled, except for rodata)
+         - ('object', obj) after each object is filled; objects of Code clusters are
+           yielded in batches of up to FILL_BATCH, once their instructions are decoded
+         - ('root', root) after the root object is read
+
+        Once exhausted, the snapshot is fully parsed (as with parse()), unless `link=False`
+        is passed: then the final steps (CID linking, back-reference index, tables), which
+        need the whole graph, are skipped.
+
+        Objects are only filled with their own data, so consumers that extract what they
+        need as objects are yielded don't need to keep it. `release` (which requires
+        `link=False`) drops the data (`x`) of each object once the consumer is done with
+        it (i.e. when the generator is resumed), and the `refs` list of each cluster once
+        all its objects are; it's True for every cluster, or a set of handler / class names
+        like `materialize`. Objects themselves stay allocated (later objects reference them),
+        but without their data. Pass `backrefs=False` too, to not record back-references.
+        '''
+        if release and link:
+            raise ValueError('release requires link=False')
+        released = lambda c: release is True or c['handler'] in release or format_cid(c['cid']) in release
+        self.pending_instructions = []
+        self.pending_rodata = []
+        self._rodata_objects = None
+        self.edges = tuple(array('i') for _ in range(4)) # dst, src, field, index
+        self.edge_roots, self.edge_fields, self.edge_field_ids = [], [], {}
+        self.backref_index = None
+        self.stats = ParseStats(self.collect_stats == 'memory') if self.collect_stats else None
+        with self.phase('header'):
+            self.parse_header()
+            self.initialize_settings()
+            self.initialize_clusters()
+            self.initialize_references()
         
         self.info('Reading allocation clusters...')
-        self.clusters = [ self.read_cluster() for _ in range(self.num_clusters) ]
-        if self.refs['next']-1 != self.num_objects:
-            self.warning('Expected {} total objects, produced {}'.format(self.num_objects, self.refs['next']-1))
+        self.clusters = []
+        deferred = self.parse_rodata is True and (self.rodata_jobs or 0) > 1 # (see decode_rodata)
+        with self.phase('alloc'):
+            for _ in range(self.num_clusters):
+                self.clusters.append(self.read_cluster())
+                if not deferred: yield 'cluster', self.clusters[-1]
+        if len(self.objects)-1 != self.num_objects:
+            self.warning('Expected {} total objects, produced {}'.format(self.num_objects, len(self.objects)-1))
+        if deferred:
+            with self.phase('rodata'):
+                self.decode_rodata()
+            for cluster in self.clusters: yield 'cluster', cluster
 
         self.info('Reading fill clusters...')
-        for cluster in self.clusters:
-            self.read_fill_cluster(cluster)
+        with self.phase('fill'):
+            for cluster in self.clusters:
+                release_cluster = bool(release) and not cluster.get('placeholder') and released(cluster)
+                for obj in self.fill_cluster(cluster):
+                    yield 'object', obj
+                    if release_cluster: obj.x = None
+                if release_cluster: cluster['refs'] = []
 
         self.info('Reading roots...')
-        root = self.refs['root'] = VMObject(self, 'root', {'handler': 'ObjectStore', 'cid': 'ObjectStore'}, {})
-        if self.vm:
-            self.storeref(self.data, root.x, 'symbol_table', root)
-            if self.includes_code:
-                root.x['_stubs'] = [ self.readref(self.data, (root, '_stubs', n)) for n in kStubCodeList ]
-            self.enforce_section_marker()
-        else:
-            self.read_fill_cluster(root.cluster, [root])
+        with self.phase('roots'):
+            root = self.root = VMObject(self, 'root', {'handler': 'ObjectStore', 'cid': 'ObjectStore'}, {})
+            if self.vm:
+                self.storeref(self.data, root.x, 'symbol_table', root)
+                if self.includes_code:
+                    root.x['_stubs'] = [ self.readref(self.data, (root, '_stubs', n)) for n in kStubCodeList ]
+                self.enforce_section_marker()
+            else:
+                self.read_fill_cluster(root.cluster, [root])
+        yield 'root', root
 
         self.info('Snapshot parsed.')
         if self.data.tell() != self.length + 4:
             self.warning('Snapshot should end at 0x{:x} but we are at 0x{:x}'.format(self.length + 4, self.data.tell()))
 
-        self.link_cids()
+        if not link: return
+        with self.phase('link_cids'):
+            self.link_cids()
+        if self.backrefs == 'csr':
+            with self.phase('backrefs'):
+                self.build_backrefs()
         if self.do_build_tables:
-            self.build_tables()
-        return self
+            with self.phase('build_tables'):
+                self.build_tables()
+
+    def phase(self, name):
+        ''' Context manager that measures a phase of the parse, if stats are enabled '''
+        return nullcontext() if self.stats is None else self.stats.phase(name)
 
     
     # REPORTING #
@@ -293,13 +486,13 @@ class Snapshot:
         ''' This method parses the header of a snapshot, checks the magic and does
         some extra steps to prepare for actual parsing:
         1. If the snapshot contains a 'rodata section', then `self.rodata` is populated
-           with a BytesIO for this extra data.
+           with a Reader for this extra data.
         2. Checks that `self.data` matches or exceeds the length in the snapshot header,
            and then truncates `self.data` to that length.
         '''
         f = self.data
 
-        self.magic_value, self.length, self.kind = unpack('<Iqq', f.read(4+8+8))
+        self.magic_value, self.length, self.kind = f.unpack('<Iqq')
         if self.magic_value != MAGIC_VALUE:
             self.warning('Invalid magic value: {:08x}'.format(self.magic_value))
         self.p(1, "[Header]\n  length = {}\n  kind = {} {}\n".format(self.length, self.kind, kKind[self.kind]), show_offset=False)
@@ -309,23 +502,23 @@ class Snapshot:
 
         # Check length, set rodata if needed, truncate
         data_end = 4 + self.length
-        if len(f.getbuffer()) < data_end:
-            self.warning('Data blob should be at least {} bytes, got {}'.format(data_end, len(f.getbuffer())))
+        if len(f) < data_end:
+            self.warning('Data blob should be at least {} bytes, got {}'.format(data_end, len(f)))
         if self.includes_code:
             rodata_offset = ((data_end - 1) // kMaxPreferredCodeAlignment + 1) * kMaxPreferredCodeAlignment
-            if len(f.getbuffer()) < rodata_offset:
+            if len(f) < rodata_offset:
                 self.warning('The rodata section is not present')
             self.rodata_offset = self.data_offset + rodata_offset
-            self.rodata = BytesIO(f.getbuffer()[rodata_offset:])
-        elif len(f.getbuffer()) > data_end:
-            self.notice('There are {} excess bytes at the end of the data blob'.format(len(f.getbuffer()) - data_end), offset=data_end)
+            self.rodata = Reader(f.buf[rodata_offset:])
+        elif len(f) > data_end:
+            self.notice('There are {} excess bytes at the end of the data blob'.format(len(f) - data_end), offset=data_end)
         f.truncate(data_end)
 
         # Parse rest of header
         self.version = f.read(32).decode('ascii')
         if self.version != EXPECTED_VERSION:
             self.warning('Version ({}) doesn\'t match with the one this parser was made for'.format(self.version))
-        self.features = parse_features(readcstr(f).decode('ascii'))
+        self.features = parse_features(f.readcstr().decode('ascii'))
         self.p(1, "[Snapshot header]\n  version = {}\n  features = {}\n".format(repr(self.version), repr(self.features)), show_offset=False)
 
         # Check that header matches with base, if passed
@@ -334,7 +527,7 @@ class Snapshot:
             self.warning("Snapshot header doesn't match with base snapshot!")
 
         # Parse counts
-        self.num_base_objects, self.num_objects, self.num_clusters, self.code_order_length = (readuint(f) for _ in range(4))
+        self.num_base_objects, self.num_objects, self.num_clusters, self.code_order_length = (f.readuint() for _ in range(4))
         self.p(1, "  base objects: {}\n  objects: {}\n  clusters: {}\n  code order length = {}\n".format(
             self.num_base_objects, self.num_objects, self.num_clusters, self.code_order_length), show_offset=False)
 
@@ -395,50 +588,164 @@ class Snapshot:
 
         # copy refs from base, posion them to be ours
         if base:
-            base_objects = base.refs['next']-1
+            base_objects = len(base.objects)-1
             self.base_clusters = list(self.base.clusters)
-            # refs is a dict from int to VMObject,
-            # except for 'next' key which just stores next ID to be assigned
-            self.refs = { 'next': min(base_objects, exp_base_objects) + 1 }
-            for i in range(1, self.refs['next']):
-                ref = self.refs[i] = base.refs[i]
+            # objects is a list from ref number to VMObject (ref 0 is illegal)
+            self.objects = base.objects[:min(base_objects, exp_base_objects) + 1]
+            for ref in self.objects[1:]:
+                src = ref.src
                 ref.s = self
+                ref._src = src if self.backrefs is True else None
+                if self.backrefs == 'csr':
+                    for source in src: self.add_backref(ref, source)
         else:
             init_base_objects(VMObject, self, self.includes_code)
-            base_objects = self.refs['next']-1
+            base_objects = len(self.objects)-1
 
         # fill any missing refs
         if base_objects != exp_base_objects:
             self.notice('Snapshot expected {} base objects, but the provided base has {}'.format(exp_base_objects, base_objects))
         tmp_cluster = { 'handler': 'UnknownBase', 'cid': 'unknown' }
-        while self.refs['next']-1 < exp_base_objects: self.allocref(tmp_cluster, {})
+        while len(self.objects)-1 < exp_base_objects: self.allocref(tmp_cluster, {})
 
     def allocref(self, cluster, x):
         if 'refs' not in cluster:
             cluster['refs'] = []
-        ref = VMObject(self, self.refs['next'], cluster, x)
-        self.refs[ref.ref] = ref
-        self.refs['next'] += 1
+        ref = VMObject(self, len(self.objects), cluster, x)
+        self.objects.append(ref)
         cluster['refs'].append(ref)
 
     def readref(self, f, source):
-        r = readuint(f)
-        if r not in self.refs:
+        r = f.readuint()
+        if not 0 < r < len(self.objects):
             self.warning('Code referenced a non-existent ref, a broken ref is returned')
             return { 'broken': r }
-        self.refs[r].src.append(source)
-        return self.refs[r]
+        ref = self.objects[r]
+        if self.backrefs is True:
+            ref._src.append(source)
+        elif self.backrefs:
+            self.record_edges([r], source)
+        return ref
+
+    def readrefs(self, f, count, source):
+        ''' Reads a run of `count` consecutive refs. The refs are decoded, resolved and
+            back-referenced in bulk; the back-reference of each one is `source` plus its index. '''
+        rs = f.readuints(count)
+        if not rs: return []
+        objects = self.objects
+        if not (0 < min(rs) and max(rs) < len(objects)):
+            res = []
+            for n, r in enumerate(rs):
+                if not 0 < r < len(objects):
+                    self.warning('Code referenced a non-existent ref, a broken ref is returned')
+                    res.append({ 'broken': r })
+                    continue
+                self.add_backref(objects[r], source + (n,))
+                res.append(objects[r])
+            return res
+        objs = [ objects[rs[0]] ] if count == 1 else list(itemgetter(*rs)(objects))
+        if self.backrefs is True:
+            sources = zip(*(repeat(x, count) for x in source), range(count))
+            deque(map(list.append, map(attrgetter('_src'), objs), sources), maxlen=0)
+        elif self.backrefs:
+            self.record_edges(rs, source + (None,))
+        return objs
 
     def storeref(self, f, x, name, src):
         if not (type(src) is tuple): src = (src,)
         x[name] = self.readref(f, src + (name,))
 
+    def add_backref(self, ref, source):
+        ''' Registers `source` as a back-reference of the `ref` object '''
+        if self.backrefs is True:
+            ref._src.append(source)
+        elif self.backrefs:
+            self.record_edges([ref.ref], source)
+
+    def record_edges(self, rs, source):
+        ''' Records edges from `source` to each of the refs in `rs`, for 'csr' mode.
+            The first int (or None) in the path of `source` is taken as the index; if it's
+            None, the index of each ref in `rs` is used instead. '''
+        obj, path, index = source[0], source[1:], -1
+        for i, p in enumerate(path):
+            if p is None or type(p) is int:
+                index, path = p, path[:i] + (None,) + path[i+1:]
+                break
+        field = self.edge_field_ids.get(path)
+        if field is None:
+            field = self.edge_field_ids[path] = len(self.edge_fields)
+            self.edge_fields.append(path)
+        sid = obj.ref
+        if type(sid) is not int:
+            roots = self.edge_roots
+            sid = next((-k for k, root in enumerate(roots) if root is obj), None)
+            if sid is None:
+                sid = -len(roots)
+                roots.append(obj)
+        dst, src, fields, indexes = self.edges
+        dst.extend(rs)
+        src.extend(repeat(sid, len(rs)))
+        fields.extend(repeat(field, len(rs)))
+        indexes.extend(range(len(rs)) if index is None else repeat(index, len(rs)))
+
+    def build_backrefs(self):
+        ''' Turns the recorded edges into a compressed sparse row index, which is used to
+            serve the back-references of each object ('csr' mode). '''
+        dst, *columns = self.edges
+        n = len(self.objects)
+        if has_numpy:
+            dst = np.frombuffer(dst, np.int32) if len(dst) else np.zeros(0, np.int32)
+            order = np.argsort(dst, kind='stable')
+            offsets = np.zeros(n + 1, np.int64)
+            np.cumsum(np.bincount(dst, minlength=n), out=offsets[1:])
+            columns = [ (np.frombuffer(c, np.int32) if len(c) else np.zeros(0, np.int32))[order] for c in columns ]
+        else:
+            offsets = [0] * (n + 1)
+            for r in dst: offsets[r + 1] += 1
+            for r in range(n): offsets[r + 1] += offsets[r]
+            pos = offsets[:-1]
+            sorted_columns = [ array('i', bytes(4 * len(dst))) for _ in columns ]
+            for i, r in enumerate(dst):
+                j = pos[r]
+                pos[r] = j + 1
+                for c, sc in zip(columns, sorted_columns): sc[j] = c[i]
+            columns = sorted_columns
+        self.backref_index = (offsets, *columns)
+        if not any(c.get('placeholder') for c in self.clusters):
+            self.edges = None # (kept while fill_placeholders may record more)
+
+    def unpack_backrefs(self):
+        ''' Turns the back-reference index back into edges (the reverse of build_backrefs),
+            so that more edges can be recorded and the index rebuilt. '''
+        offsets, *columns = self.backref_index
+        to_array = lambda c: array('i', memoryview(c).cast('B').cast('i').tolist())
+        if has_numpy:
+            offsets = np.asarray(offsets, np.int64)
+            dst = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+            columns = [ np.asarray(c, np.int32) for c in columns ]
+        else:
+            dst = array('i', chain.from_iterable(repeat(r, b - a) for r, (a, b) in enumerate(zip(offsets, offsets[1:]))))
+        self.edges = tuple(map(to_array, [ dst, *columns ]))
+        self.edge_field_ids = { path: n for n, path in enumerate(self.edge_fields) }
+
+    def get_backrefs(self, obj):
+        ''' Returns list of back-references to `obj`, from the back-reference index.
+            Empty if back-references aren't tracked or the index isn't built yet. '''
+        if self.backref_index is None or type(obj.ref) is not int:
+            return []
+        offsets, src, fields, indexes = self.backref_index
+        a, b = int(offsets[obj.ref]), int(offsets[obj.ref + 1])
+        objects, roots, paths = self.objects, self.edge_roots, self.edge_fields
+        return [ (objects[s] if s > 0 else roots[-s],) + tuple(i if p is None else p for p in paths[f])
+            for s, f, i in zip(src[a:b].tolist(), fields[a:b].tolist(), indexes[a:b].tolist()) ]
+
 
     # MAIN PARSING LOGIC #
 
     def read_cluster(self):
         ''' Reads the alloc section of a new cluster '''
-        cid = readcid(self.data)
+        if self.stats is not None: start, offset = perf_counter(), self.data.tell()
+        cid = self.data.readcid()
         self.debug('reading cluster with cid={}'.format(format_cid(cid)))
         if cid >= kNumPredefinedCids:
             handler = 'Instance'
@@ -451,87 +758,251 @@ class Snapshot:
         else:
             handler = kClassId[cid]
         cluster = { 'handler': handler, 'cid': cid }
+        if not self.is_materialized(cluster):
+            cluster['placeholder'] = True
         if not hasattr(self.handlers, handler):
             raise ParseError(self.data_offset + self.data.tell(), 'Cluster "{}" still not implemented'.format(handler))
         getattr(self.handlers, handler)(cid).alloc(self.data, cluster)
         
         if self.is_debug:
-            serializers_next_ref_index = readint(f, 32)
-            self.warning('next_ref doesn\'t match, expected {} but got {}'.format(serializers_next_ref_index, refs['next']))
+            serializers_next_ref_index = self.data.readint(32)
+            self.warning('next_ref doesn\'t match, expected {} but got {}'.format(serializers_next_ref_index, len(self.objects)))
+        if self.stats is not None:
+            entry = self.stats.cluster(cluster)
+            entry['cid'], entry['objects'] = format_cid(cid), len(cluster.get('refs', ()))
+            entry['alloc_bytes'] += self.data.tell() - offset
+            entry['alloc_time'] += perf_counter() - start
         return cluster
 
     def read_fill_cluster(self, cluster, refs=None):
-        ''' Reads the fill section of the passed cluster '''
+        ''' Reads the fill section of the passed cluster (see fill_cluster) '''
+        for _ in self.fill_cluster(cluster, refs): pass
+
+    def fill_cluster(self, cluster, refs=None):
+        ''' Reads the fill section of the passed cluster, as a generator of its objects,
+            which are yielded as soon as they're filled (Code objects are yielded in
+            batches, once their instructions are decoded). For placeholder clusters (see
+            `materialize`), the data is read into throwaway dictionaries, without recording
+            back-references, and the offset of the section is kept for fill_placeholders(). '''
         f = self.data
+        timed = self.stats is not None
+        if timed: elapsed, start, offset = 0, perf_counter(), f.tell()
         cid, name = cluster['cid'], cluster['handler']
         self.debug('reading cluster with cid={}'.format(format_cid))
         handler = getattr(self.handlers, name)(cid)
         if refs is None: refs = cluster['refs']
-        for ref in refs:
-            if self.show_debug: self.debug('  reading ref {}'.format(ref.ref))
-            assert ref.cluster == cluster
-            if handler.do_read_from:
-                if name in {'Closure', 'GrowableObjectArray'}:
-                    ref.x['canonical'] = read1(f)
-                if name == 'Code':
-                    ref.x['instructions'] = self.read_instructions()
-                    if not self.is_precompiled and self.kind == kkKind['kFullJIT']:
-                        ref.x['active_instructions'] = self.read_instructions()
-                for _, fname, _ in self.types[cluster['handler']]:
-                    if self.show_debug: self.debug('    reading field {}'.format(fname))
-                    self.storeref(f, ref.x, fname, ref)
-            if self.show_debug: self.debug('    reading fill')
-            handler.fill(f, ref.x, ref)
+        placeholder = cluster.get('placeholder', False)
+        if placeholder:
+            cluster['fill_offset'] = f.tell()
+            backrefs, self.backrefs = self.backrefs, False
+        batch = []
+        try:
+            for ref in refs:
+                if self.show_debug: self.debug('  reading ref {}'.format(ref.ref))
+                assert ref.cluster == cluster
+                x = dict(ref.x) if placeholder else ref.x
+                if handler.do_read_from:
+                    if name in {'Closure', 'GrowableObjectArray'}:
+                        x['canonical'] = f.read1()
+                    if name == 'Code':
+                        x['instructions'] = self.read_instructions()
+                        if not self.is_precompiled and self.kind == kkKind['kFullJIT']:
+                            x['active_instructions'] = self.read_instructions()
+                    for _, fname, _ in self.types[cluster['handler']]:
+                        if self.show_debug: self.debug('    reading field {}'.format(fname))
+                        self.storeref(f, x, fname, ref)
+                if self.show_debug: self.debug('    reading fill')
+                handler.fill(f, x, ref)
+                if placeholder: self.pending_instructions.clear()
+                batch.append(ref)
+                if self.pending_instructions and len(batch) < FILL_BATCH: continue
+                self.decode_instructions()
+                if timed: elapsed += perf_counter() - start
+                yield from batch
+                if timed: start = perf_counter()
+                batch = []
+        finally:
+            if placeholder: self.backrefs = backrefs
+        self.decode_instructions()
         self.enforce_section_marker()
+        if timed:
+            elapsed += perf_counter() - start
+            entry = self.stats.cluster(cluster)
+            entry['cid'] = cid if type(cid) is str else format_cid(cid) # (root)
+            entry['fill_bytes'] += f.tell() - offset
+            entry['fill_time'] += elapsed
+        yield from batch
+
+    def is_materialized(self, cluster):
+        ''' Whether a cluster is parsed (see `materialize`), by its handler or class name '''
+        names = self.materialize
+        return names is None or cluster['handler'] in names or format_cid(cluster['cid']) in names
+
+    def fill_placeholders(self, names=None):
+        '''
+        Parses the placeholder clusters left by `materialize` (all of them, or those
+        matching `names`) by reading their sections again: their rodata objects are
+        decoded, their fill sections re-read, their CIDs linked and the tables rebuilt.
+        The existing objects are filled in place, so references to them stay valid.
+        '''
+        self.materialize = None if names is None else tuple(sorted(set(self.materialize or ()) | set(names)))
+        clusters = [ c for c in self.clusters if c.get('placeholder') and self.is_materialized(c) ]
+        if not clusters: return self
+        if self.backrefs == 'csr' and self.edges is None:
+            self.unpack_backrefs() # (loaded from an image)
+        addresses = { obj.ref: address for address, obj in self.rodata_objects }
+        self.pending_rodata = []
+        self.handlers = make_cluster_handlers(self)
+        for cluster in clusters:
+            handler = getattr(self.handlers, cluster['handler'])(cluster['cid'])
+            if hasattr(handler, 'parse_object_at'):
+                for obj in cluster['refs']:
+                    if obj.ref in addresses:
+                        obj.x = handler.try_parse_object(addresses[obj.ref] - self.rodata_offset)
+        self.decode_rodata()
+
+        pos = self.data.tell()
+        for cluster in clusters:
+            del cluster['placeholder']
+            self.data.seek(cluster.pop('fill_offset'))
+            self.read_fill_cluster(cluster)
+        self.data.seek(pos)
+
+        refs = [ r for c in clusters for r in c['refs'] ]
+        if any(c['handler'] == 'Class' for c in clusters):
+            # objects linked while their class was a placeholder
+            refs += [ r for r in self.objects[1:] if r.x.get('_class', False) is None ]
+        self.link_cids(refs)
+        if self.backrefs == 'csr':
+            self.build_backrefs()
+        if self.do_build_tables:
+            self.build_tables()
+        return self
 
     def read_instructions(self):
-        ''' Reads RawInstructions object '''
-        offset = readint(self.data, 32)
+        ''' Reads reference to RawInstructions object. The returned dictionary is
+            populated later, when decode_instructions() is called for the cluster. '''
+        offset = self.data.readint(32)
         if offset < 0:
             offset = -offset # FIXME: implement
             self.notice('Base instructions not implemented yet, returning empty object')
             return None
         if not self.parse_rodata:
             return { 'offset': self.instructions_offset + offset }
-        f = self.instructions
-        f.seek(offset)
-
-        if self.is_64:
-            tags, _, size_and_flags, unchecked_entrypoint_pc_offset = unpack('<LLLL', f.read(16))
-            # 16 0xCC bytes observed on x64, looks like a sentinel or something?
-            # on ARM64 it is 00... 20 D4 FFFF FFFF
-            f.read(16)
+        instr = {}
+        self.pending_instructions.append((offset, instr))
+        return instr
+
+    def decode_instructions(self):
+        ''' Decodes all pending RawInstructions objects in one batch, and populates
+            their dictionaries. `data` is a view of the instructions blob (not a copy). '''
+        pending, self.pending_instructions = self.pending_instructions, []
+        if not pending: return
+        buf = self.instructions.buf
+        offsets = [ offset for offset, _ in pending ]
+
+        # Read all headers (4 x uint32) at once
+        if has_numpy and all(offset % 4 == 0 for offset in offsets):
+            words = np.frombuffer(buf, '<u4', len(buf) // 4)
+            headers = words[np.array(offsets)[:, None] // 4 + np.arange(4)].tolist()
         else:
-            tags, size_and_flags, unchecked_entrypoint_pc_offset, _ = unpack('<LLLL', f.read(16))
-        size, flags = size_and_flags & ((1 << 31) - 1), size_and_flags >> 31
-        data_addr = self.instructions_offset + f.tell() # for disassembling in another program
-        data = f.read(size)
-        return {
-            'tags': tags,
-            'flags': { 'single_entry': flags & 1 },
-            'unchecked_entrypoint_pc_offset': unchecked_entrypoint_pc_offset,
-            'data': data,
-            'data_addr': data_addr,
-        }
+            headers = [ unpack_from('<LLLL', buf, offset) for offset in offsets ]
+
+        for (offset, instr), header in zip(pending, headers):
+            if self.is_64:
+                tags, _, size_and_flags, unchecked_entrypoint_pc_offset = header
+                # followed by 16 bytes: 0xCC on x64, looks like a sentinel or something?
+                # on ARM64 it is 00... 20 D4 FFFF FFFF
+                start = offset + 32
+            else:
+                tags, size_and_flags, unchecked_entrypoint_pc_offset, _ = header
+                start = offset + 16
+            size, flags = size_and_flags & ((1 << 31) - 1), size_and_flags >> 31
+            instr['tags'] = tags
+            instr['flags'] = { 'single_entry': flags & 1 }
+            instr['unchecked_entrypoint_pc_offset'] = unchecked_entrypoint_pc_offset
+            instr['data'] = buf[start:start + size]
+            instr['data_addr'] = self.instructions_offset + start # for disassembling in another program
+
+    def decode_rodata(self):
+        ''' Decodes all pending rodata objects (see `rodata_jobs`) in a pool of worker
+            processes, and populates their dictionaries. '''
+        global _rodata_handlers
+        pending, self.pending_rodata = self.pending_rodata, []
+        if not pending: return
+        tasks = [ (name, offset) for name, offset, _ in pending ]
+        self.info('Decoding {} rodata objects...'.format(len(tasks)))
+
+        # Workers are forked, so they inherit the handlers and the rodata (no copies are made)
+        _rodata_handlers = self.handlers
+        try:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                self.notice('Forking not supported, decoding rodata in this process')
+                results = decode_rodata_chunk(tasks)
+            else:
+                chunk = -(-len(tasks) // (self.rodata_jobs * 8))
+                chunks = [ tasks[i:i + chunk] for i in range(0, len(tasks), chunk) ]
+                with multiprocessing.get_context('fork').Pool(self.rodata_jobs) as pool:
+                    results = chain.from_iterable(pool.map(decode_rodata_chunk, chunks))
+        finally:
+            _rodata_handlers = None
+
+        for (_, _, x), result in zip(pending, results):
+            if 'value' in result: result['value'] = intern(result['value'])
+            x.update(result)
 
     def enforce_section_marker(self):
         if not self.is_debug: return
         offset = self.data.tell()
-        section_marker = readint(self.data, 32)
+        section_marker = self.data.readint(32)
         if section_marker != kSectionMarker:
             raise ParseError(self.data_offset + offset, 'Section marker doesn\'t match')
 
 
+    # IMAGES #
+
+    def image_key(self):
+        ''' Returns a hash of the input blobs and parser options (including those of
+            the base), which identifies the images of this snapshot. '''
+        from .image import image_key
+        return image_key(self)
+
+    def save_image(self, path):
+        ''' Saves the parsed snapshot as an image file, which can be loaded later with
+            load_image(). Native references are saved too, if they were populated. '''
+        from .image import save_image
+        save_image(self, path)
+
+    def load_image(self, path, check=True):
+        ''' Alternative to parse() which loads the parsed snapshot from an image written by
+            save_image(). The image file is mapped into memory, and the data of each object
+            is decoded on first access. Returns self, or None if the image doesn't exist
+            or is stale (i.e. its input blobs or parser options didn't match ours; pass
+            check=False to skip this) in which case parse() should be called instead.
+
+            Back-references of a loaded snapshot are always served from an index
+            (like backrefs='csr' does), unless the image was saved with backrefs=False. '''
+        from .image import load_image
+        if load_image(self, path, check) is None: return
+        data_end = 4 + self.length
+        if self.includes_code:
+            self.rodata = Reader(self.data.buf[self.rodata_offset - self.data_offset:])
+        self.data.truncate(data_end)
+        self.data.seek(data_end)
+        self.initialize_clusters() # (for fill_placeholders)
+        return self
+
+
     # CID LINKING #
 
-    def link_cids(self):
+    def link_cids(self, refs=None):
         ''' This method builds a CID-to-VMObject table, and then manually inserts references
-            from things that reference a CID (Instance, Type and predefined Class) to their original Class. '''
+            from things that reference a CID (Instance, Type and predefined Class) to their original Class.
+            If `refs` is passed, only these objects are linked. '''
         # Build class table, and link predefined Class objects
         self.classes = {}
-        for i in range(1, self.refs['next']):
-            r = self.refs[i]
-            if (r.cluster['cid'] == 'BaseObject' and r.x['type'] == 'Class') or r.is_cid('Class'):
+        for r in self.objects[1:]:
+            if (r.cluster['cid'] == 'BaseObject' and r.x['type'] == 'Class') or (r.is_cid('Class') and 'cid' in r.x):
                 if r.x['cid'] in self.classes:
                     self.notice('Duplicated class with CID {}'.format(r.x['cid']))
                 self.classes[r.x['cid']] = r
@@ -545,11 +1016,11 @@ class Snapshot:
                 ref.x['_class'] = None
                 return
             ref.x['_class'] = self.classes[cid]
-            self.classes[cid].src.append((ref, '_class'))
+            self.add_backref(self.classes[cid], (ref, '_class'))
 
         # Link references from Instance and Type objects
-        for i in range(1, self.refs['next']):
-            r = self.refs[i]
+        for r in self.objects[1:] if refs is None else refs:
+            if r.is_placeholder(): continue
             if r.is_instance():
                 reference_cid(r, r.cluster['cid'])
             if r.is_cid('Type'):
@@ -572,12 +1043,18 @@ class Snapshot:
             self.clrefs[n] += c['refs']
 
         self.strings_refs = self.getrefs('OneByteString') + self.getrefs('TwoByteString')
-        self.strings = { ref.x['value']: ref for ref in self.strings_refs }
-        if len(self.strings) != len(self.strings_refs):
-            self.notice('There are {} duplicate strings.'.format(len(self.strings_refs) - len(self.strings)))
+        placeholders = any(c.get('placeholder') for c in self.clusters)
+        if placeholders:
+            self.strings_refs = [ r for r in self.strings_refs if not r.is_placeholder() ]
+        self._strings = None
+        self._address_map = None
+        self._indexes = None
+        self._names = None
 
         self.scripts_lib = {}
         for l in self.getrefs('Library'):
+            if placeholders and (l.is_placeholder() or l.x['owned_scripts'].is_placeholder() or \
+                l.x['owned_scripts'].x['data'].is_placeholder()): continue
             for r in l.x['owned_scripts'].x['data'].x['value']:
                 if r.ref == 1: continue
                 if r.ref in self.scripts_lib:
@@ -586,16 +1063,18 @@ class Snapshot:
 
         # FIXME: register active_instructions too, if present
         self.entry_points = {}
-        for c in self.getrefs('Code'):
+        codes = [ c for c in self.getrefs('Code') if not c.is_placeholder() ]
+        for c in codes:
             ep = self.get_entry_points(c.x['instructions'])
             for k, v in ep.items():
                 self.entry_points[k] = (c, v)
 
         key = lambda x: x.x['instructions']['data_addr']
-        self.code_objs = sorted(self.getrefs('Code'), key=key)
+        self.code_objs = sorted(codes, key=key)
         self.code_addrs = list(map(key, self.code_objs))
 
         # Consistency checks
+        if placeholders: return
         if len(self.scripts_lib) != len(self.getrefs('Script')):
             self.notice('There are {} scripts but only {} are associated to a library'.format(len(self.getrefs('Script')), len(self.scripts_lib)))
         for c in self.getrefs('Class'):
@@ -604,6 +1083,88 @@ class Snapshot:
         for a, code, b in zip(self.code_addrs, self.code_objs, self.code_addrs[1:]):
             assert a + len(code.x['instructions']['data']) < b  # code areas shouldn't overlap
 
+    @property
+    def strings(self):
+        ''' Dictionary from string value to String object. It's built on first access,
+            since it needs to decode all strings. '''
+        if self._strings is None:
+            self._strings = { ref.x['value']: ref for ref in self.strings_refs }
+            if len(self._strings) != len(self.strings_refs):
+                self.notice('There are {} duplicate strings.'.format(len(self.strings_refs) - len(self._strings)))
+        return self._strings
+
+    @property
+    def rodata_objects(self):
+        ''' List of (address, object) of the objects in rodata, or None if the snapshot
+            isn't parsed. It's built on first access, by reading the offsets in the alloc
+            sections of their clusters again. '''
+        if self._rodata_objects is None and hasattr(self, 'clusters'):
+            res, f = [], Reader(self.data.buf)
+            for cluster in self.clusters:
+                if 'alloc_offset' not in cluster: continue
+                f.seek(cluster['alloc_offset'])
+                shared = f.readuint()
+                for _ in range(shared): f.readuint()
+                running_offset = 0
+                for obj in cluster.get('refs', [])[shared:shared + f.readuint()]:
+                    running_offset += f.readuint() << self.kObjectAlignmentLog2
+                    res.append((self.rodata_offset + running_offset, obj))
+            self._rodata_objects = res
+        return self._rodata_objects
+
+    @property
+    def address_map(self):
+        ''' AddressMap of the objects with a known address (instructions of Code objects,
+            rodata objects...), built on first access. See the `addresses` module. '''
+        if self._address_map is None:
+            from .addresses import build_address_map
+            self._address_map = build_address_map(self)
+        return self._address_map
+
+    @property
+    def indexes(self):
+        ''' Indexes of the objects by library, owner, class and code, built on first
+            access. See the `indexes` module. '''
+        if self._indexes is None:
+            from .indexes import Indexes
+            self._indexes = Indexes(self)
+        return self._indexes
+
+    @property
+    def names(self):
+        ''' NameIndex of the qualified names of libraries, classes and members (using
+            deobfuscated names), built on first access. See the `names` module. Set
+            `_names` to None to rebuild it after changing `unob` names. '''
+        if self._names is None:
+            from .names import NameIndex
+            self._names = NameIndex(self)
+        return self._names
+
+    def get_classes(self, library):
+        ''' Classes of a Library '''
+        return self.indexes.classes(library)
+
+    def get_functions(self, owner, closures=False):
+        ''' Functions of a Library, Class or PatchClass (and its closures, if `closures` is
+            True), or closures of a Function '''
+        return self.indexes.functions(owner, closures)
+
+    def get_fields(self, owner):
+        ''' Fields of a Library, Class or PatchClass '''
+        return self.indexes.fields(owner)
+
+    def get_closures(self, owner):
+        ''' Closures inside a Library, Class or Function '''
+        return self.indexes.closures(owner)
+
+    def get_code(self, function):
+        ''' Code object of a Function, or None '''
+        return self.indexes.code(function)
+
+    def get_function(self, code):
+        ''' Function a Code object belongs to, or None (stubs...) '''
+        return self.indexes.function(code)
+
     def search_address(self, addr):
         '''
         Given a PC (instruction) address this returns (code, offset),
@@ -42,7 +42,6 @@ def init_base_objects(Ref, snapshot, includes_code):
     entries = make_base_entries(includes_code)
     get_data = lambda e: { 'type': e[1], 'value': e[2], **(e[3] if len(e) > 3 else {}) }
     # ref 0 is illegal
-    snapshot.refs = { i+1: Ref(snapshot, i+1, tmp_cluster, get_data(entry))
-        for i, entry in enumerate(entries) }
-    snapshot.refs['next'] = len(entries) + 1
+    snapshot.objects = [None] + [ Ref(snapshot, i+1, tmp_cluster, get_data(entry))
+        for i, entry in enumerate(entries) ]
     snapshot.base_clusters = []
@@ -0,0 +1,255 @@
+# DEOBFUSCATE: Recovers obfuscated names, by matching a snapshot against a reference one
+
+import hashlib
+from array import array
+from collections import Counter
+
+from .core import VMObject
+from .indexes import owner_class
+from .asm.base import mask_pc_relative
+from .read import has_numpy
+if has_numpy: import numpy as np
+
+# Names the obfuscator leaves untouched
+SPECIAL_NAMES = { '::', '<anonymous closure>' }
+ACCESSOR_PREFIXES = ( 'get:', 'set:' )
+
+# Bits of each instruction word kept for its shape (opcode, roughly; immediates of PC-relative
+# instructions are masked first), per arch; other archs don't have fixed-size instructions,
+# so only the length is used
+SHAPE_SHIFTS = { 'arm64': 22, 'arm': 20 }
+
+
+def name_string(obj):
+    ''' String object holding the name of a Library (its URL), Class, Function or Field '''
+    name = obj.x.get('url' if obj.is_cid('Library') else 'name')
+    if isinstance(name, VMObject) and name.is_string() and not name.is_placeholder() and 'value' in name.x:
+        return name
+
+def instruction_shape(arch, code):
+    ''' Hash of the instructions of a Code object, with the operands masked out: pool
+        offsets, branch targets, etc. change between builds (and with the layout) '''
+    instr = code.x.get('instructions') if isinstance(code, VMObject) and code.is_cid('Code') else None
+    if not instr or 'data' not in instr: return None
+    data, shift = instr['data'], SHAPE_SHIFTS.get(arch.split('-')[0])
+    if shift is None: return len(data)
+    data = mask_pc_relative(arch, data)
+    if has_numpy:
+        words = (np.frombuffer(data, '<u4') >> shift).astype('<u2').tobytes()
+    else:
+        words = array('H', (w >> shift for w in array('I', data))).tobytes()
+    return hashlib.blake2b(words, digest_size=8).digest()
+
+
+class SnapshotFeatures:
+    '''
+    Structural features of the Libraries, Classes, Functions and Fields of a snapshot,
+    and their fingerprints (hashes of these features, combined bottom-up):
+
+     - functions: kind_tag, packed_fields (which hold the parameter counts and flags),
+       number of parameter names, instruction shape, non-identifier strings and
+       constants loaded by the code; then refined with the fingerprints of the
+       functions it calls / references (in order), `rounds` times
+     - fields: kind_bits and offset (or static value kind)
+     - classes: instance layout, plus the sorted fingerprints of their members
+     - libraries: the sorted fingerprints of their classes
+    '''
+
+    def __init__(self, s, identifiers, rounds=3):
+        self.s = s
+        ix = s.indexes
+        self.functions = [ f for f in s.getrefs('Function') if not f.is_placeholder() ]
+        self.fields = [ f for f in s.getrefs('Field') if not f.is_placeholder() ]
+        self.classes = [ c for c in s.getrefs('Class') if not c.is_placeholder() and 'name' in c.x ]
+        self.libraries = [ l for l in s.getrefs('Library') if not l.is_placeholder() ]
+
+        # references from the code of each function
+        self.callees, local = {}, {}
+        for f in self.functions:
+            code = ix.code(f)
+            strings, constants, callees = [], [], []
+            for target, *_ in (code.x.get('nrefs', []) if code is not None else []):
+                if target.is_placeholder(): continue
+                if target.is_cid('Code'): target = ix.function(target)
+                if target is None: continue
+                if target.is_cid('Function'):
+                    callees.append(target)
+                elif target.is_string():
+                    value = target.x['value']
+                    if value not in identifiers: strings.append(value)
+                elif target.is_cid('Mint', 'Double'):
+                    constants.append(target.x['value'])
+            self.callees[f] = callees
+            params = f.x.get('parameter_names')
+            params = len(params.x['value']) if isinstance(params, VMObject) and params.is_array() and \
+                not params.is_placeholder() else None
+            local[f] = hash((f.x.get('kind_tag'), f.x.get('packed_fields'), params, bool(ix.function_closures.get(f)),
+                instruction_shape(s.arch, code), tuple(sorted(strings)), tuple(sorted(constants, key=repr)), len(callees)))
+        self.local = dict(local)
+
+        # refine with the fingerprints of the callees
+        fp = local
+        for _ in range(rounds):
+            fp = { f: hash((h, tuple(fp[c] for c in self.callees[f] if c in fp))) for f, h in fp.items() }
+        self.fp = fp
+
+        for f in self.fields:
+            v = f.x.get('value')
+            v = v.x['value'] if isinstance(v, VMObject) and v.is_cid('Mint') and not v.is_placeholder() else \
+                v.cluster['cid'] if isinstance(v, VMObject) else None
+            self.local[f] = self.fp[f] = hash((f.x.get('kind_bits'), v))
+
+        for c in self.classes:
+            members = ix.class_functions.get(c, []) + ix.class_fields.get(c, []) + ix.class_closures.get(c, [])
+            self.local[c] = hash((c.x.get('instance_size_in_words'), c.x.get('next_field_offset_in_words'),
+                c.x.get('num_type_arguments'), len(ix.class_functions.get(c, [])), len(ix.class_fields.get(c, []))))
+            self.fp[c] = hash((self.local[c], tuple(sorted(self.fp[m] for m in members if m in self.fp))))
+
+        for l in self.libraries:
+            classes = ix.library_classes.get(l, [])
+            self.local[l] = hash(len(classes))
+            self.fp[l] = hash((self.local[l], tuple(sorted(self.fp[c] for c in classes if c in self.fp))))
+
+
+def unique_pairs(targets, references, key):
+    ''' Pairs the objects that are the only ones with their key, on both sides '''
+    buckets = {}
+    for side, objs in enumerate((targets, references)):
+        for obj in objs:
+            k = key(side, obj)
+            if k is None: continue
+            bucket = buckets.setdefault(k, ([], []))
+            bucket[side].append(obj)
+    return [ (t[0], r[0]) for t, r in buckets.values() if len(t) == 1 and len(r) == 1 ]
+
+
+class Matcher:
+    '''
+    Matches the Libraries, Classes, Functions and Fields of a `target` (obfuscated)
+    snapshot to those of a `reference` one (built from the same code, without
+    obfuscation), using their structural fingerprints (see SnapshotFeatures):
+
+     1. Objects whose fingerprint is unique in both snapshots are matched.
+     2. Matches are propagated: a matched function matches its class, closures and
+        callees; a matched class matches its library and members; a matched library
+        matches its classes. Each time, the candidates are bucketed by fingerprint
+        (or local features, which is less strict) and unique ones are matched.
+
+    Everything is done with hash buckets, so it takes near-linear time. The code of
+    both snapshots should be analyzed (see populate_native_references) for the best
+    results; if it isn't, it's done here (for the supported archs).
+
+    `matches` maps target objects to reference objects; `names` maps obfuscated
+    names to the recovered ones. apply() writes them into the `unob` field of the
+    target strings, which is what `unob_string` and the name index use.
+    '''
+
+    def __init__(self, target, reference, rounds=3, analyze=True):
+        self.target, self.reference = target, reference
+        if analyze:
+            from .asm.base import populate_native_references
+            for s in (target, reference):
+                if s.arch.split('-')[0] in SHAPE_SHIFTS and any('nrefs' not in c.x for c in s.getrefs('Code')
+                    if c.is_own() and not c.is_placeholder()):
+                    populate_native_references(s)
+
+        # strings that are names of something are excluded from features (they're obfuscated)
+        identifiers = set()
+        for s in (target, reference):
+            for cid in ('Library', 'Class', 'Function', 'Field'):
+                for obj in s.getrefs(cid):
+                    name = None if obj.is_placeholder() else name_string(obj)
+                    if name is not None: identifiers.add(name.x['value'])
+        self.features = [ SnapshotFeatures(s, identifiers, rounds) for s in (target, reference) ]
+        self.matches, self.matched = {}, set()
+        self.run()
+        self.names = self.recover_names()
+
+    def add(self, t, r, pending):
+        if t in self.matches or r in self.matched: return
+        if t.cluster['handler'] != r.cluster['handler']: return
+        self.matches[t] = r
+        self.matched.add(r)
+        pending.append((t, r))
+
+    def match(self, targets, references, pending, exact=True):
+        ''' Matches the unmatched objects with a unique fingerprint (or local features) '''
+        targets = [ t for t in targets if t not in self.matches ]
+        references = [ r for r in references if r not in self.matched ]
+        if not targets or not references: return
+        tables = [ f.fp if exact else f.local for f in self.features ]
+        key = lambda side, obj: tables[side].get(obj)
+        for t, r in unique_pairs(targets, references, key):
+            self.add(t, r, pending)
+
+    def run(self):
+        tf, rf = self.features
+        pending = []
+        for name in ('libraries', 'classes', 'functions', 'fields'):
+            self.match(getattr(tf, name), getattr(rf, name), pending)
+
+        tix, rix = self.target.indexes, self.reference.indexes
+        while pending:
+            t, r = pending.pop()
+            if t.is_cid('Function'):
+                tc, rc = owner_class(t.x['owner']), owner_class(r.x['owner'])
+                if tc is not None and rc is not None: self.add(tc, rc, pending)
+                for exact in (True, False):
+                    self.match(tix.function_closures.get(t, []), rix.function_closures.get(r, []), pending, exact)
+                tcallees, rcallees = tf.callees.get(t, []), rf.callees.get(r, [])
+                if len(tcallees) == len(rcallees):
+                    for tc, rc in zip(tcallees, rcallees):
+                        if tf.local.get(tc) == rf.local.get(rc): self.add(tc, rc, pending)
+            elif t.is_cid('Class'):
+                tl, rl = t.x['library'], r.x['library']
+                if tl.is_cid('Library') and rl.is_cid('Library'): self.add(tl, rl, pending)
+                for exact in (True, False):
+                    self.match(tix.class_functions.get(t, []), rix.class_functions.get(r, []), pending, exact)
+                    self.match(tix.class_fields.get(t, []), rix.class_fields.get(r, []), pending, exact)
+                    self.match(tix.class_closures.get(t, []), rix.class_closures.get(r, []), pending, exact)
+            elif t.is_cid('Library'):
+                for exact in (True, False):
+                    self.match(tix.library_classes.get(t, []), rix.library_classes.get(r, []), pending, exact)
+
+    def recover_names(self):
+        ''' Returns a dictionary from obfuscated name to recovered name, decided by majority
+            among the matches (names are obfuscated per string, so they must agree) '''
+        votes = {}
+        for t, r in self.matches.items():
+            tname, rname = name_string(t), name_string(r)
+            if tname is None or rname is None: continue
+            obf, real = tname.x['value'], rname.x['value']
+            if obf in SPECIAL_NAMES or obf == real: continue
+            votes.setdefault(obf, Counter())[real] += 1
+            for prefix in ACCESSOR_PREFIXES:
+                # accessors keep their prefix, so their base name is known too
+                if obf.startswith(prefix) and real.startswith(prefix):
+                    votes.setdefault(obf[len(prefix):], Counter())[real[len(prefix):]] += 1
+        names = {}
+        for obf, counter in votes.items():
+            (real, n), *rest = counter.most_common(2)
+            if not rest or rest[0][1] < n: names[obf] = real
+        return names
+
+    def apply(self):
+        ''' Writes the recovered names into the `unob` field of the target strings (every
+            string with an obfuscated name gets it), returns the number of strings changed '''
+        count = 0
+        for string in self.target.strings_refs:
+            value = string.x['value']
+            prefix = next((p for p in ACCESSOR_PREFIXES if value.startswith(p)), '')
+            real = self.names.get(value)
+            if real is None and prefix and value[len(prefix):] in self.names:
+                real = prefix + self.names[value[len(prefix):]]
+            if real is not None and string.x.get('unob') != real:
+                string.x['unob'] = real
+                count += 1
+        self.target._names = None # (the name index uses unob)
+        return count
+
+def deobfuscate(target, reference, rounds=3, analyze=True):
+    ''' Matches `target` against `reference` (see Matcher), writes the recovered names
+        into `target`, and returns the Matcher '''
+    matcher = Matcher(target, reference, rounds, analyze)
+    matcher.apply()
+    return matcher
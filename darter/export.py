@@ -0,0 +1,216 @@
+# EXPORT: Dumps a parsed snapshot into other formats, for querying it without darter
+
+import os
+import json
+import sqlite3
+from base64 import b64encode
+from collections import defaultdict
+from itertools import islice, chain
+
+from .constants import kKind
+from .core import VMObject, format_cid, unob_string
+
+
+# SIMPLE EXPORTS #
+
+def snapshot_summary(s):
+    ''' Returns a JSON-serializable dictionary with an overview of the snapshot '''
+    code = s.getrefs('Code')
+    return {
+        'arch': s.arch,
+        'version': s.version,
+        'kind': kKind[s.kind][0],
+        'features': s.features,
+        'base_objects': s.num_base_objects,
+        'objects': len(s.objects) - 1,
+        'clusters': { name: len(refs) for name, refs in sorted(s.clrefs.items()) },
+        'libraries': sorted( name_of(l.x['url']) or '' for l in s.getrefs('Library') ),
+        'strings': len(s.strings_refs),
+        'code_size': sum( len(c.x['instructions']['data']) for c in code
+            if c.x['instructions'] and 'data' in c.x['instructions'] ),
+        'native_refs': sum( len(c.x['nrefs']) for c in code if 'nrefs' in c.x ) if s.nrefs_populated else None,
+    }
+
+def export_summary(s, f):
+    ''' Writes snapshot_summary() as JSON to `f` '''
+    json.dump(snapshot_summary(s), f, indent=2)
+
+def export_strings(s, f):
+    ''' Writes the value of every string in the snapshot to `f`, one per line (JSON encoded) '''
+    for r in s.strings_refs:
+        if 'value' in r.x: print(json.dumps(r.x['value'], ensure_ascii=False), file=f)
+
+def export_r2_metadata(s, f):
+    ''' Writes R2 metadata to `f`: a flag for every Code object (named `c_<ref>`) with its
+        location as comment, plus comments on every object load (requires populated native references) '''
+    do_b64 = lambda x: 'base64:' + b64encode(x.encode('utf-8')).decode('ascii')
+    comments = defaultdict(lambda: [])
+    print('fs functions', file=f)
+    for code in s.getrefs('Code'):
+        instr = code.x['instructions']
+        name = 'c_{}'.format(code.ref)
+        comment = ' '.join(map(str, code.locate()))
+        print('f {name} {len} {addr} {c}'.format( name=name, len=len(instr['data']), addr=instr['data_addr'], c=do_b64(comment) ), file=f)
+        for target, pc, kind, *args in code.x.get('nrefs', []):
+            if kind == 'load':
+                comments[pc].append( 'load: {reg} = {tg}'.format(tg=target.describe(), reg=args[0]) )
+    for addr, lines in comments.items():
+        print('CCu {} @ {}'.format( do_b64("\n".join(lines)), addr ), file=f)
+
+
+# SQLITE #
+
+SQLITE_SCHEMA = '''
+CREATE TABLE info (key TEXT PRIMARY KEY, value);
+CREATE TABLE objects (ref INTEGER PRIMARY KEY, cid INTEGER, kind TEXT, cluster INTEGER);
+CREATE TABLE strings (ref INTEGER PRIMARY KEY, value TEXT, unob TEXT);
+CREATE TABLE libraries (ref INTEGER PRIMARY KEY, name TEXT, url TEXT);
+CREATE TABLE classes (ref INTEGER PRIMARY KEY, cid INTEGER, name TEXT, library INTEGER);
+CREATE TABLE functions (ref INTEGER PRIMARY KEY, name TEXT, owner INTEGER, class INTEGER, library INTEGER, parent INTEGER, code INTEGER);
+CREATE TABLE fields (ref INTEGER PRIMARY KEY, name TEXT, owner INTEGER, class INTEGER, library INTEGER);
+CREATE TABLE code_ranges (code INTEGER PRIMARY KEY, start INTEGER, end INTEGER, owner INTEGER);
+CREATE TABLE edges (src INTEGER, dst INTEGER, field TEXT, idx INTEGER);
+CREATE TABLE native_refs (code INTEGER, address INTEGER, kind TEXT, target INTEGER, arg);
+'''
+
+SQLITE_INDEXES = [
+    ('objects', 'cid'), ('objects', 'kind'), ('strings', 'value'), ('libraries', 'url'),
+    ('classes', 'name'), ('classes', 'library'), ('classes', 'cid'),
+    ('functions', 'name'), ('functions', 'owner'), ('functions', 'class'), ('functions', 'library'), ('functions', 'code'),
+    ('fields', 'name'), ('fields', 'owner'), ('fields', 'class'), ('fields', 'library'),
+    ('code_ranges', 'start'), ('edges', 'dst'), ('edges', 'src'),
+    ('native_refs', 'code'), ('native_refs', 'target'), ('native_refs', 'address'),
+]
+
+def ref_of(obj):
+    ''' Ref number of an object, or None if it's not a (regular) object '''
+    return obj.ref if isinstance(obj, VMObject) and type(obj.ref) is int else None
+
+def name_of(obj):
+    ''' Value of a string object (deobfuscated if possible), or None if it's not a string '''
+    return unob_string(obj) if isinstance(obj, VMObject) and obj.is_string() and 'value' in obj.x else None
+
+def class_of(obj):
+    ''' Resolves the owner of a function / field to its class (PatchClass are followed) '''
+    if isinstance(obj, VMObject) and obj.is_cid('PatchClass'):
+        obj = obj.x['patched_class']
+    return obj if isinstance(obj, VMObject) and obj.is_cid('Class') else None
+
+def library_of(cls):
+    lib = cls.x.get('library') if cls is not None else None
+    return ref_of(lib) if isinstance(lib, VMObject) and lib.is_cid('Library') else None
+
+def split_source(source):
+    ''' Splits a back-reference into (src ref, field, index). The field is made of the
+        names in its path (joined by dots), and the index is the first int in it, if any. '''
+    obj, path, index = source[0], source[1:], None
+    names = []
+    for p in path:
+        if type(p) is int and index is None: index = p
+        else: names.append(str(p))
+    return ref_of(obj), '.'.join(names), index
+
+def sqlite_rows(s):
+    ''' Returns a dictionary from table name to an iterator of its rows '''
+    objects = s.objects
+    clusters = { id(c): n for n, c in enumerate(s.base_clusters + s.clusters) }
+    getrefs = s.getrefs if hasattr(s, 'clrefs') else \
+        lambda name: [ r for r in objects[1:] if format_cid(r.cluster['cid']) == name ]
+
+    def info():
+        yield from [ ('arch', s.arch), ('version', s.version), ('kind', str(s.kind)), ('features', ' '.join(
+            k if v else 'no-' + k for k, v in s.features.items())), ('num_base_objects', s.num_base_objects), ('num_objects', s.num_objects) ]
+    def objects_rows():
+        for r in objects[1:]:
+            cid = r.cluster['cid']
+            kind = r.x['type'] if r.is_baseobject() else format_cid(cid)
+            yield r.ref, cid if type(cid) is int else None, kind, clusters.get(id(r.cluster))
+    def strings():
+        for r in chain(getrefs('OneByteString'), getrefs('TwoByteString')):
+            if 'value' in r.x: yield r.ref, r.x['value'], r.x.get('unob')
+    def libraries():
+        for r in getrefs('Library'):
+            yield r.ref, name_of(r.x['name']), name_of(r.x['url'])
+    def classes():
+        for r in objects[1:]:
+            if r.is_baseobject() and r.x['type'] == 'Class':
+                yield r.ref, r.x['cid'], r.x['value'], None
+            elif r.is_cid('Class'):
+                yield r.ref, r.x['cid'], name_of(r.x['name']), library_of(r)
+    def functions():
+        for r in getrefs('Function'):
+            x = r.x
+            cls = class_of(x['owner'])
+            data = x.get('data')
+            parent = data.x['parent_function'] if isinstance(data, VMObject) and data.is_cid('ClosureData') else None
+            code = x.get('code')
+            yield r.ref, name_of(x['name']), ref_of(x['owner']), ref_of(cls), library_of(cls), ref_of(parent), \
+                ref_of(code) if isinstance(code, VMObject) and code.is_cid('Code') else None
+    def fields():
+        for r in getrefs('Field'):
+            cls = class_of(r.x['owner'])
+            yield r.ref, name_of(r.x['name']), ref_of(r.x['owner']), ref_of(cls), library_of(cls)
+    def code_ranges():
+        for r in getrefs('Code'):
+            instr = r.x['instructions']
+            if instr and 'data_addr' in instr:
+                yield r.ref, instr['data_addr'], instr['data_addr'] + len(instr['data']), ref_of(r.x['owner'])
+    def edges():
+        for r in objects[1:]:
+            for source in r.src:
+                src, field, index = split_source(source)
+                yield src, r.ref, field, index
+    def native_refs():
+        for r in getrefs('Code'):
+            for target, address, kind, *rest in r.x.get('nrefs', []):
+                yield r.ref, address, kind, ref_of(target), rest[0] if rest else None
+
+    return {
+        'info': info(), 'objects': objects_rows(), 'strings': strings(), 'libraries': libraries(),
+        'classes': classes(), 'functions': functions(), 'fields': fields(), 'code_ranges': code_ranges(),
+        'edges': edges(), 'native_refs': native_refs(),
+    }
+
+def export_sqlite(s, path, batch_size=10000):
+    '''
+    Exports a parsed snapshot into a new SQLite database at `path` (overwriting it), with
+    these tables:
+
+     - `info`: snapshot header information (arch, version, features...)
+     - `objects`: every object with its `cid` (NULL for base objects), `kind` (name of the
+       class or base object type) and `cluster` (index into base_clusters + clusters).
+     - `strings`, `libraries`, `classes`, `functions`, `fields`: the main objects and their
+       names (deobfuscated, if `unob` is set). Functions and fields have their `owner`,
+       and the `class` and `library` it resolves to.
+     - `code_ranges`: address range (`start` to `end`, exclusive) of each Code object.
+     - `edges`: references between objects (from back-references). `src` is NULL if the
+       reference is from the root object; `field` is the field name (like `entries.raw_obj`)
+       and `idx` is the index in the field, if any.
+     - `native_refs`: native references, if they were populated (see populate_native_references).
+       `arg` is the register name for loads, and the offset into the target for calls.
+
+    Every object column holds a ref number. Rows are inserted in batches of `batch_size`,
+    all in a single transaction, and indexes are created at the end.
+    Returns a dictionary with the number of rows of each table.
+    '''
+    if os.path.exists(path): os.remove(path)
+    con = sqlite3.connect(path, isolation_level=None)
+    counts = {}
+    try:
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        con.execute('BEGIN')
+        for statement in SQLITE_SCHEMA.split(';')[:-1]: con.execute(statement)
+        for table, rows in sqlite_rows(s).items():
+            counts[table] = 0
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch: break
+                con.executemany('INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * len(batch[0]))), batch)
+                counts[table] += len(batch)
+        for table, column in SQLITE_INDEXES:
+            con.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(table, column))
+        con.execute('COMMIT')
+    finally:
+        con.close()
+    return counts
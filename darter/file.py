@@ -1,6 +1,7 @@
 # FILE: Stores top level logic to unwrap blobs from a snapshot file and parse them
 
-from struct import unpack
+from struct import unpack_from
+import mmap
 
 from .constants import kAppAOTSymbols, kAppJITMagic, kAppSnapshotPageSize
 from .core import Snapshot
@@ -14,73 +15,105 @@ except ImportError as e:
     pass
 
 
-def parse_elf_snapshot(fname, **kwargs):
+def map_file(fname):
+    ''' Maps a whole file into memory (read-only), returns a memoryview of it.
+        Slices of it can be passed to Snapshot without copying any data; the
+        mapping is released once the last view referencing it is gone. '''
+    with open(fname, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def parse_elf_snapshot(fname, image=None, **kwargs):
     ''' Open and parse an ELF (executable) AppAOT snapshot. Note that the reported
         offsets are virtual addresses, not physical ones. Returns isolate snapshot.
+        If `image` is passed, the snapshot is loaded from that image file if it's
+        up to date; otherwise it's parsed and then saved there (see Snapshot.load_image).
         NOTE: This method requires pyelftools '''
     log = lambda n, x: print(x) if kwargs.get('print_level', 3) >= n else None
     if not has_elftools:
         raise Exception('pyelftools not found, install it to use this method')
 
     # Open file, obtain symbols
-    f = ELFFile(open(fname, 'rb'))
-    sections = list(f.iter_sections())
-    tables = [ s for s in sections if isinstance(s, SymbolTableSection) ]
-    symbols = { sym.name: sym.entry for table in tables for sym in table.iter_symbols() }
+    with open(fname, 'rb') as fd:
+        f = ELFFile(fd)
+        sections = [ (S['sh_addr'], S['sh_offset'], S.data_size) for S in f.iter_sections() ]
+        tables = [ s for s in f.iter_sections() if isinstance(s, SymbolTableSection) ]
+        symbols = { sym.name: sym.entry for table in tables for sym in table.iter_symbols() }
+        machine, elfclass = f['e_machine'], f.elfclass
+    data = map_file(fname)
 
-    # Extract blobs
+    # Extract blobs (as views of the mapped file)
     blobs, offsets = [], []
     for s in kAppAOTSymbols:
         s = symbols[s]
-        section = next(S for S in sections if 0 <= s.st_value - S['sh_addr'] < S.data_size)
-        blob = section.data()[(s.st_value - section['sh_addr']):][:s.st_size]
+        addr, offset, _ = next(S for S in sections if 0 <= s.st_value - S[0] < S[2])
+        start = offset + (s.st_value - addr)
+        blob = data[start:start + s.st_size]
         assert len(blob) == s.st_size
         blobs.append(blob), offsets.append(s.st_value)
 
     # Parse VM snapshot, then isolate snapshot
-    log(3, '------- PARSING VM SNAPSHOT --------\n')
     base = Snapshot(data=blobs[0], data_offset=offsets[0],
                     instructions=blobs[1], instructions_offset=offsets[1],
-                    vm=True, **kwargs).parse()
-    log(3, '\n------- PARSING ISOLATE SNAPSHOT --------\n')
+                    vm=True, **kwargs)
     res = Snapshot(data=blobs[2], data_offset=offsets[2],
                     instructions=blobs[3], instructions_offset=offsets[3],
-                    base=base, **kwargs).parse()
+                    base=base, **kwargs)
+    if image and res.load_image(image):
+        log(3, 'Loaded parsed snapshot from {}'.format(image))
+    else:
+        log(3, '------- PARSING VM SNAPSHOT --------\n')
+        base.parse()
+        log(3, '\n------- PARSING ISOLATE SNAPSHOT --------\n')
+        res.parse()
+        if image: res.save_image(image)
 
     archs = { 'EM_386': 'ia32', 'EM_X86_64': 'x64', 'EM_ARM': 'arm', 'EM_AARCH64': 'arm64' }
-    if archs.get(f['e_machine']) != res.arch.split('-')[0] or (f.elfclass == 64) != res.is_64:
-        log(1, 'WARN: ELF arch ({}) and/or class ({}) not matching snapshot'.format(f['e_machine'], f.elfclass))
+    if archs.get(machine) != res.arch.split('-')[0] or (elfclass == 64) != res.is_64:
+        log(1, 'WARN: ELF arch ({}) and/or class ({}) not matching snapshot'.format(machine, elfclass))
     return res
 
-def parse_appjit_snapshot(fname, base=None, **kwargs):
-    ''' Open and parse an AppJIT snapshot file. Returns isolate snapshot. '''
+def parse_appjit_snapshot(fname, base=None, image=None, **kwargs):
+    ''' Open and parse an AppJIT snapshot file. Returns isolate snapshot.
+        `image` works like in parse_elf_snapshot(). '''
     log = lambda n, x: print(x) if kwargs.get('print_level', 3) >= n else None
 
     # Read header, check magic
-    f = open(fname, 'rb')
-    magic = unpack('<Q', f.read(8))[0]
+    data = map_file(fname)
+    magic = unpack_from('<Q', data, 0)[0]
     if magic != kAppJITMagic:
         log(1, "WARN: Magic not matching, got 0x{:016x}".format(magic))
-    lengths = unpack('<qqqq', f.read(4 * 8))
+    lengths = unpack_from('<qqqq', data, 8)
 
-    # Extract blobs
+    # Extract blobs (as views of the mapped file)
     blobs, offsets = [], []
+    pos = 8 + 4 * 8
     for length in lengths:
-        f.seek( ((f.tell() - 1) // kAppSnapshotPageSize + 1) * kAppSnapshotPageSize )
-        offsets.append(f.tell())
-        blobs.append(f.read(length))
+        pos = ((pos - 1) // kAppSnapshotPageSize + 1) * kAppSnapshotPageSize
+        offsets.append(pos)
+        blobs.append(data[pos:pos + length])
+        pos += len(blobs[-1])
 
     # Parse VM snapshot if present, then isolate snapshot
+    vm = None
     if blobs[0]:
-        log(3, '\n------- PARSING VM SNAPSHOT --------\n')
-        base = Snapshot(data=blobs[0], data_offset=offsets[0],
+        base = vm = Snapshot(data=blobs[0], data_offset=offsets[0],
                         instructions=blobs[1], instructions_offset=offsets[1],
-                        vm=True, **kwargs).parse()
+                        vm=True, **kwargs)
     else:
-        log(3, 'No base snapshot, skipping base snapshot parsing...')
         assert not lengths[1]
+    res = Snapshot(data=blobs[2], data_offset=offsets[2],
+                    instructions=blobs[3], instructions_offset=offsets[3],
+                    base=base, **kwargs)
+    if image and res.load_image(image):
+        log(3, 'Loaded parsed snapshot from {}'.format(image))
+        return res
 
+    if vm:
+        log(3, '\n------- PARSING VM SNAPSHOT --------\n')
+        vm.parse()
+    else:
+        log(3, 'No base snapshot, skipping base snapshot parsing...')
     log(3, '\n------- PARSING ISOLATE SNAPSHOT --------\n')
-    return Snapshot(data=blobs[2], data_offset=offsets[2],
-                    instructions=blobs[3], instructions_offset=offsets[3],
-                    base=base, **kwargs).parse()
+    res.parse()
+    if image: res.save_image(image)
+    return res
@@ -0,0 +1,373 @@
+# IMAGE: Compact binary image of a parsed snapshot, which can be reloaded instantly (used by CORE)
+
+import hashlib
+import mmap
+import os
+import sys
+from array import array
+from operator import itemgetter
+from struct import pack, unpack_from, calcsize
+from sys import intern
+
+from .core import VMObject
+
+IMAGE_MAGIC = b'DARTERIM'
+IMAGE_VERSION = 3
+
+# Layout: header, then a table of sections (offset, size), each one aligned to 8 bytes
+IMAGE_HEADER = '<8sI32sI'
+IMAGE_SECTIONS = [
+    'meta',                                                     # snapshot attributes, tables, clusters
+    'string_offsets', 'strings',                                # string pool (UTF-8)
+    'object_clusters', 'object_shapes', 'object_offsets',       # object table
+    'records',                                                  # encoded data of each object
+    'nsrc',                                                     # native back-references, if populated
+    'edge_offsets', 'edge_src', 'edge_fields', 'edge_indexes',  # back-references (CSR)
+]
+
+# Parser options and attributes that are stored in the image (if present)
+IMAGE_OPTIONS = [ 'vm', 'data_offset', 'instructions_offset', 'strict', 'parse_rodata', 'parse_csm', 'do_build_tables', 'backrefs', 'materialize' ]
+IMAGE_ATTRS = [
+    'magic_value', 'length', 'kind', 'includes_code', 'includes_bytecode', 'rodata_offset', 'version', 'features',
+    'num_base_objects', 'num_objects', 'num_clusters', 'code_order_length',
+    'arch', 'is_64', 'is_debug', 'is_product', 'is_precompiled', 'kObjectAlignmentLog2', 'raw_instance_size_in_words',
+    'classes', 'clrefs', 'strings_refs', 'scripts_lib', 'entry_points', 'code_objs', 'code_addrs', 'nrefs_populated',
+]
+
+# Value encoding: a tag byte followed by its payload. Unsigned ints are LEB128.
+(T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_BYTES, T_VIEW,
+    T_OBJECT, T_LIST, T_TUPLE, T_DICT, T_OBJECTS) = b'NTFIDSbvOLUMP'
+
+def write_uleb128(out, x):
+    while x >= 0x80:
+        out.append((x & 0x7F) | 0x80)
+        x >>= 7
+    out.append(x)
+
+def image_key(s):
+    ''' Hash of the input blobs and parser options of a snapshot (and its base) '''
+    h = hashlib.sha256(repr((IMAGE_VERSION, [ getattr(s, k) for k in IMAGE_OPTIONS ])).encode())
+    for blob in s.blobs:
+        h.update(b'\0' if blob is None else pack('<Q', len(blob)))
+        if blob is not None: h.update(blob)
+    if s.base is not None:
+        h.update(image_key(s.base))
+    return h.digest()
+
+
+# WRITING #
+
+class ImageWriter:
+    def __init__(self, s):
+        self.s = s
+        self.objects = s.objects
+        self.extras, self.extra_ids = [], {}    # objects without a (valid) ref: roots, foreign objects
+        self.strings, self.string_ids = [], {}
+        self.shapes, self.shape_ids = [], {}
+        self.clusters, self.cluster_ids = [], {}
+        self.templates, self.template_ids = [], {}
+
+    def intern_value(self, table, ids, value, key=None):
+        ''' Returns index of `value` in `table`, appending it if needed '''
+        if key is None: key = value
+        n = ids.get(key)
+        if n is None:
+            n = ids[key] = len(table)
+            table.append(value)
+        return n
+
+    def object_id(self, obj):
+        ''' Objects are identified by their ref; extra objects get IDs after the last ref '''
+        ref, objects = obj.ref, self.objects
+        if type(ref) is int and 0 < ref < len(objects) and objects[ref] is obj:
+            return ref
+        return len(objects) + self.intern_value(self.extras, self.extra_ids, obj, id(obj))
+
+    def encode(self, out, v):
+        t = type(v)
+        if v is None: out.append(T_NONE)
+        elif v is True: out.append(T_TRUE)
+        elif v is False: out.append(T_FALSE)
+        elif t is VMObject:
+            out.append(T_OBJECT)
+            write_uleb128(out, self.object_id(v))
+        elif t is str:
+            out.append(T_STR)
+            write_uleb128(out, self.intern_value(self.strings, self.string_ids, v))
+        elif isinstance(v, int):
+            out.append(T_INT)
+            write_uleb128(out, v << 1 if v >= 0 else ((-v - 1) << 1) | 1)
+        elif t is float:
+            out.append(T_FLOAT)
+            out += pack('<d', v)
+        elif t is memoryview or isinstance(v, (bytes, bytearray)):
+            v = memoryview(v).cast('B')
+            out.append(T_VIEW if t is memoryview else T_BYTES)
+            write_uleb128(out, len(v))
+            out += v
+        elif t is list and len(v) > 1 and all(type(x) is VMObject for x in v):
+            out.append(T_OBJECTS)
+            write_uleb128(out, len(v))
+            out += array('I', map(self.object_id, v)).tobytes()
+        elif t is list or t is tuple:
+            out.append(T_LIST if t is list else T_TUPLE)
+            write_uleb128(out, len(v))
+            for x in v: self.encode(out, x)
+        elif isinstance(v, dict):
+            out.append(T_DICT)
+            write_uleb128(out, len(v))
+            for k, x in v.items():
+                self.encode(out, k)
+                self.encode(out, x)
+        else:
+            raise TypeError('Value of type {} cannot be stored in an image'.format(t.__name__))
+
+    def encode_source(self, source):
+        ''' Encodes a back-reference like Snapshot.record_edges() does, returns (src, field, index) '''
+        obj, path, index = source[0], source[1:], -1
+        for i, p in enumerate(path):
+            if type(p) is int:
+                index, path = p, path[:i] + (None,) + path[i+1:]
+                break
+        sid = self.object_id(obj)
+        if sid >= len(self.objects): sid = len(self.objects) - sid
+        return sid, self.intern_value(self.templates, self.template_ids, path), index
+
+    def write(self, path):
+        s, objects = self.s, self.objects
+        with_edges, with_nsrc = bool(s.backrefs), s.nrefs_populated
+
+        # Snapshot attributes and cluster lists, encoded first so that objects are numbered
+        attrs = { k: getattr(s, k) for k in IMAGE_OPTIONS + IMAGE_ATTRS if hasattr(s, k) }
+        attrs['root'] = s.root
+        attrs_out = bytearray()
+        self.encode(attrs_out, attrs)
+        cluster_id = lambda c: self.intern_value(self.clusters, self.cluster_ids, c, id(c))
+        clusters, base_clusters = list(map(cluster_id, s.clusters)), list(map(cluster_id, s.base_clusters))
+
+        # Objects and their back-references. Extra objects and clusters can be found
+        # while encoding, so loop until all of them are done
+        object_clusters, object_shapes, object_offsets = array('i', [-1]), array('i', [-1]), array('Q', [0, 0])
+        records, nsrc, nsrc_count = bytearray(), bytearray(), 0
+        edge_offsets, edge_src, edge_fields, edge_indexes = array('q', [0, 0]), array('i'), array('i'), array('i')
+        clusters_out, n = [], 1
+        while n < len(objects) + len(self.extras) or len(clusters_out) < len(self.clusters):
+            while n < len(objects) + len(self.extras):
+                obj = objects[n] if n < len(objects) else self.extras[n - len(objects)]
+                object_clusters.append(cluster_id(obj.cluster))
+                x = obj.x
+                shape = tuple(x.keys())
+                object_shapes.append(self.intern_value(self.shapes, self.shape_ids, shape))
+                for k in shape: self.encode(records, x[k])
+                object_offsets.append(len(records))
+                if with_nsrc and obj.nsrc:
+                    write_uleb128(nsrc, n)
+                    self.encode(nsrc, obj.nsrc)
+                    nsrc_count += 1
+                if with_edges:
+                    for source in obj.src:
+                        sid, field, index = self.encode_source(source)
+                        edge_src.append(sid), edge_fields.append(field), edge_indexes.append(index)
+                edge_offsets.append(len(edge_src))
+                n += 1
+            while len(clusters_out) < len(self.clusters):
+                out = bytearray()
+                self.encode(out, self.clusters[len(clusters_out)])
+                clusters_out.append(out)
+
+        # Metadata: header (doesn't reference objects), clusters, attributes
+        meta = bytearray()
+        self.encode(meta, {
+            'extras': [ obj.ref for obj in self.extras ],
+            'shapes': self.shapes,
+            'templates': self.templates,
+            'clusters': clusters,
+            'base_clusters': base_clusters,
+            'with_edges': with_edges,
+            'with_nsrc': with_nsrc,
+            'nsrc_count': nsrc_count,
+        })
+        write_uleb128(meta, len(clusters_out))
+        for out in clusters_out: meta += out
+        meta += attrs_out
+
+        strings = [ x.encode('utf-8', 'surrogatepass') for x in self.strings ]
+        string_offsets = array('Q', [0])
+        for x in strings: string_offsets.append(string_offsets[-1] + len(x))
+
+        sections = [ meta, string_offsets, b''.join(strings), object_clusters, object_shapes, object_offsets, records,
+            nsrc, edge_offsets, edge_src, edge_fields, edge_indexes ]
+        sections = [ memoryview(x).cast('B') for x in sections ]
+        if sys.byteorder != 'little':
+            raise Exception('Writing images is only supported on little-endian hosts')
+
+        # Write header, section table, sections
+        pos = calcsize(IMAGE_HEADER) + 16 * len(sections)
+        table = []
+        for x in sections:
+            pos += -pos % 8
+            table.append((pos, len(x)))
+            pos += len(x)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(pack(IMAGE_HEADER, IMAGE_MAGIC, IMAGE_VERSION, image_key(s), len(sections)))
+            for offset, size in table: f.write(pack('<QQ', offset, size))
+            for (offset, _), x in zip(table, sections):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(x)
+        os.replace(tmp, path)
+
+
+# READING #
+
+def read_image_header(buf):
+    ''' Returns the key and section views of an image, or None if it's not a valid image '''
+    if len(buf) < calcsize(IMAGE_HEADER): return
+    magic, version, key, count = unpack_from(IMAGE_HEADER, buf)
+    if magic != IMAGE_MAGIC or version != IMAGE_VERSION or count != len(IMAGE_SECTIONS): return
+    table = unpack_from('<{}Q'.format(2 * count), buf, calcsize(IMAGE_HEADER))
+    return key, { name: buf[offset:offset + size] for name, offset, size in zip(IMAGE_SECTIONS, table[::2], table[1::2]) }
+
+class ImageReader:
+    def __init__(self, s, sections):
+        self.s = s
+        self.sections = sections
+        self.string_offsets = sections['string_offsets'].cast('Q')
+        self.string_data = sections['strings']
+        self.strings = [None] * (len(self.string_offsets) - 1)
+        self.records = sections['records']
+        self.object_offsets = sections['object_offsets'].cast('Q')
+        self.objects = None
+
+    def string(self, n):
+        x = self.strings[n]
+        if x is None:
+            a, b = self.string_offsets[n], self.string_offsets[n+1]
+            x = self.strings[n] = intern(str(self.string_data[a:b], 'utf-8', 'surrogatepass'))
+        return x
+
+    def decode(self, buf, pos):
+        ''' Decodes a value at `pos`, returns (value, new pos) '''
+        t = buf[pos]; pos += 1
+        if t in (T_INT, T_STR, T_OBJECT, T_BYTES, T_VIEW, T_LIST, T_TUPLE, T_DICT, T_OBJECTS):
+            x = 0; sh = 0
+            while True:
+                b = buf[pos]; pos += 1
+                x |= (b & 0x7F) << sh
+                if not (b & 0x80): break
+                sh += 7
+            if t == T_OBJECT: return self.objects[x], pos
+            if t == T_STR: return self.string(x), pos
+            if t == T_INT: return (x >> 1) ^ -(x & 1), pos
+            if t == T_BYTES: return bytes(buf[pos:pos + x]), pos + x
+            if t == T_VIEW: return buf[pos:pos + x], pos + x
+            if t == T_OBJECTS:
+                ids = buf[pos:pos + 4 * x].cast('I')
+                return list(itemgetter(*ids)(self.objects)), pos + 4 * x
+            if t == T_DICT:
+                res = {}
+                for _ in range(x):
+                    k, pos = self.decode(buf, pos)
+                    res[k], pos = self.decode(buf, pos)
+                return res, pos
+            res = []
+            for _ in range(x):
+                v, pos = self.decode(buf, pos)
+                res.append(v)
+            return (res if t == T_LIST else tuple(res)), pos
+        if t == T_NONE: return None, pos
+        if t == T_TRUE: return True, pos
+        if t == T_FALSE: return False, pos
+        if t == T_FLOAT: return unpack_from('<d', buf, pos)[0], pos + 8
+        raise Exception('Invalid tag in image: {}'.format(t))
+
+    def load_record(self, n):
+        ''' Decodes the data dictionary of object with ID `n` (which is its ref, for regular objects) '''
+        buf, pos, decode = self.records, self.object_offsets[n], self.decode
+        res = {}
+        for k in self.shapes[self.object_shapes[n]]:
+            res[k], pos = decode(buf, pos)
+        return res
+
+    def read(self):
+        s, sections = self.s, self.sections
+        meta, pos = sections['meta'], 0
+        header, pos = self.decode(meta, pos)
+        self.shapes = header['shapes']
+        self.object_shapes = sections['object_shapes'].cast('i')
+        object_clusters = sections['object_clusters'].cast('i')
+
+        # Create all objects first (their data is decoded when accessed), so that they can be referenced
+        extras, total = header['extras'], len(object_clusters)
+        count = total - len(extras)
+        new = VMObject.__new__
+        objects = self.objects = [None] * total
+        for n in range(1, count):
+            obj = objects[n] = new(VMObject)
+            obj.ref, obj.s, obj._src = n, s, None
+        for n, ref in enumerate(extras, count):
+            obj = objects[n] = new(VMObject)
+            obj.ref, obj.s, obj._src = ref, s, None
+        n_clusters, pos = self.uleb(meta, pos)
+        clusters = []
+        for _ in range(n_clusters):
+            c, pos = self.decode(meta, pos)
+            clusters.append(c)
+        for obj, c in zip(objects[1:], object_clusters[1:]):
+            obj.cluster = clusters[c]
+        s.image = self
+        for n in range(count, total):
+            objects[n].x = self.load_record(n)
+
+        # Attributes and tables
+        attrs, pos = self.decode(meta, pos)
+        for k, v in attrs.items(): setattr(s, k, v)
+        s.objects = objects[:count]
+        s.clusters = [ clusters[i] for i in header['clusters'] ]
+        s.base_clusters = [ clusters[i] for i in header['base_clusters'] ]
+        s._strings = None
+        s._address_map = None
+        s._indexes = None
+        s._names = None
+
+        # Back-references
+        s.backrefs = 'csr' if header['with_edges'] else False
+        s.edges, s.edge_field_ids = None, {}
+        s.edge_roots, s.edge_fields = objects[count:], header['templates']
+        s.backref_index = None
+        if header['with_edges']:
+            s.backref_index = (sections['edge_offsets'].cast('q'),
+                *( sections[k].cast('i') for k in ['edge_src', 'edge_fields', 'edge_indexes'] ))
+        if header['with_nsrc']:
+            buf, pos = sections['nsrc'], 0
+            for _ in range(header['nsrc_count']):
+                n, pos = self.uleb(buf, pos)
+                objects[n].nsrc, pos = self.decode(buf, pos)
+
+    def uleb(self, buf, pos):
+        x = 0; sh = 0
+        while True:
+            b = buf[pos]; pos += 1
+            x |= (b & 0x7F) << sh
+            if not (b & 0x80): break
+            sh += 7
+        return x, pos
+
+
+def save_image(s, path):
+    ImageWriter(s).write(path)
+
+def load_image(s, path, check=True):
+    if not os.path.exists(path): return
+    with open(path, 'rb') as f:
+        buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    header = read_image_header(buf)
+    if header is None:
+        s.notice('Image {} is not valid or has a different format version, ignoring'.format(path), show_offset=False)
+        return
+    key, sections = header
+    if check and key != image_key(s):
+        s.notice('Image {} is stale (input blobs or options changed), ignoring'.format(path), show_offset=False)
+        return
+    ImageReader(s, sections).read()
+    return s
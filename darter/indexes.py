@@ -0,0 +1,129 @@
+# INDEXES: Secondary indexes over the parsed objects (by library, owner, class, code)
+
+from .core import VMObject
+
+
+def owner_class(owner):
+    ''' Resolves the owner of a function / field to its class (PatchClass are followed),
+        or returns None if it's not a class '''
+    if isinstance(owner, VMObject) and owner.is_cid('PatchClass'):
+        owner = owner.x['patched_class']
+    return owner if isinstance(owner, VMObject) and owner.is_cid('Class') else None
+
+def is_closure(func):
+    data = func.x.get('data')
+    return isinstance(data, VMObject) and data.is_cid('ClosureData')
+
+
+class Indexes:
+    '''
+    Secondary indexes of a parsed snapshot (including the objects of its base), built
+    once with a single pass over the relevant objects. All dictionaries are keyed by
+    object and map to lists:
+
+     - `library_classes`: Library -> Classes in it
+     - `class_functions`, `class_fields`: Class -> Functions / Fields owned by it
+       (directly or through a PatchClass); closures are not included
+     - `class_closures`: Class -> closures inside its functions (at any depth)
+     - `owner_members`: owner (Class, PatchClass...) -> Functions and Fields that
+       have it as `owner` (the closures are owned by their class too)
+     - `function_closures`: Function -> closures whose parent function is it
+     - `function_code`: Function -> its Code
+     - `code_function`: Code -> the Function it belongs to
+
+    It's usually accessed through `Snapshot.indexes` and the `Snapshot.get_*` methods.
+    '''
+
+    def __init__(self, s):
+        self.library_classes = {}
+        self.class_functions, self.class_fields, self.class_closures = {}, {}, {}
+        self.owner_members, self.function_closures = {}, {}
+        self.function_code, self.code_function = {}, {}
+        add = lambda d, k, v: d[k].append(v) if k in d else d.__setitem__(k, [v])
+
+        for cls in s.getrefs('Class'):
+            library = cls.x.get('library')
+            if isinstance(library, VMObject) and library.is_cid('Library'):
+                add(self.library_classes, library, cls)
+
+        closures = []
+        for func in s.getrefs('Function'):
+            owner = func.x['owner']
+            add(self.owner_members, owner, func)
+            code = func.x.get('code')
+            if isinstance(code, VMObject) and code.is_cid('Code'):
+                self.function_code[func] = code
+                self.code_function[code] = func
+            if is_closure(func):
+                parent = func.x['data'].x['parent_function']
+                if isinstance(parent, VMObject) and parent.is_cid('Function'):
+                    add(self.function_closures, parent, func)
+                closures.append(func)
+                continue
+            cls = owner_class(owner)
+            if cls is not None: add(self.class_functions, cls, func)
+
+        for func in closures:
+            # closures are owned by the class of their outermost function
+            cls = owner_class(func.x['owner'])
+            if cls is not None: add(self.class_closures, cls, func)
+
+        for field in s.getrefs('Field'):
+            owner = field.x['owner']
+            add(self.owner_members, owner, field)
+            cls = owner_class(owner)
+            if cls is not None: add(self.class_fields, cls, field)
+
+        for code in s.getrefs('Code'):
+            owner = code.x['owner']
+            if code not in self.code_function and isinstance(owner, VMObject) and owner.is_cid('Function'):
+                self.code_function[code] = owner
+
+    def classes(self, library):
+        return self.library_classes.get(library, [])
+
+    def functions(self, owner, closures=False):
+        '''
+        Functions of a Library, Class or PatchClass (closures are included if
+        `closures` is True). For a Function, returns its closures (at any depth
+        if `closures` is True, otherwise only the immediate ones).
+        '''
+        if owner.is_cid('Library'):
+            return [ f for cls in self.classes(owner) for f in self.functions(cls, closures) ]
+        if owner.is_cid('Function'):
+            result, pending = [], [owner]
+            while pending:
+                children = self.function_closures.get(pending.pop(), [])
+                result += children
+                if closures: pending += children
+            return result
+        if owner.is_cid('PatchClass'):
+            return [ f for f in self.owner_members.get(owner, []) if f.is_cid('Function') and (closures or not is_closure(f)) ]
+        cls = owner_class(owner)
+        return self.class_functions.get(cls, []) + (self.class_closures.get(cls, []) if closures else [])
+
+    def fields(self, owner):
+        ''' Fields of a Library, Class or PatchClass '''
+        if owner.is_cid('Library'):
+            return [ f for cls in self.classes(owner) for f in self.fields(cls) ]
+        if owner.is_cid('PatchClass'):
+            return [ f for f in self.owner_members.get(owner, []) if f.is_cid('Field') ]
+        return self.class_fields.get(owner, [])
+
+    def closures(self, owner):
+        ''' Closures inside a Function, Class or Library (at any depth) '''
+        if owner.is_cid('Library'):
+            return [ f for cls in self.classes(owner) for f in self.closures(cls) ]
+        if owner.is_cid('Function'):
+            return self.functions(owner, closures=True)
+        return self.class_closures.get(owner_class(owner), [])
+
+    def members(self, owner):
+        ''' Functions and Fields that have `owner` as their owner '''
+        return self.owner_members.get(owner, [])
+
+    def code(self, function):
+        return self.function_code.get(function)
+
+    def function(self, code):
+        return self.code_function.get(code)
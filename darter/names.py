@@ -0,0 +1,122 @@
+# NAMES: Index of qualified names (library, class, member, closures) with prefix and regex search
+
+import re
+from bisect import bisect_left
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse # (Python < 3.11)
+
+from .core import VMObject, unob_string
+
+INDEXED_CIDS = ('Library', 'Class', 'Function', 'Field')
+TOPLEVEL_CLASS = '::' # name of the class holding top-level members of a library
+
+
+def object_name(obj, unob=True):
+    ''' Name of a library (its URL), class or member, deobfuscated if `unob` is True '''
+    if obj.is_cid('PatchClass'):
+        obj = obj.x['patched_class']
+    name = obj.x['url'] if obj.is_cid('Library') else obj.x['name']
+    if not (isinstance(name, VMObject) and name.is_string() and 'value' in name.x): return None
+    return unob_string(name) if unob else name.x['value']
+
+def qualified_name(obj, unob=True):
+    '''
+    Qualified name of a library, class or member, built from its `locate()` chain:
+    `<library URL>::<class>.<member>.<closure>...`. Members of the top-level class
+    are qualified with the library only. Returns None if it can't be determined.
+    '''
+    chain = [ obj ] + [ p for p in obj.locate() or [] if isinstance(p, VMObject) ]
+    top = chain[-1]
+    if top.is_cid('PatchClass'): top = top.x['patched_class']
+    if top.is_cid('Class') and top.x['library'].is_cid('Library'):
+        chain.append(top.x['library'])
+    names = [ object_name(p, unob) for p in reversed(chain) ]
+    if None in names: return None
+    if not chain[-1].is_cid('Library'): return '.'.join(names)
+    members = [ n for n in names[1:] if n != TOPLEVEL_CLASS ]
+    return names[0] + '::' + '.'.join(members) if members else names[0]
+
+def literal_prefix(pattern, flags=0):
+    '''
+    Literal prefix that every match of an anchored (^...) regex starts with, taken
+    from its parsed form: the literals that follow the anchor at the top level (so a
+    top-level alternation has none). Empty if matching isn't case-sensitive or `^`
+    can match after newlines.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return ''
+    if parsed.state.flags & (re.IGNORECASE | re.MULTILINE): return ''
+    items = list(parsed)
+    if not items or items[0][0] is not sre_parse.AT or \
+        items[0][1] not in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING): return ''
+    prefix = []
+    for op, value in items[1:]:
+        if op is not sre_parse.LITERAL: break
+        prefix.append(chr(value))
+    return ''.join(prefix)
+
+
+class NameIndex:
+    '''
+    Sorted index of the qualified names (see `qualified_name`) of the libraries,
+    classes, functions (closures included) and fields of a snapshot and its base.
+    If `unob` is True, deobfuscated names are used where available.
+
+    `keys` holds the sorted names and `objects` the object for each one (a name may
+    appear more than once, i.e. anonymous closures).
+    '''
+
+    def __init__(self, s, unob=True):
+        entries = []
+        for cid in INDEXED_CIDS:
+            for obj in s.getrefs(cid):
+                name = qualified_name(obj, unob)
+                if name is not None: entries.append((name, obj.ref, obj))
+        entries.sort(key=lambda e: e[:2])
+        self.keys = [ name for name, _, _ in entries ]
+        self.objects = [ obj for _, _, obj in entries ]
+        self.by_name = {} # simple name (last component) -> objects
+        for obj in self.objects:
+            name = object_name(obj, unob)
+            if name in self.by_name: self.by_name[name].append(obj)
+            else: self.by_name[name] = [obj]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def items(self, prefix=''):
+        ''' Returns (name, object) pairs whose name starts with `prefix`, in order '''
+        keys, n = self.keys, bisect_left(self.keys, prefix)
+        while n < len(keys) and keys[n].startswith(prefix):
+            yield keys[n], self.objects[n]
+            n += 1
+
+    def get(self, name):
+        ''' Objects with exactly this qualified name '''
+        n, result = bisect_left(self.keys, name), []
+        while n < len(self.keys) and self.keys[n] == name:
+            result.append(self.objects[n])
+            n += 1
+        return result
+
+    def prefix(self, prefix):
+        ''' Objects whose qualified name starts with `prefix` (i.e. 'package:myapp/') '''
+        return [ obj for _, obj in self.items(prefix) ]
+
+    def search(self, pattern, flags=0):
+        '''
+        Objects whose qualified name matches a regex (re.search semantics). If the
+        pattern is anchored with a literal prefix, only names with that prefix are
+        scanned (see literal_prefix).
+        '''
+        regex = re.compile(pattern, flags)
+        prefix = literal_prefix(regex.pattern, regex.flags) if isinstance(regex.pattern, str) else ''
+        return [ obj for name, obj in self.items(prefix) if regex.search(name) ]
+
+    def named(self, name):
+        ''' Objects whose own (unqualified) name is `name`, i.e. all methods named 'build' '''
+        return self.by_name.get(name, [])
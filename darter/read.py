@@ -1,6 +1,13 @@
 # READING PRIMITIVES
 
-from struct import unpack, pack
+from struct import unpack, pack, unpack_from, calcsize
+
+has_numpy = False
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError as e:
+    pass
 
 
 def readcstr(f):
@@ -48,3 +55,157 @@ def read_uleb128(f):
         if not (b & 0x80): break
         s += 7
     return x
+
+
+# Buffer cursor
+
+# minimum run length for which readuints() uses NumPy (below this, the setup overhead dominates)
+BULK_THRESHOLD = 64
+
+class Reader:
+    '''
+    Cursor over an in-memory buffer (bytes, bytearray, mmap, memoryview...).
+    It offers the reading primitives above as methods, decoding directly
+    from the buffer without allocating an object per byte, and also
+    implements the subset of the file API (read, seek, tell) used by
+    the parser, so it can be used in place of a BytesIO.
+    '''
+    def __init__(self, data, pos=0):
+        buf = data if isinstance(data, memoryview) else memoryview(data)
+        if buf.format != 'B' or buf.ndim != 1: buf = buf.cast('B')
+        self.buf = buf
+        self.pos = pos
+
+    def __len__(self):
+        return len(self.buf)
+
+    # File API
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        self.pos = pos + { 0: 0, 1: self.pos, 2: len(self.buf) }[whence]
+        return self.pos
+
+    def truncate(self, size):
+        self.buf = self.buf[:size]
+
+    def read(self, n=-1):
+        return self.view(n).tobytes()
+
+    def view(self, n=-1):
+        ''' Like read(), but returns a memoryview of the buffer instead of a copy '''
+        start = self.pos
+        end = len(self.buf) if n < 0 else min(start + n, len(self.buf))
+        self.pos = end
+        return self.buf[start:end]
+
+    # Reading primitives
+
+    def unpack(self, fmt):
+        ''' Reads a fixed-width struct, returns the unpacked tuple '''
+        res = unpack_from(fmt, self.buf, self.pos)
+        self.pos += calcsize(fmt)
+        return res
+
+    def readcstr(self):
+        buf, start = self.buf, self.pos
+        end = start
+        while True:
+            chunk = buf[end:end+256].tobytes()
+            if not chunk: raise Exception('Unexpected EOF')
+            idx = chunk.find(0)
+            if idx >= 0: break
+            end += len(chunk)
+        self.pos = end + idx + 1
+        return buf[start:end + idx].tobytes()
+
+    def readuint(self, bits=64, signed=False):
+        buf, pos = self.buf, self.pos
+        b = buf[pos]
+        if bits == 8:
+            self.pos = pos + 1
+            return b - 0x100 if signed and b > 0x7f else b
+        x = 0; s = 0
+        while b < 0x80:
+            x |= b << s
+            s += 7
+            pos += 1
+            b = buf[pos]
+        self.pos = pos + 1
+        x |= (b - (0xc0 if signed else 0x80)) << s
+        if s + 7 > bits: # only check when the value could overflow
+            assert s < bits
+            if x.bit_length() > bits:
+                print('--> Int {} longer than {} bits'.format(x, bits))
+        return x
+
+    def readint(self, bits=64):
+        return self.readuint(bits, True)
+
+    def readuints(self, count, bits=64, signed=False):
+        ''' Reads a run of `count` consecutive integers, returns them as a list.
+            Long runs of unsigned integers are decoded with NumPy, if available. '''
+        if has_numpy and count >= BULK_THRESHOLD and not signed:
+            res = self.readuints_bulk(count)
+            if res is not None: return res
+        buf, pos = self.buf, self.pos
+        final = 0xc0 if signed else 0x80
+        res = []
+        append = res.append
+        for _ in range(count):
+            b = buf[pos]
+            x = 0; s = 0
+            while b < 0x80:
+                x |= b << s
+                s += 7
+                pos += 1
+                b = buf[pos]
+            pos += 1
+            assert s < bits
+            append(x | ((b - final) << s))
+        self.pos = pos
+        return res
+
+    def readuints_bulk(self, count):
+        ''' Vectorized version of readuints() for unsigned integers (requires NumPy).
+            Returns None (without advancing) if some integer doesn't fit in 63 bits. '''
+        buf, pos = self.buf, self.pos
+        # find the terminating bytes, growing the window until we have enough
+        size = min(len(buf) - pos, count * 4)
+        while True:
+            a = np.frombuffer(buf, np.uint8, size, pos)
+            ends = np.flatnonzero(a >= 0x80)
+            if len(ends) >= count or pos + size == len(buf): break
+            size = min(len(buf) - pos, size * 2)
+        if len(ends) < count: raise IndexError('Unexpected EOF')
+        ends = ends[:count]
+        starts = np.empty(count, np.intp)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        lengths = ends - starts + 1
+        if lengths.max() > 9: return None
+        a = a[:ends[-1] + 1]
+        shifts = (np.arange(len(a)) - np.repeat(starts, lengths)) * 7
+        values = np.left_shift((a & 0x7F).astype(np.uint64), shifts.astype(np.uint64))
+        self.pos = pos + len(a)
+        return np.add.reduceat(values, starts).tolist()
+
+    readcid = lambda self: self.readuint(32, True)
+    read1 = lambda self: { 0: False, 1: True}[self.readuint(8)]
+    readtokenposition = lambda self: self.readuint(32, True)
+
+    readfloat  = lambda self: unpack('<f', pack('<I', self.readuint(32) & ((1<<32)-1)))[0]
+    readdouble = lambda self: unpack('<d', pack('<Q', self.readuint(70) & ((1<<64)-1)))[0]
+
+    def read_uleb128(self):
+        buf, pos = self.buf, self.pos
+        x = 0; s = 0
+        while True:
+            b = buf[pos]; pos += 1
+            x |= (b & 0x7F) << s
+            if not (b & 0x80): break
+            s += 7
+        self.pos = pos
+        return x
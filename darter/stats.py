@@ -0,0 +1,85 @@
+# STATS: Instrumentation collected while parsing a snapshot (see the `stats` option of Snapshot)
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class ParseStats:
+    '''
+    Statistics of a parse:
+
+     - `phases`: dictionary from phase name (header, alloc, rodata, fill, roots,
+       link_cids, backrefs, build_tables) to a dictionary with its wall `time` and,
+       if memory tracing is enabled, `memory_peak` (peak traced memory during the
+       phase) and `memory_delta` (traced memory retained by the phase), in bytes
+     - `clusters`: list with a dictionary for each cluster (in order), with its `cid`,
+       `handler`, number of `objects`, and `alloc_bytes`, `alloc_time`, `fill_bytes`,
+       `fill_time` (bytes consumed from the data blob, and wall time)
+
+    When used through stream(), phase times include the time spent by the consumer.
+    '''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.phases = {}
+        self.clusters = []
+        self.cluster_index = {}
+
+    @contextmanager
+    def phase(self, name):
+        ''' Measures a phase of the parse (phases with the same name are added up) '''
+        entry = self.phases.setdefault(name, { 'time': 0.0 })
+        started_tracing = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['time'] += time.perf_counter() - start
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                entry['memory_peak'] = max(entry.get('memory_peak', 0), peak)
+                entry['memory_delta'] = entry.get('memory_delta', 0) + current - start_memory
+                if started_tracing: tracemalloc.stop()
+
+    def cluster(self, cluster):
+        ''' Returns the entry of a cluster, creating it if needed '''
+        n = self.cluster_index.get(id(cluster))
+        if n is None:
+            n = self.cluster_index[id(cluster)] = len(self.clusters)
+            self.clusters.append({ 'cid': None, 'handler': cluster['handler'], 'objects': 0,
+                'alloc_bytes': 0, 'alloc_time': 0.0, 'fill_bytes': 0, 'fill_time': 0.0 })
+        return self.clusters[n]
+
+    def by_cid(self):
+        ''' Adds up the cluster entries by cid, returns a dictionary from cid name to totals '''
+        result = {}
+        for c in self.clusters:
+            total = result.setdefault(c['cid'], { k: 0 for k in c if k not in ('cid', 'handler') })
+            for k in total: total[k] += c[k]
+        return result
+
+    def to_dict(self):
+        return { 'phases': self.phases, 'clusters': self.clusters, 'cids': self.by_cid(),
+            'total_time': sum(p['time'] for p in self.phases.values()) }
+
+    def to_json(self, f=None, **kwargs):
+        ''' Returns the stats as a JSON string, or writes them to file `f` if passed '''
+        if f is None: return json.dumps(self.to_dict(), **kwargs)
+        json.dump(self.to_dict(), f, **kwargs)
+
+    def __str__(self):
+        lines = [ '{:14} {:8.3f}s'.format(name, p['time']) + (
+            '   peak {:8.1f} MiB   delta {:+8.1f} MiB'.format(p['memory_peak'] / 2**20, p['memory_delta'] / 2**20)
+            if 'memory_peak' in p else '') for name, p in self.phases.items() ]
+        cids = sorted(self.by_cid().items(), key=lambda kv: -(kv[1]['alloc_time'] + kv[1]['fill_time']))
+        lines += [ '  {:28} {:8} objects {:10} bytes {:8.3f}s'.format(str(cid), c['objects'],
+            c['alloc_bytes'] + c['fill_bytes'], c['alloc_time'] + c['fill_time']) for cid, c in cids ]
+        return '\n'.join(lines)
@@ -0,0 +1,290 @@
+# SYNTH: Generates synthetic snapshots of configurable size, for testing and benchmarking
+
+import random
+from struct import pack
+
+from .constants import *
+from .data.base_objects import make_base_entries
+from .write import SnapshotWriter
+
+HEADER = { 'arm64': 32, 'x64': 32, 'arm': 16, 'ia32': 16 } # size of the header of Instructions
+
+# generate() parameters for some reference sizes
+SIZES = {
+    'small': {},
+    'medium': { 'n_libraries': 20, 'n_classes': 20, 'n_functions': 8, 'n_strings': 50000, 'array_size': 100000, 'n_instances': 5000 },
+    'large': { 'n_libraries': 100, 'n_classes': 40, 'n_functions': 10, 'n_strings': 500000, 'array_size': 1000000, 'n_instances': 50000 },
+}
+
+
+# Random code, with the instruction patterns that asm/ recognizes (pool loads, calls)
+
+def arm64_code(rng, n_ops, pool_len, self_addr, targets):
+    ''' Returns list of uint32 words '''
+    words = []
+    for _ in range(n_ops):
+        k = rng.random()
+        t = rng.randrange(0, 16)
+        if k < 0.3 and pool_len:
+            n = rng.randrange(min(pool_len, 4000))
+            words.append(0xF9400000 | ((n + 2) << 10) | (27 << 5) | t)
+        elif k < 0.4 and pool_len:
+            n = rng.randrange(pool_len)
+            off = 8 * (n + 2)
+            words.append(0x91400000 | ((off >> 12) << 10) | (27 << 5) | 16)
+            words.append(0xF9400000 | (((off & 0xfff) >> 3) << 10) | (16 << 5) | t)
+        elif k < 0.45 and pool_len:
+            n = rng.randrange(pool_len)
+            off = 8 * (n + 2)
+            words.append(0xD2800000 | ((off & 0xffff) << 5) | 16)
+            if off >> 16:
+                words.append(0xF2A00000 | ((off >> 16) << 5) | 16)
+            words.append(0x8B000000 | (16 << 16) | (27 << 5) | 16)
+            words.append(0xF9400000 | (16 << 5) | t)
+        elif k < 0.5 and pool_len > 1:
+            n = rng.randrange(min(pool_len - 1, 60))
+            off = 8 * (n + 2)
+            words.append(0xA9400000 | ((off >> 3) << 15) | (30 << 10) | (27 << 5) | 5)
+            words.append(0xD63F03C0)
+        elif k < 0.65 and targets:
+            target = rng.choice(targets)
+            delta = (target - (self_addr + 4 * len(words))) >> 2
+            words.append(0x94000000 | (delta & 0x3ffffff))
+        elif k < 0.7:
+            words.append(0xAA0003E0 | (rng.randrange(16) << 16) | t)  # mov xT, xM
+        else:
+            words.append(0xD503201F)  # nop
+    words.append(0xD65F03C0)  # ret
+    return words
+
+def arm_code(rng, n_ops, pool_len, self_addr, targets):
+    words = []
+    for _ in range(n_ops):
+        k = rng.random()
+        t = rng.randrange(0, 5)
+        if k < 0.3 and pool_len:
+            n = rng.randrange(min(pool_len, 1000))
+            off = 4 * (n + 2) - 1
+            words.append(0xE5900000 | (5 << 16) | (t << 12) | off)
+        elif k < 0.4 and pool_len:
+            n = rng.randrange(pool_len)
+            off = 4 * (n + 2) - 1
+            words.append(0xE2800000 | (5 << 16) | (t << 12) | (0xA << 8) | ((off >> 12) & 0xff))
+            words.append(0xE5900000 | (t << 16) | (t << 12) | (off & 0xfff))
+        elif k < 0.55 and targets:
+            target = rng.choice(targets)
+            delta = (target - (self_addr + 4 * len(words) + 8)) >> 2
+            words.append(0xEB000000 | (delta & 0xffffff))
+        else:
+            words.append(0xE1A00000)  # nop (mov r0, r0)
+    words.append(0xE12FFF1E)  # bx lr
+    return words
+
+def code_bytes(arch, rng, n_ops, pool_len, self_addr, targets):
+    if arch == 'arm64':
+        w = arm64_code(rng, n_ops, pool_len, self_addr, targets)
+    elif arch == 'arm':
+        w = arm_code(rng, n_ops, pool_len, self_addr, targets)
+    else:
+        return b'\x90' * (4 * n_ops) + b'\xc3'
+    return pack('<{}L'.format(len(w)), *w)
+
+
+def stub_bytes(arch, rng, count, n_ops=4):
+    ''' Instructions of `count` stubs, which load from the first entries of the pool and
+        call each other (laid out like the writer places them) '''
+    hdr, size = HEADER[arch], 4 * (n_ops * 4 + 1)
+    addrs = [ n * (-(hdr + size) // -kMaxPreferredCodeAlignment * kMaxPreferredCodeAlignment) + hdr for n in range(count) ]
+    stubs = [ code_bytes(arch, rng, n_ops, 16, addr, addrs) for addr in addrs ]
+    return [ data + b'\x1f\x20\x03\xd5' * ((size - len(data)) // 4) for data in stubs ]
+
+
+def generate(arch='arm64', seed=0, n_libraries=4, n_classes=6, n_functions=5, n_fields=3,
+             n_strings=500, array_size=2000, n_instances=50, code_ops=40, obfuscate=False):
+    '''
+    Generates a random (but deterministic, given `seed`) AppAOT snapshot for `arch`,
+    returns its (VM data, VM instructions, isolate data, isolate instructions) blobs.
+    It has `n_libraries` libraries with `n_classes` classes each, with `n_functions`
+    functions (some with closures, each with its Code) and `n_fields` fields each,
+    `n_strings` strings, three big arrays of `array_size` / 2 to `array_size` refs,
+    instances of three classes (`n_instances` each), a global object pool, and
+    instructions of about `code_ops` random instructions per Code, that load from the
+    pool and call each other.
+
+    If `obfuscate` is True, identifiers (library URLs and names, class, function and
+    field names) are renamed like the obfuscator does: each distinct name gets a random
+    name, keeping getter / setter prefixes. The rest of the snapshot is the same as the
+    non-obfuscated one with the same arguments.
+
+    See `SIZES` for some reference sizes, and parse_synthetic() to parse it.
+    '''
+    rng = random.Random(seed)
+    base_count = len(make_base_entries(True))
+
+    # VM snapshot
+    vm = SnapshotWriter(arch=arch, vm=True, num_base_objects=base_count)
+    vstr = vm.cluster('OneByteString')
+    vsyms = [ vm.add(vstr, value='sym{}'.format(i)) for i in range(20) ]
+    varr = vm.cluster('Array')
+    symtab = vm.add(varr, value=vsyms)
+    vcodes = vm.cluster('Code')
+    stubs = [ vm.add(vcodes, instructions={ 'data': data, 'flags': {'single_entry': True} })
+              for data in stub_bytes(arch, random.Random(seed + 2), len(kStubCodeList)) ]
+    vm.roots = { 'symbol_table': symtab, '_stubs': stubs }
+    vm_data, vm_instr = vm.write()
+
+    # Isolate snapshot
+    w = SnapshotWriter(arch=arch, num_base_objects=vm.num_objects)
+    strs = w.cluster('OneByteString')
+    strings = [ w.add(strs, value='str_{}_{}'.format(i, 'x' * rng.randrange(30))) for i in range(n_strings) ]
+    strings += [ w.add(strs, value='str_{}'.format(i)) for i in range(20) ]  # duplicates
+    strings += [ w.add(strs, value=s) for s in ['dart:core', '<anonymous closure>', 'build'] ]
+    tstrs = w.cluster('TwoByteString')
+    strings += [ w.add(tstrs, value='ü→{}'.format(i)) for i in range(10) ]
+    new_string = lambda v: w.add(strs, value=v)
+    renames, obf_rng = {}, random.Random(seed + 1)
+    def identifier(v):
+        if not obfuscate: return new_string(v)
+        prefix, name = ('get:', v[4:]) if v.startswith('get:') else ('', v)
+        while name not in renames:
+            new_name = ''.join(obf_rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz') for _ in range(3))
+            if new_name not in renames.values(): renames[name] = new_name
+        return new_string(prefix + renames[name])
+
+    mints = w.cluster('Mint')
+    mint = lambda v: w.add(mints, value=v, canonical=True)
+    doubles = w.cluster('Double')
+    dbl = [ w.add(doubles, value=rng.random() * 100) for _ in range(10) ]
+
+    arrays = w.cluster('Array')
+    goas = w.cluster('GrowableObjectArray')
+    def goa(values):
+        return w.add(goas, length=mint(len(values)), data=w.add(arrays, value=list(values)))
+
+    pcd = w.cluster('PcDescriptors')
+    csm = w.cluster('CodeSourceMap')
+    stm = w.cluster('StackMap')
+    scripts = w.cluster('Script')
+    libraries = w.cluster('Library')
+    classes = w.cluster('Class')
+    functions = w.cluster('Function')
+    closure_data = w.cluster('ClosureData')
+    fields = w.cluster('Field')
+    codes = w.cluster('Code')
+    pools = w.cluster('ObjectPool')
+    typeargs = w.cluster('TypeArguments')
+    types = w.cluster('Type')
+
+    code_objs, libs, all_functions = [], [], []
+    cid = kNumPredefinedCids
+    user_classes = []
+    for l in range(n_libraries):
+        url = identifier('package:app{}/lib{}.dart'.format(l % 2, l))
+        script = w.add(scripts, url=url)
+        cls_list = []
+        for c in range(n_classes):
+            cls = w.add(classes, name=identifier('Class{}_{}'.format(l, c)), script=script, cid=cid,
+                        next_field_offset_in_words=1 + n_fields, instance_size_in_words=1 + n_fields)
+            user_classes.append(cls)
+            cid += 1
+            funcs, flds = [], []
+            for k in range(n_functions):
+                name = identifier(rng.choice(['build', 'get:x{}'.format(k), 'method{}'.format(k)]))
+                code = w.add(codes, pc_descriptors=w.add(pcd, data=bytes(rng.randrange(256) for _ in range(12))),
+                    code_source_map=w.add(csm, ops=[('kChangePosition', 5), ('kAdvancePC', 8), ('kPushFunction', 3), ('kPopFunction',)]),
+                    stackmaps=w.add(stm, bits=[rng.random() < .5 for _ in range(13)], pc_offset=4))
+                params = w.add(arrays, value=[ rng.choice(strings) for _ in range(rng.randrange(4)) ])
+                fn = w.add(functions, name=name, owner=cls, code=code, parameter_names=params,
+                           packed_fields=rng.randrange(1 << 20), kind_tag=rng.randrange(1 << 30))
+                code.x['owner'] = fn
+                funcs.append(fn); code_objs.append(code)
+                if rng.random() < 0.3:
+                    cd = w.add(closure_data, parent_function=fn)
+                    ccode = w.add(codes, owner=None)
+                    clo = w.add(functions, name=strings[-11], owner=cls, code=ccode, data=cd,
+                                parameter_names=w.add(arrays, value=[]))
+                    ccode.x['owner'] = clo
+                    funcs.append(clo); code_objs.append(ccode)
+            for k in range(n_fields):
+                flds.append(w.add(fields, name=identifier('field{}'.format(k)), owner=cls, value=mint(8 * (k + 1)),
+                                  kind_bits=rng.randrange(1 << 10)))
+            cls.x['functions'] = w.add(arrays, value=funcs)
+            cls.x['fields'] = w.add(arrays, value=flds)
+            all_functions += funcs
+            cls_list.append(cls)
+        lib = w.add(libraries, name=identifier('lib{}'.format(l)), url=url, owned_scripts=goa([script]),
+                    index=l, num_imports=l, load_state=3, dictionary=w.add(arrays, value=cls_list))
+        for c in cls_list: c.x['library'] = lib
+        libs.append(lib)
+
+    # Type objects and instances
+    tlist = [ w.add(types, canonical=True, type_class_id=mint(c.x['cid'])) for c in user_classes[:5] ]
+    w.add(typeargs, types=tlist, hash=1234)
+    values = strings + dbl
+    for cls in user_classes[:3]:
+        inst = w.cluster(cls.x['cid'], next_field_offset_in_words=1 + n_fields, instance_size_in_words=1 + n_fields)
+        for _ in range(n_instances):
+            w.add(inst, fields=[ rng.choice(values) for _ in range(n_fields) ], canonical=True)
+
+    # Big arrays
+    w.add(arrays, value=[ rng.choice(strings) for _ in range(array_size) ])
+    w.add(arrays, value=[ rng.choice(all_functions) for _ in range(array_size // 2) ])
+    w.add(arrays, value=[ mint(n) for n in range(array_size // 2) ])
+
+    # Global object pool
+    pool_values = strings + all_functions + code_objs
+    rng.shuffle(pool_values)
+    entries = [ { 'type': kkEntryType['kTaggedObject'], 'raw_obj': v } for v in pool_values ]
+    entries.insert(3, { 'type': kkEntryType['kImmediate'], 'raw_value': 12345 })
+    entries.insert(7, { 'type': kkEntryType['kNativeFunction'] })
+    pool = w.add(pools, entries=entries)
+
+    # Instructions, with calls between code objects
+    hdr = HEADER[arch]
+    sizes = [ 4 * (code_ops * 4 + 1) for _ in code_objs ]
+    addrs, pos = [], 0
+    for size in sizes:
+        pos += -pos % kMaxPreferredCodeAlignment
+        addrs.append(pos + hdr)
+        pos += hdr + size
+    for code, addr in zip(code_objs, addrs):
+        data = code_bytes(arch, rng, code_ops, len(entries), addr, addrs)
+        code.x['instructions'] = { 'data': data, 'flags': { 'single_entry': rng.random() < 0.5 },
+                                   'unchecked_entrypoint_pc_offset': rng.choice([0, 16]) }
+        code.x['object_pool'] = pool
+    # pad codes to predicted size
+    for code, size in zip(code_objs, sizes):
+        d = code.x['instructions']['data']
+        code.x['instructions']['data'] = d + b'\x1f\x20\x03\xd5' * ((size - len(d)) // 4)
+
+    w.roots = { 'symbol_table': w.add(arrays, value=strings[:100]), 'global_object_pool': pool,
+                'core_library': libs[0] }
+    iso_data, iso_instr = w.write()
+    return vm_data, vm_instr, iso_data, iso_instr
+
+
+# (blobs of a generated snapshot are placed at these addresses, so that code doesn't overlap)
+VM_OFFSETS, ISOLATE_OFFSETS = (0x1000, 0x100000), (0x200000, 0x400000)
+
+def parse_synthetic(blobs, **kwargs):
+    ''' Parses the blobs returned by generate(), returns the isolate snapshot. `kwargs` are
+        passed to Snapshot. '''
+    from .core import Snapshot
+    kwargs.setdefault('print_level', 1)
+    base = Snapshot(data=blobs[0], instructions=blobs[1], vm=True,
+        data_offset=VM_OFFSETS[0], instructions_offset=VM_OFFSETS[1], **kwargs).parse()
+    return Snapshot(data=blobs[2], instructions=blobs[3], base=base,
+        data_offset=ISOLATE_OFFSETS[0], instructions_offset=ISOLATE_OFFSETS[1], **kwargs).parse()
+
+if __name__ == '__main__':
+    # Usage: python -m darter.synth [--size small|medium|large] [--arch ARCH] [--seed N] <output file>
+    import argparse
+    from .write import write_appjit_snapshot
+    parser = argparse.ArgumentParser(prog='python -m darter.synth',
+        description='Generates a synthetic snapshot file (that parse_appjit_snapshot() reads).')
+    parser.add_argument('output')
+    parser.add_argument('--size', choices=list(SIZES), default='small')
+    parser.add_argument('--arch', choices=list(HEADER), default='arm64')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_appjit_snapshot(args.output, generate(arch=args.arch, seed=args.seed, **SIZES[args.size]))
@@ -0,0 +1,453 @@
+# WRITE: Serializer that produces snapshots in the format CORE parses (used to generate test / benchmark snapshots)
+
+import io
+import re
+from struct import pack, unpack
+
+from .constants import *
+from .data.type_data import make_type_data
+
+
+# Writing primitives (inverse of those in READ)
+
+def writeuint(f, x, bits=64, signed=False):
+    if bits == 8:
+        f.write(pack('b' if signed else 'B', x)); return
+    out = bytearray()
+    while not ((-0x40 <= x < 0x40) if signed else (x < 0x80)):
+        out.append(x & 0x7F)
+        x >>= 7
+    out.append(x + (0xc0 if signed else 0x80))
+    f.write(out)
+
+def writeint(f, x, bits=64):
+    writeuint(f, x, bits, signed=True)
+
+writecid = lambda f, x: writeint(f, x, 32)
+write1 = lambda f, x: f.write(bytes([1 if x else 0]))
+writetokenposition = lambda f, x: writeint(f, x, 32)
+writedouble = lambda f, x: writeuint(f, unpack('<Q', pack('<d', x))[0], 70)
+
+def writecstr(f, x):
+    f.write(x + b'\0')
+
+
+def encode_code_source_map(ops):
+    ''' Inverse of parse_code_source_map() '''
+    f = io.BytesIO()
+    names = ['kChangePosition', 'kAdvancePC', 'kPushFunction', 'kPopFunction', 'kNullCheck']
+    for op in ops:
+        writeint(f, names.index(op[0]), 9)
+        for arg in op[1:]: writeint(f, arg, 32)
+    return f.getvalue()
+
+
+# Clusters whose fill section doesn't start with the fields in type_data
+DONT_READ_FROM = {'TypedData', 'Instance', 'Mint', 'ObjectPool', 'ExceptionHandlers', 'TypeArguments', 'Double',
+                  'Array', 'ContextScope', 'OneByteString', 'TwoByteString', 'PcDescriptors', 'CodeSourceMap', 'StackMap'}
+
+
+class Object:
+    ''' Object to be written: `x` holds its data, in the same form the parser produces '''
+    __slots__ = ('x',)
+    def __init__(self, x):
+        self.x = x
+
+
+class SnapshotWriter:
+    '''
+    Writes a snapshot (data and instructions blobs) from objects built in memory.
+    Objects are grouped into clusters (created with `cluster()`, in the order they'll
+    be written) and added with `add(cluster, **x)`, where `x` is the data of the
+    object as the parser returns it: fields named as in type_data, referencing other
+    objects (or refs of base objects, as ints; None is null), plus the cluster
+    specific data (`value` of strings and arrays, `entries` of object pools,
+    `instructions` of Code...). Missing fields are written as null / zero.
+    The root fields go into `roots`.
+
+    Only what the parser supports can be written; as there's no VM snapshot writer
+    for the base objects, `num_base_objects` must be passed (i.e. the number of
+    objects of the VM snapshot, or of the core base objects).
+    '''
+
+    def __init__(self, kind='kFullAOT', arch='arm64', features=None, num_base_objects=None, vm=False):
+        self.kind = kkKind[kind]
+        self.arch = arch
+        self.features = features if features is not None else ['product', 'no-debug', arch + '-sysv']
+        self.vm = vm
+        self.is_64 = arch.split('-')[0] in {'x64', 'arm64'}
+        self.is_product = 'product' in self.features
+        self.is_precompiled = self.kind == kkKind['kFullAOT'] and self.is_product
+        self.includes_code = self.kind in {kkKind['kFullJIT'], kkKind['kFullAOT']}
+        self.includes_bytecode = self.kind in {kkKind['kFull'], kkKind['kFullJIT']}
+        self.kObjectAlignmentLog2 = (2 * (8 if self.is_64 else 4)).bit_length() - 1
+        self.num_base_objects = num_base_objects
+        self.types = self.make_types()
+        self.clusters = []
+        self.roots = {}
+
+    def make_types(self):
+        types, mappings = make_type_data(self.is_precompiled, self.is_product)
+        for name, fields in types.items():
+            mapping = mappings.get(name)
+            if not (mapping is None or type(mapping) is bool):
+                last_field = mapping[{ kkKind[n]: i for i, n in enumerate(['kFull', 'kFullJIT', 'kFullAOT']) }[self.kind]]
+                idx = next(filter(lambda x: x[1][1] == last_field, enumerate(fields)))[0]
+                fields = fields[:idx+1]
+            if name == 'ClosureData' and self.kind == kkKind['kFullAOT']:
+                fields = [f for f in fields if f[1] != 'context_scope']
+            if name == 'Code':
+                if not self.is_precompiled and self.kind != kkKind['kFullJIT']:
+                    fields = [f for f in fields if f[1] not in {'deopt_info_array', 'static_calls_target_table'}]
+            types[name] = fields
+        return types
+
+    # Building
+
+    def cluster(self, cid, **attrs):
+        ''' Creates a new cluster, for a cid (or class name). Instance clusters need
+            `next_field_offset_in_words` and `instance_size_in_words` in `attrs`. '''
+        if type(cid) is str: cid = kkClassId[cid]
+        if cid >= kNumPredefinedCids: handler = 'Instance'
+        elif isTypedData(cid) or isExternalTypedData(cid): handler = 'TypedData'
+        elif isTypedDataView(cid): handler = 'TypedDataView'
+        elif cid == kkClassId['ImmutableArray']: handler = 'Array'
+        else: handler = kClassId[cid]
+        cluster = { 'handler': handler, 'cid': cid, 'refs': [], **attrs }
+        self.clusters.append(cluster)
+        return cluster
+
+    def add(self, cluster, **x):
+        obj = Object(x)
+        cluster['refs'].append(obj)
+        return obj
+
+    # Serialization
+
+    def resolve(self, v):
+        if v is None: return 1
+        if type(v) is int: return v
+        r = self.assigned.get(id(v))
+        return v.ref if r is None else r
+
+    def assign_refs(self):
+        self.assigned = {}
+        n = self.num_base_objects + 1
+        for c in self.clusters:
+            for obj in self.alloc_order(c):
+                self.assigned[id(obj)] = n
+                n += 1
+        self.num_objects = n - 1
+
+    def alloc_order(self, c):
+        if c['handler'] == 'Class':
+            return [o for o in c['refs'] if o.x.get('predefined')] + [o for o in c['refs'] if not o.x.get('predefined')]
+        return c['refs']
+
+    def is_rodata(self, c):
+        return self.includes_code and c['handler'] in {'OneByteString', 'TwoByteString', 'PcDescriptors', 'CodeSourceMap', 'StackMap'}
+
+    def write(self):
+        ''' Serializes the snapshot, returns (data, instructions) blobs. The rodata
+            (strings, PcDescriptors...) is appended to the data blob. '''
+        self.assign_refs()
+        self.rodata = io.BytesIO()
+        self.instructions = io.BytesIO()
+        f = self.data = io.BytesIO()
+        f.write(bytes(4 + 8 + 8))
+        f.write(EXPECTED_VERSION.encode('ascii'))
+        writecstr(f, ' '.join(self.features).encode('ascii'))
+        codes = sum(len(c['refs']) for c in self.clusters if c['handler'] == 'Code')
+        for x in (self.num_base_objects, self.num_objects, len(self.clusters), codes):
+            writeuint(f, x)
+        for c in self.clusters:
+            writecid(f, c['cid'])
+            getattr(self, 'alloc_' + self.alloc_kind(c))(f, c)
+        for c in self.clusters:
+            self.write_fill_cluster(f, c)
+        self.write_roots(f)
+
+        length = len(f.getbuffer()) - 4
+        f.seek(0)
+        f.write(pack('<Iqq', MAGIC_VALUE, length, self.kind))
+        f.seek(0, 2)
+        if self.includes_code:
+            f.write(bytes(-len(f.getbuffer()) % kMaxPreferredCodeAlignment))
+            f.write(self.rodata.getvalue())
+        return f.getvalue(), (self.instructions.getvalue() if self.includes_code else None)
+
+    def alloc_kind(self, c):
+        if self.is_rodata(c): return 'rodata'
+        h = c['handler']
+        if h == 'TypedData':
+            return 'simple' if isExternalTypedData(c['cid']) else 'length'
+        if h in {'ObjectPool', 'ExceptionHandlers', 'TypeArguments', 'Array', 'ContextScope', 'OneByteString', 'TwoByteString'}:
+            return 'length'
+        if h in {'Class', 'Instance', 'Type', 'Mint'}:
+            return h.lower()
+        return 'simple'
+
+    def alloc_simple(self, f, c):
+        writeuint(f, len(c['refs']))
+
+    def alloc_length(self, f, c):
+        writeuint(f, len(c['refs']))
+        for o in c['refs']:
+            writeuint(f, self.object_length(c, o))
+
+    def object_length(self, c, o):
+        x = o.x
+        if 'length' in x: return x['length']
+        h = c['handler']
+        if h in {'Array', 'TypedData', 'OneByteString', 'TwoByteString'}: return len(x['value'])
+        if h == 'TypeArguments': return len(x['types'])
+        if h in {'ObjectPool', 'ExceptionHandlers'}: return len(x['entries'])
+        if h == 'ContextScope': return len(x['variables'])
+        raise Exception('Unknown length for {}'.format(h))
+
+    def alloc_class(self, f, c):
+        predefined = [o for o in c['refs'] if o.x.get('predefined')]
+        writeuint(f, len(predefined))
+        for o in predefined: writecid(f, o.x['cid'])
+        writeuint(f, len(c['refs']) - len(predefined))
+
+    def alloc_instance(self, f, c):
+        writeuint(f, len(c['refs']))
+        writeint(f, c['next_field_offset_in_words'], 32)
+        writeint(f, c['instance_size_in_words'], 32)
+
+    def alloc_type(self, f, c):
+        canonical = [o for o in c['refs'] if o.x.get('canonical')]
+        assert c['refs'][:len(canonical)] == canonical
+        writeuint(f, len(canonical))
+        writeuint(f, len(c['refs']) - len(canonical))
+
+    def alloc_mint(self, f, c):
+        writeuint(f, len(c['refs']))
+        for o in c['refs']:
+            write1(f, o.x.get('canonical', False))
+            writeint(f, o.x['value'], 64)
+
+    def alloc_rodata(self, f, c):
+        writeuint(f, 0)
+        writeuint(f, len(c['refs']))
+        align = 1 << self.kObjectAlignmentLog2
+        r = self.rodata
+        last = 0
+        for o in c['refs']:
+            r.write(bytes(-len(r.getbuffer()) % align))
+            offset = len(r.getbuffer())
+            writeuint(f, (offset - last) >> self.kObjectAlignmentLog2)
+            last = offset
+            r.write(self.encode_rodata(c['handler'], o.x))
+
+    def encode_rodata(self, h, x):
+        tags = x.get('tags', 0)
+        if h in {'OneByteString', 'TwoByteString'}:
+            data = x['value'].encode('latin-1' if h == 'OneByteString' else 'utf-16-le')
+            length = len(x['value']) * 2
+            hdr = pack('<LLQ', tags, x.get('hash', 0), length) if self.is_64 else pack('<LLL', tags, length, x.get('hash', 0))
+            return hdr + data
+        if h in {'PcDescriptors', 'CodeSourceMap'}:
+            data = x['data'] if 'data' in x else encode_code_source_map(x['ops'])
+            hdr = pack('<LLQ', tags, 0, len(data)) if self.is_64 else pack('<LL', tags, len(data))
+            return hdr + bytes(data)
+        if h == 'StackMap':
+            bits = x['bits']
+            hdr = pack('<L', tags) + (bytes(4) if self.is_64 else b'')
+            hdr += pack('<IHH', x.get('pc_offset', 0), len(bits), x.get('slow_path_bit_count', 0))
+            data = bytes(sum(bool(b) << i for i, b in enumerate(bits[n:n+8])) for n in range(0, len(bits), 8))
+            return hdr + data
+        raise Exception('Unknown rodata object {}'.format(h))
+
+    def write_instructions(self, f, instr):
+        if instr is None:
+            writeint(f, -1, 32); return
+        r = self.instructions
+        r.write(bytes(-len(r.getbuffer()) % kMaxPreferredCodeAlignment))
+        writeint(f, len(r.getbuffer()), 32)
+        size_and_flags = len(instr['data']) | (bool(instr.get('flags', {}).get('single_entry')) << 31)
+        unchecked = instr.get('unchecked_entrypoint_pc_offset', 0)
+        if self.is_64:
+            r.write(pack('<LLLL', instr.get('tags', 0), 0, size_and_flags, unchecked))
+            r.write(b'\xcc' * 16)
+        else:
+            r.write(pack('<LLLL', instr.get('tags', 0), size_and_flags, unchecked, 0))
+        r.write(bytes(instr['data']))
+
+    def write_fields(self, f, name, x):
+        for _, fname, _ in self.types[name]:
+            writeuint(f, self.resolve(x.get(fname)))
+
+    def write_fill_cluster(self, f, c):
+        h = c['handler']
+        fill = None if self.is_rodata(c) else getattr(self, 'fill_' + h, None)
+        if fill is None and not self.is_rodata(c):
+            raise Exception('Cluster "{}" not supported by the writer'.format(h))
+        do_read_from = h in self.types and h not in DONT_READ_FROM
+        for o in self.alloc_order(c):
+            x = o.x
+            if do_read_from:
+                if h in {'Closure', 'GrowableObjectArray'}:
+                    write1(f, x.get('canonical', False))
+                if h == 'Code':
+                    self.write_instructions(f, x.get('instructions'))
+                    if not self.is_precompiled and self.kind == kkKind['kFullJIT']:
+                        self.write_instructions(f, x.get('active_instructions'))
+                self.write_fields(f, h, x)
+            if fill: fill(f, x, c)
+
+    def write_roots(self, f):
+        x = self.roots
+        if self.vm:
+            writeuint(f, self.resolve(x.get('symbol_table')))
+            if self.includes_code:
+                for stub in x['_stubs']: writeuint(f, self.resolve(stub))
+        else:
+            self.write_fields(f, 'ObjectStore', x)
+
+    # Fill writers (mirror HandlerStore in clusters.py)
+
+    def fill_TypedData(self, f, x, c):
+        external = isExternalTypedData(c['cid'])
+        value = x['value']
+        writeuint(f, len(value))
+        if external:
+            f.write(bytes(-len(f.getbuffer()) % kDataSerializationAlignment))
+        else:
+            write1(f, x.get('canonical', False))
+        m = re.fullmatch('(External)?TypedData(.+)Array', kClassId[c['cid']])
+        fmt = {'Int8': 'b', 'Uint8': 'B', 'Int16': 'h', 'Uint16': 'H', 'Int32': 'i', 'Uint32': 'I', 'Int64': 'q', 'Uint64': 'Q'}[m.group(2)]
+        f.write(bytes(value) if fmt == 'B' else pack('<{}{}'.format(len(value), fmt), *value))
+
+    def fill_Class(self, f, x, c):
+        writecid(f, x['cid'])
+        if (not self.is_precompiled) and (self.kind != kkKind['kFullAOT']):
+            writeuint(f, x.get('binary_declaration', 0), 32)
+        writeint(f, x.get('instance_size_in_words', 0), 32)
+        writeint(f, x.get('next_field_offset_in_words', 0), 32)
+        writeint(f, x.get('type_arguments_field_offset_in_words', 0), 32)
+        writeint(f, x.get('num_type_arguments', 0), 16)
+        writeuint(f, x.get('num_native_fields', 0), 16)
+        writetokenposition(f, x.get('token_pos', 0))
+        writetokenposition(f, x.get('end_token_pos', 0))
+        writeuint(f, x.get('state_bits', 0), 32)
+
+    def fill_Instance(self, f, x, c):
+        write1(f, x.get('canonical', False))
+        fields = x['fields']
+        assert len(fields) == c['next_field_offset_in_words'] - 1
+        for v in fields: writeuint(f, self.resolve(v))
+
+    def fill_Type(self, f, x, c):
+        writetokenposition(f, x.get('token_pos', 0))
+        writeint(f, x.get('type_state', 0), 8)
+
+    def fill_Mint(self, f, x, c): pass
+
+    def fill_PatchClass(self, f, x, c):
+        if (not self.is_precompiled) and (self.kind != kkKind['kFullAOT']):
+            writeint(f, x.get('library_kernel_offset', 0), 32)
+
+    def fill_Function(self, f, x, c):
+        if not self.is_precompiled:
+            if self.kind == kkKind['kFullJIT']:
+                writeuint(f, self.resolve(x.get('unoptimized_code')))
+            if self.includes_bytecode:
+                writeuint(f, self.resolve(x.get('bytecode')))
+        if self.includes_code:
+            writeuint(f, self.resolve(x.get('code')))
+        if self.kind == kkKind['kFullJIT']:
+            writeuint(f, self.resolve(x.get('ic_data_array')))
+        if (not self.is_precompiled) and (self.kind != kkKind['kFullAOT']):
+            writetokenposition(f, x.get('token_pos', 0))
+            writetokenposition(f, x.get('end_token_pos', 0))
+            writeuint(f, x.get('binary_declaration', 0), 32)
+        writeuint(f, x.get('packed_fields', 0), 32)
+        writeuint(f, x.get('kind_tag', 0), 64)
+
+    def fill_Field(self, f, x, c):
+        if self.kind != kkKind['kFullAOT']:
+            writetokenposition(f, x.get('token_pos', 0))
+            writetokenposition(f, x.get('end_token_pos', 0))
+            writecid(f, x.get('guarded_cid', 0))
+            writecid(f, x.get('is_nullable', 0))
+            writeint(f, x.get('static_type_exactness_state', 0), 8)
+            if not self.is_precompiled:
+                writeuint(f, x.get('binary_declaration', 0), 32)
+        writeuint(f, x.get('kind_bits', 0), 16)
+
+    def fill_Script(self, f, x, c):
+        writeint(f, x.get('line_offset', 0), 32)
+        writeint(f, x.get('col_offset', 0), 32)
+        writeint(f, x.get('kind', 0), 8)
+        writeint(f, x.get('kernel_script_index', 0), 32)
+
+    def fill_Library(self, f, x, c):
+        writeint(f, x.get('index', 0), 32)
+        writeuint(f, x.get('num_imports', 0), 16)
+        writeint(f, x.get('load_state', 0), 8)
+        write1(f, x.get('is_dart_scheme', False))
+        write1(f, x.get('debuggable', False))
+        if not self.is_precompiled:
+            writeuint(f, x.get('binary_declaration', 0), 32)
+
+    def fill_Code(self, f, x, c):
+        writeint(f, x.get('state_bits', 0), 32)
+
+    def fill_ObjectPool(self, f, x, c):
+        writeuint(f, len(x['entries']))
+        for e in x['entries']:
+            writeuint(f, e['type'] | ((not e.get('patchable', True)) << 7), 8)
+            if e['type'] in {kkEntryType['kNativeEntryData'], kkEntryType['kTaggedObject']}:
+                writeuint(f, self.resolve(e['raw_obj']))
+            elif e['type'] == kkEntryType['kImmediate']:
+                writeint(f, e['raw_value'])
+
+    def fill_TypeArguments(self, f, x, c):
+        writeuint(f, len(x['types']))
+        write1(f, x.get('canonical', False))
+        writeint(f, x.get('hash', 0), 32)
+        writeuint(f, self.resolve(x.get('instantiations')))
+        for v in x['types']: writeuint(f, self.resolve(v))
+
+    def fill_Double(self, f, x, c):
+        write1(f, x.get('canonical', False))
+        writedouble(f, x['value'])
+
+    def fill_Array(self, f, x, c):
+        writeuint(f, len(x['value']))
+        write1(f, x.get('canonical', False))
+        writeuint(f, self.resolve(x.get('type_arguments')))
+        for v in x['value']: writeuint(f, self.resolve(v))
+
+    def fill_OneByteString(self, f, x, c):
+        writeuint(f, len(x['value']))
+        write1(f, x.get('canonical', False))
+        writeuint(f, x.get('hash', 0), 32)
+        f.write(x['value'].encode('latin-1'))
+
+    def fill_TwoByteString(self, f, x, c):
+        writeuint(f, len(x['value']))
+        write1(f, x.get('canonical', False))
+        writeuint(f, x.get('hash', 0), 32)
+        f.write(x['value'].encode('utf-16-le'))
+
+    def fill_MegamorphicCache(self, f, x, c):
+        writeint(f, x.get('filled_entry_count', 0), 32)
+
+    def fill_ObjectStore(self, f, x, c): pass
+    fill_ClosureData = fill_SignatureData = fill_UnlinkedCall = fill_SubtypeTestCache = fill_UnhandledException = \
+        fill_TypeRef = fill_Closure = fill_GrowableObjectArray = fill_StackTrace = fill_Namespace = \
+        fill_WeakProperty = fill_ObjectStore
+
+
+def write_appjit_snapshot(fname, blobs):
+    ''' Writes the (VM data, VM instructions, isolate data, isolate instructions) blobs
+        into an AppJIT-style snapshot file, that parse_appjit_snapshot() reads '''
+    with open(fname, 'wb') as f:
+        f.write(pack('<Q', kAppJITMagic))
+        f.write(pack('<4q', *(len(b or b'') for b in blobs)))
+        for blob in blobs:
+            f.write(bytes(-f.tell() % kAppSnapshotPageSize))
+            f.write(blob or b'')